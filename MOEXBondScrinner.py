@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import urllib.request
 import urllib.error
+import asyncio
 import time
 import json
 import logging
@@ -8,73 +9,513 @@ import os
 import csv
 import sqlite3
 import platform
-from datetime import datetime, timedelta
+import sys
+import array
+import threading
+import http.server
+import functools
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import gzip
+import io
+from datetime import datetime, timedelta, date
+
+
+class BondsMetrics:
+    _lock = threading.Lock()
+    _stages = {}
+    _filters = {}
+    _requests = {"count": 0, "failures": 0, "retries": 0, "retry_sleep_sec": 0.0, "bytes": 0,
+                 "latency_sum_sec": 0.0, "latency_buckets": {}}
+    _cache = {}
+    latency_buckets = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    @staticmethod
+    def measure_stage(function):
+        stage_name = function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                BondsMetrics.record_stage(stage_name, time.perf_counter() - start_time)
+        return wrapper
+
+    @staticmethod
+    def measure_generator(function):
+        # Generators are measured under the name of their list-returning wrapper
+        stage_name = function.__qualname__.replace(".iter_", ".")
+
+        @functools.wraps(function)
+        def wrapper(bonds_list, *args, **kwargs):
+            counter = {"input": 0, "output": 0, "duration_sec": 0.0}
+
+            def count_input(input_bonds):
+                # Time spent in upstream generators is not part of this stage, so durations of chained stages
+                # are not overlapped
+                input_iterator = iter(input_bonds)
+                while True:
+                    start_time = time.perf_counter()
+                    try:
+                        bond = next(input_iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        counter["duration_sec"] -= time.perf_counter() - start_time
+                    counter["input"] += 1
+                    yield bond
+
+            generator = function(count_input(bonds_list), *args, **kwargs)
+            try:
+                while True:
+                    start_time = time.perf_counter()
+                    try:
+                        bond = next(generator)
+                    finally:
+                        counter["duration_sec"] += time.perf_counter() - start_time
+                    counter["output"] += 1
+                    yield bond
+            except StopIteration:
+                return
+            finally:
+                generator.close()
+                BondsMetrics.record_stage(stage_name, counter["duration_sec"])
+                BondsMetrics.record_filter(stage_name, counter["input"], counter["output"])
+        return wrapper
+
+    @staticmethod
+    def record_stage(stage_name, duration_sec):
+        with BondsMetrics._lock:
+            stage = BondsMetrics._stages.setdefault(stage_name, {"count": 0, "total_sec": 0.0, "max_sec": 0.0})
+            stage["count"] += 1
+            stage["total_sec"] += duration_sec
+            stage["max_sec"] = max(stage["max_sec"], duration_sec)
+
+    @staticmethod
+    def record_filter(filter_name, input_count, output_count):
+        with BondsMetrics._lock:
+            current_filter = BondsMetrics._filters.setdefault(filter_name, {"input": 0, "output": 0})
+            current_filter["input"] += input_count
+            current_filter["output"] += output_count
+
+    @staticmethod
+    def record_request(latency_sec, bytes_count=0, is_failed=False):
+        with BondsMetrics._lock:
+            requests = BondsMetrics._requests
+            requests["count"] += 1
+            requests["latency_sum_sec"] += latency_sec
+            requests["bytes"] += bytes_count
+            if is_failed:
+                requests["failures"] += 1
+            bucket = next((bound for bound in BondsMetrics.latency_buckets if latency_sec <= bound), "+Inf")
+            requests["latency_buckets"][bucket] = requests["latency_buckets"].get(bucket, 0) + 1
+
+    @staticmethod
+    def record_retry(sleep_sec):
+        with BondsMetrics._lock:
+            BondsMetrics._requests["retries"] += 1
+            BondsMetrics._requests["retry_sleep_sec"] += sleep_sec
+
+    @staticmethod
+    def record_cache(cache_name, is_hit):
+        with BondsMetrics._lock:
+            cache = BondsMetrics._cache.setdefault(cache_name, {"hits": 0, "misses": 0})
+            cache["hits" if is_hit else "misses"] += 1
+
+    @staticmethod
+    def reset():
+        with BondsMetrics._lock:
+            BondsMetrics._stages.clear()
+            BondsMetrics._filters.clear()
+            BondsMetrics._cache.clear()
+            BondsMetrics._requests.update({"count": 0, "failures": 0, "retries": 0, "retry_sleep_sec": 0.0,
+                                           "bytes": 0, "latency_sum_sec": 0.0, "latency_buckets": {}})
+
+    @staticmethod
+    def get_report():
+        with BondsMetrics._lock:
+            requests = dict(BondsMetrics._requests)
+            buckets = requests.pop("latency_buckets")
+            requests["latency_histogram"] = [(str(bound), buckets.get(bound, 0)) for bound
+                                             in BondsMetrics.latency_buckets + ("+Inf",)]
+            filters = {}
+            for (filter_name, current_filter) in BondsMetrics._filters.items():
+                selectivity = current_filter["output"] / current_filter["input"] if current_filter["input"] else None
+                filters[filter_name] = dict(current_filter, selectivity=selectivity)
+            return {"stages": {name: dict(stage) for (name, stage) in BondsMetrics._stages.items()},
+                    "filters": filters, "requests": requests,
+                    "cache": {name: dict(cache) for (name, cache) in BondsMetrics._cache.items()}}
+
+    @staticmethod
+    def to_prometheus(prefix="moex_bonds"):
+        report = BondsMetrics.get_report()
+        lines = [f"# HELP {prefix}_stage_duration_seconds Time spent in library stages.",
+                 f"# TYPE {prefix}_stage_duration_seconds summary"]
+        for (name, stage) in report["stages"].items():
+            lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{name}"}} {stage["total_sec"]}')
+            lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+        lines += [f"# HELP {prefix}_filter_bonds_total Bonds passed to and left after filters.",
+                  f"# TYPE {prefix}_filter_bonds_total counter"]
+        for (name, current_filter) in report["filters"].items():
+            lines.append(f'{prefix}_filter_bonds_total{{filter="{name}",direction="input"}} {current_filter["input"]}')
+            lines.append(f'{prefix}_filter_bonds_total{{filter="{name}",direction="output"}} {current_filter["output"]}')
+        requests = report["requests"]
+        for (metric, key, help_text) in (("requests_total", "count", "Requests to MOEX ISS."),
+                                         ("request_failures_total", "failures", "Failed requests to MOEX ISS."),
+                                         ("request_retries_total", "retries", "Retries of requests to MOEX ISS."),
+                                         ("retry_sleep_seconds_total", "retry_sleep_sec", "Time slept before retries."),
+                                         ("response_bytes_total", "bytes", "Bytes received from MOEX ISS.")):
+            lines += [f"# HELP {prefix}_{metric} {help_text}", f"# TYPE {prefix}_{metric} counter",
+                      f"{prefix}_{metric} {requests[key]}"]
+        lines += [f"# HELP {prefix}_request_duration_seconds Latency of requests to MOEX ISS.",
+                  f"# TYPE {prefix}_request_duration_seconds histogram"]
+        cumulative_count = 0
+        for (bound, count) in requests["latency_histogram"]:
+            cumulative_count += count
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{le="{bound}"}} {cumulative_count}')
+        lines.append(f"{prefix}_request_duration_seconds_sum {requests['latency_sum_sec']}")
+        lines.append(f"{prefix}_request_duration_seconds_count {requests['count']}")
+        lines += [f"# HELP {prefix}_cache_requests_total Cache lookups by result.",
+                  f"# TYPE {prefix}_cache_requests_total counter"]
+        for (name, cache) in report["cache"].items():
+            lines.append(f'{prefix}_cache_requests_total{{cache="{name}",result="hit"}} {cache["hits"]}')
+            lines.append(f'{prefix}_cache_requests_total{{cache="{name}",result="miss"}} {cache["misses"]}')
+        return "\n".join(lines) + "\n"
+
+
+class BondsISSColumns:
+    def __init__(self, names):
+        self.names = list(names)
+        self.columns = {name: [] for name in self.names}
+        self._length = 0
+
+    @staticmethod
+    def from_iss(data, root_name):
+        result = BondsISSColumns(data[root_name]["columns"])
+        rows = data[root_name]["data"]
+        for (i, name) in enumerate(result.names):
+            result.columns[name] = BondsISSColumns._pack_column(name, [line[i] for line in rows])
+        result._length = len(rows)
+        return result
+
+    @staticmethod
+    def from_rows(rows, names):
+        data = {"rows": {"columns": list(names), "data": [[row.get(name) for name in names] for row in rows]}}
+        return BondsISSColumns.from_iss(data, "rows")
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self.rows()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row(i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Row index is out of range")
+        return self.row(index)
+
+    def column(self, name):
+        column = self.columns[name]
+        if isinstance(column, array.array) and column.typecode == 'l':
+            return [BondsISSColumns._unpack_date(value) for value in column]
+        if isinstance(column, array.array) and column.typecode == 'd':
+            return [None if value != value else value for value in column]
+        return list(column)
+
+    def row(self, index):
+        result = {}
+        for name in self.names:
+            column = self.columns[name]
+            value = column[index]
+            if isinstance(column, array.array):
+                if column.typecode == 'l':
+                    value = BondsISSColumns._unpack_date(value)
+                elif column.typecode == 'd' and value != value:
+                    value = None
+            result[name] = value
+        return result
+
+    def rows(self):
+        for index in range(self._length):
+            yield self.row(index)
+
+    def extend(self, other):
+        if other.names != self.names:
+            raise ValueError(f"Can not extend columns {str(self.names)} with columns {str(other.names)}")
+        for name in self.names:
+            column = self.columns[name]
+            other_column = other.columns[name]
+            if type(column) is type(other_column) and getattr(column, "typecode", None) == \
+                    getattr(other_column, "typecode", None):
+                column.extend(other_column)
+            elif self._length == 0:
+                self.columns[name] = other_column[:]
+            else:
+                # Types of columns are different, so values are stored as they are received from ISS
+                self.columns[name] = self.column(name) + other.column(name)
+        self._length += len(other)
+
+    def to_list(self):
+        return list(self.rows())
+
+    @staticmethod
+    def _pack_column(name, values):
+        if name.lower().endswith("date"):
+            packed_dates = {}
+            try:
+                for value in values:
+                    if value not in packed_dates:
+                        packed_dates[value] = BondsISSColumns._pack_date(value)
+                return array.array('l', [packed_dates[value] for value in values])
+            except (TypeError, ValueError):
+                pass
+        value_types = {type(value) for value in values}
+        if value_types and value_types <= {float, type(None)}:
+            return array.array('d', [float('nan') if value is None else value for value in values])
+        if value_types == {int}:
+            try:
+                return array.array('q', values)
+            except OverflowError:
+                pass
+        return [sys.intern(value) if type(value) is str else value for value in values]
+
+    @staticmethod
+    def _pack_date(value):
+        if value is None:
+            return -1
+        if value == "0000-00-00":
+            return 0
+        parsed_date = date.fromisoformat(value)
+        if parsed_date.isoformat() != value:
+            raise ValueError(f"Date '{value}' can not be restored from ordinal")
+        return parsed_date.toordinal()
+
+    @staticmethod
+    def _unpack_date(value):
+        if value == -1:
+            return None
+        if value == 0:
+            return "0000-00-00"
+        return date.fromordinal(value).isoformat()
+
+
+class BondsCacheLock:
+    def __init__(self, filename, poll_interval_sec=1.0):
+        self.filename = filename
+        self.poll_interval_sec = poll_interval_sec
+        self._fh = None
+
+    def acquire(self, blocking=True):
+        fh = open(self.filename, 'a+')
+        while True:
+            try:
+                BondsCacheLock._lock_file(fh, blocking)
+                self._fh = fh
+                return True
+            except OSError:
+                # Windows can not wait for a lock infinitely, so it is polled
+                if blocking and platform.system() == "Windows":
+                    time.sleep(self.poll_interval_sec)
+                    continue
+                fh.close()
+                if blocking:
+                    raise
+                return False
+
+    def release(self):
+        if self._fh is None:
+            return
+        try:
+            if platform.system() == "Windows":
+                import msvcrt
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @staticmethod
+    def _lock_file(fh, blocking):
+        if platform.system() == "Windows":
+            import msvcrt
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
 
 
 class BondsMOEXDataRetriever:
     @staticmethod
-    def load_or_retrieve(bonds_group_list=(7, 58)):
-        cache_filename = datetime.strftime(datetime.today(), "%Y-%m-%d") + ".json"
+    @BondsMetrics.measure_stage
+    def load_or_retrieve(bonds_group_list=(7, 58), cache_dir=None, wait_for_leader=True, filter_description_dict=None,
+                         liquidity_store=None, columnar=False):
+        cache_dir = BondsMOEXDataRetriever.get_cache_dir(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_name = datetime.strftime(datetime.today(), "%Y-%m-%d")
+        cache_filename = os.path.join(cache_dir, cache_name + ".json")
+        cache_lock = BondsCacheLock(os.path.join(cache_dir, cache_name + ".lock"))
+        if not cache_lock.acquire(blocking=False):
+            if not wait_for_leader and os.path.isfile(cache_filename):
+                cached_object = BondsMOEXDataRetriever.load_results_from_file(cache_filename)
+                logging.warning(f"Another process is retrieving data. Partially retrieved data with status "
+                                f"'{cached_object.get('status', 'list_only')}' will be used.")
+                bonds_list = cached_object.get("data", [])
+                if columnar:
+                    BondsMOEXDataRetriever.convert_payments_to_columns(bonds_list)
+                return bonds_list
+            logging.info("Another process is retrieving data. Please wait until it will be finished.")
+            cache_lock.acquire()
+        try:
+            return BondsMOEXDataRetriever._load_or_retrieve_locked(bonds_group_list, cache_filename,
+                                                                   filter_description_dict, liquidity_store, columnar)
+        finally:
+            cache_lock.release()
+
+    @staticmethod
+    def get_cache_dir(cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("MOEX_BONDS_CACHE_DIR", ".")
+        return cache_dir
+
+    @staticmethod
+    def _load_or_retrieve_locked(bonds_group_list, cache_filename, filter_description_dict=None,
+                                 liquidity_store=None, columnar=False):
+        BondsMetrics.record_cache("daily_file", os.path.isfile(cache_filename))
         if not os.path.isfile(cache_filename):
             logging.info("No cached data is found. Please wait until current data will be retrieved.")
-            bonds_list = BondsMOEXDataRetriever.get_bonds_info(bonds_group_list)
+            (bonds_list, pending_list) = BondsMOEXDataRetriever.split_listing(
+                BondsMOEXDataRetriever.get_bonds_info(bonds_group_list), filter_description_dict)
             cached_status = "list_only"
-            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status)
+            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status, pending_list)
         else:
             logging.info("Found cached data. Less new requests will be required.")
             cached_object = BondsMOEXDataRetriever.load_results_from_file(cache_filename)
             cached_status = cached_object.get("status", "list_only")
             bonds_list = cached_object.get("data", [])
+            pending_list = cached_object.get("pending", [])
+            if columnar:
+                # Cache file stores schedules as rows, so they are packed again after loading
+                BondsMOEXDataRetriever.convert_payments_to_columns(bonds_list)
+            if pending_list:
+                # Bonds skipped by previous narrower query are enriched only if they are required now
+                (new_bonds_list, pending_list) = BondsMOEXDataRetriever.split_listing(pending_list,
+                                                                                      filter_description_dict)
+                if new_bonds_list:
+                    logging.info(f"{str(len(new_bonds_list))} bonds which were skipped before will be retrieved.")
+                    new_bonds_list = BondsMOEXDataRetriever.enrich_bonds_up_to_status(new_bonds_list, cached_status,
+                                                                                      liquidity_store, columnar)
+                    bonds_list = bonds_list + new_bonds_list
+                    BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status,
+                                                                pending_list)
 
         if cached_status == "list_only":
             logging.info("There is no data about bonds description. This data will be retrieved.")
             bonds_list = BondsMOEXDataRetriever.enrich_bonds_description(bonds_list)
             cached_status = "with_description"
-            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status)
+            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status, pending_list)
 
         if cached_status == "with_description":
             logging.info("There is no data about bonds payments. This data will be retrieved.")
-            bonds_list = BondsMOEXDataRetriever.enrich_bonds_payments(bonds_list)
+            bonds_list = BondsMOEXDataRetriever.enrich_bonds_payments(bonds_list, columnar)
             cached_status = "with_payments"
-            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status)
+            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status, pending_list)
 
         if cached_status == "with_payments":
             logging.info("There is no data about bonds sales history. This data will be retrieved.")
-            bonds_list = BondsMOEXDataRetriever.enrich_bonds_sales_history(bonds_list)
+            bonds_list = BondsMOEXDataRetriever.enrich_bonds_sales_history(bonds_list, liquidity_store)
             cached_status = "with_sales"
-            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status)
+            BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, cached_status, pending_list)
 
         logging.info(f"{str(len(bonds_list))} bonds were loaded for analyzing.")
         return bonds_list
 
     @staticmethod
+    def split_listing(bonds_list, filter_description_dict=None):
+        if filter_description_dict is None:
+            return bonds_list, []
+        filter_settings = BondsMOEXFilter.get_advanced_filter_settings(filter_description_dict)
+        result = []
+        pending_list = []
+        for bond in bonds_list:
+            try:
+                is_suitable = BondsMOEXFilter.check_bond_listing(bond, filter_settings)
+            except (KeyError, ValueError):
+                logging.error("Can not check listing data for bond " + str(bond), exc_info=True)
+                is_suitable = True
+            if is_suitable:
+                result.append(bond)
+            else:
+                pending_list.append(bond)
+        logging.info(f"{str(len(pending_list))} bonds are skipped by listing data, "
+                     f"{str(len(result))} bonds will be retrieved")
+        return result, pending_list
+
+    @staticmethod
+    def enrich_bonds_up_to_status(bonds_list, status, liquidity_store=None, columnar=False):
+        if status in ("with_description", "with_payments", "with_sales"):
+            bonds_list = BondsMOEXDataRetriever.enrich_bonds_description(bonds_list)
+        if status in ("with_payments", "with_sales"):
+            bonds_list = BondsMOEXDataRetriever.enrich_bonds_payments(bonds_list, columnar)
+        if status == "with_sales":
+            bonds_list = BondsMOEXDataRetriever.enrich_bonds_sales_history(bonds_list, liquidity_store)
+        return bonds_list
+
+    @staticmethod
+    @BondsMetrics.measure_stage
     def get_bonds_info(bounds_group_list):
         logging.debug("Entering 'get_bonds_info' function")
         result = []
         for bonds_group in bounds_group_list:
-            # additional info about coupon can be found in COUPONPERCENT, COUPONVALUE, NEXTCOUPON, COUPONPERIOD
-            request_url = "https://iss.moex.com/iss/engines/stock/markets/bonds/boardgroups/" + str(bonds_group) + \
-                          "/securities.json?iss.meta=off&iss.only=securities" \
-                          "&securities.columns=SECID,ISIN,SHORTNAME,SECNAME,PREVPRICE,LOTSIZE,FACEVALUE," \
-                          "MATDATE,OFFERDATE,FACEUNIT,ACCRUEDINT,SECTYPE,COUPONPERCENT,COUPONPERIOD"
+            request_url = BondsMOEXDataRetriever._get_bonds_info_url(bonds_group)
             data = BondsMOEXDataRetriever._url_request(request_url)
             if data is None:
                 logging.critical("Can not retrieve list of bonds. Further processing is impossible. "
                                  "Please check your internet connection.")
                 exit(1)
-            converted_data = BondsMOEXDataRetriever._convert_data_to_dict(data, "securities")
-            result = result + converted_data
+            # Every bond of the list is enriched as dict, so rows are built right away
+            result.extend(BondsMOEXDataRetriever._convert_data_to_dict(data, "securities"))
         logging.info(f"Found {str(len(result))} bonds")
         return result
 
+    @staticmethod
+    def _get_bonds_info_url(bonds_group):
+        # additional info about coupon can be found in COUPONPERCENT, COUPONVALUE, NEXTCOUPON, COUPONPERIOD
+        return "https://iss.moex.com/iss/engines/stock/markets/bonds/boardgroups/" + str(bonds_group) + \
+               "/securities.json?iss.meta=off&iss.only=securities" \
+               "&securities.columns=SECID,ISIN,SHORTNAME,SECNAME,PREVPRICE,LOTSIZE,FACEVALUE," \
+               "MATDATE,OFFERDATE,FACEUNIT,ACCRUEDINT,SECTYPE,COUPONPERCENT,COUPONPERIOD"
+
     @staticmethod
     def get_bond_description(sec_id):
         logging.debug(f"Entering 'get_bond_description' function with sec_id '{sec_id}'")
-        request_url = "https://iss.moex.com/iss/securities/" + str(sec_id) + \
-                      ".json?iss.meta=off&iss.only=description&description.columns=name,value"
-        data = BondsMOEXDataRetriever._url_request(request_url)
-        if data is None:
-            return
+        data = BondsMOEXDataRetriever._url_request(BondsMOEXDataRetriever._get_bond_description_url(sec_id))
+        return None if data is None else BondsMOEXDataRetriever._parse_bond_description(data)
+
+    @staticmethod
+    def _get_bond_description_url(sec_id):
+        return "https://iss.moex.com/iss/securities/" + str(sec_id) + \
+               ".json?iss.meta=off&iss.only=description&description.columns=name,value"
+
+    @staticmethod
+    def _parse_bond_description(data):
         result = {}
         for line in data['description']['data']:
             key = line[0]
@@ -83,33 +524,70 @@ class BondsMOEXDataRetriever:
         return result
 
     @staticmethod
-    def get_bond_payments(sec_id):
+    def get_bond_payments(sec_id, columnar=False):
         logging.debug(f"Entering 'get_bond_payments' function with sec_id '{sec_id}'")
-        request_url = "https://iss.moex.com/iss/statistics/engines/stock/markets/bonds/bondization/" + str(sec_id) + \
-                      ".json?iss.meta=off&iss.only=amortizations,coupons,offers&limit=unlimited" \
-                      "&amortizations.columns=amortdate,faceunit,value" \
-                      "&coupons.columns=coupondate,faceunit,value" \
-                      "&offers.columns=offerdate,offertype"
-        data = BondsMOEXDataRetriever._url_request(request_url)
-        amortizations_data = None if data is None else BondsMOEXDataRetriever._convert_data_to_dict(data, "amortizations")
-        coupons_data = None if data is None else BondsMOEXDataRetriever._convert_data_to_dict(data, "coupons")
-        offers_data = None if data is None else BondsMOEXDataRetriever._convert_data_to_dict(data, "offers")
+        data = BondsMOEXDataRetriever._url_request(BondsMOEXDataRetriever._get_bond_payments_url(sec_id))
+        if data is None:
+            return None, None, None
+        return BondsMOEXDataRetriever._parse_bond_payments(data, columnar)
+
+    @staticmethod
+    def _get_bond_payments_url(sec_id):
+        return "https://iss.moex.com/iss/statistics/engines/stock/markets/bonds/bondization/" + str(sec_id) + \
+               ".json?iss.meta=off&iss.only=amortizations,coupons,offers&limit=unlimited" \
+               "&amortizations.columns=amortdate,faceunit,value" \
+               "&coupons.columns=coupondate,faceunit,value" \
+               "&offers.columns=offerdate,offertype"
+
+    @staticmethod
+    def convert_payments_to_columns(bonds_list):
+        for bond in bonds_list:
+            for (key, names) in BondsMOEXDataRetriever._payments_columns.items():
+                if isinstance(bond.get(key), list):
+                    bond[key] = BondsISSColumns.from_rows(bond[key], names)
+        return bonds_list
+
+    @staticmethod
+    def _parse_bond_payments(data, columnar=False):
+        convert_function = BondsISSColumns.from_iss if columnar else BondsMOEXDataRetriever._convert_data_to_dict
+        amortizations_data = convert_function(data, "amortizations")
+        coupons_data = convert_function(data, "coupons")
+        offers_data = convert_function(data, "offers")
         return amortizations_data, coupons_data, offers_data
 
     @staticmethod
     def get_bonds_sales_history(sec_id, days_delta=15):
         logging.debug(f"Entering 'get_bonds_sales_history' function with sec_id '{sec_id}'")
-        today = datetime.today()
-        date_from = today - timedelta(days=days_delta)
-        request_url = "https://iss.moex.com/iss/history/engines/stock/markets/bonds/securities/" + str(sec_id) + \
-                      ".json?iss.meta=off&iss.only=history&history.columns=TRADEDATE,VOLUME,NUMTRADES" \
-                      "&limit=20&from=" + datetime.strftime(date_from, '%Y-%m-%d')
+        request_url = BondsMOEXDataRetriever._get_bonds_sales_history_url(sec_id, days_delta)
         data = BondsMOEXDataRetriever._url_request(request_url)
         return None if data is None else BondsMOEXDataRetriever._convert_data_to_dict(data, "history")
 
+    @staticmethod
+    def _get_bonds_sales_history_url(sec_id, days_delta=15):
+        date_from = datetime.today() - timedelta(days=days_delta)
+        return "https://iss.moex.com/iss/history/engines/stock/markets/bonds/securities/" + str(sec_id) + \
+               ".json?iss.meta=off&iss.only=history&history.columns=TRADEDATE,VOLUME,NUMTRADES" \
+               "&limit=20&from=" + datetime.strftime(date_from, '%Y-%m-%d')
+
+    @staticmethod
+    def iter_retrieve(bonds_group_list=(7, 58), columnar=False):
+        bonds_list = BondsMOEXDataRetriever.get_bonds_info(bonds_group_list)
+        # Every bond is fully enriched before the next one is requested, nothing is cached.
+        # Bonds are taken out of the list, so enriched bonds are not kept after they are consumed.
+        bonds_list.reverse()
+        bonds_iterator = (bonds_list.pop() for _ in range(len(bonds_list)))
+        bonds_iterator = BondsMOEXDataRetriever.iter_enrich_bonds_description(bonds_iterator)
+        bonds_iterator = BondsMOEXDataRetriever.iter_enrich_bonds_payments(bonds_iterator, columnar)
+        return BondsMOEXDataRetriever.iter_enrich_bonds_sales_history(bonds_iterator)
+
     @staticmethod
     def enrich_bonds_description(bonds_list):
-        result = []
+        return list(BondsMOEXDataRetriever.iter_enrich_bonds_description(bonds_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_enrich_bonds_description(bonds_list):
+        result_count = 0
         for bond in bonds_list:
             if "SECID" not in bond:
                 logging.error(f"While executing function 'enrich_bonds_description' can not find 'SECID' "
@@ -119,37 +597,50 @@ class BondsMOEXDataRetriever:
             if bond_description is None:
                 logging.error(f"Can not retrieve data about bond description for bond {str(bond)}")
                 continue
-            bond_enriched = dict(bond)
-            bond_enriched.update(bond_description)
-            result.append(bond_enriched)
+            bond.update(bond_description)
+            result_count += 1
+            yield bond
             logging.debug(f"Description was successfully enriched for bond {bond['SECID']}")
-        logging.info(f"Successfully enriched description for {str(len(result))} bonds")
-        return result
+        logging.info(f"Successfully enriched description for {str(result_count)} bonds")
 
     @staticmethod
-    def enrich_bonds_payments(bonds_list):
-        result = []
+    def enrich_bonds_payments(bonds_list, columnar=False):
+        return list(BondsMOEXDataRetriever.iter_enrich_bonds_payments(bonds_list, columnar))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_enrich_bonds_payments(bonds_list, columnar=False):
+        result_count = 0
         for bond in bonds_list:
             if "SECID" not in bond:
                 logging.error(f"While executing function 'enrich_bonds_payments' can not find 'SECID' "
                               f"for bond {str(bond)}")
                 continue
-            (amortizations_data, coupons_data, offers_data) = BondsMOEXDataRetriever.get_bond_payments(bond["SECID"])
+            (amortizations_data, coupons_data, offers_data) = BondsMOEXDataRetriever.get_bond_payments(bond["SECID"],
+                                                                                                       columnar)
             if amortizations_data is None or coupons_data is None or offers_data is None:
                 logging.error(f"Can not retrieve data about bond payments for bond {str(bond)}")
                 continue
-            bond_enriched = dict(bond)
-            bond_enriched["amortizations"] = amortizations_data
-            bond_enriched["coupons"] = coupons_data
-            bond_enriched["offers"] = offers_data
-            result.append(bond_enriched)
+            bond["amortizations"] = amortizations_data
+            bond["coupons"] = coupons_data
+            bond["offers"] = offers_data
+            result_count += 1
+            yield bond
             logging.debug(f"Payments were successfully enriched for bond {bond['SECID']}")
-        logging.info(f"Successfully enriched payments for {str(len(result))} bonds")
-        return result
+        logging.info(f"Successfully enriched payments for {str(result_count)} bonds")
 
     @staticmethod
-    def enrich_bonds_sales_history(bonds_list):
-        result = []
+    def enrich_bonds_sales_history(bonds_list, liquidity_store=None):
+        if liquidity_store is not None:
+            # Store requests history of all bonds by days instead of one request for every bond
+            liquidity_store.update()
+            return liquidity_store.enrich_bonds_sales_history(list(bonds_list))
+        return list(BondsMOEXDataRetriever.iter_enrich_bonds_sales_history(bonds_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_enrich_bonds_sales_history(bonds_list):
+        result_count = 0
         for bond in bonds_list:
             if "SECID" not in bond:
                 logging.error(f"While executing function 'enrich_bonds_sales_history' can not find 'SECID' "
@@ -159,173 +650,527 @@ class BondsMOEXDataRetriever:
             if bond_sales_history is None:
                 logging.error(f"Can not retrieve data about bond sales history for bond {str(bond)}")
                 continue
-            bond_enriched = dict(bond)
-            bond_enriched['sales_history'] = bond_sales_history
-            result.append(bond_enriched)
+            bond['sales_history'] = bond_sales_history
+            result_count += 1
+            yield bond
             logging.debug(f"Sales history was successfully enriched for bond {bond['SECID']}")
-        logging.info(f"Successfully enriched sales history for {str(len(result))} bonds")
-        return result
+        logging.info(f"Successfully enriched sales history for {str(result_count)} bonds")
 
     @staticmethod
-    def dump_results_to_file(bonds_list, filename, status):
+    @BondsMetrics.measure_stage
+    def dump_results_to_file(bonds_list, filename, status, pending_list=None):
         cached_object = {"data": bonds_list, "status": status}
-        fh = open(filename, 'w+')
-        fh.write(json.dumps(cached_object))
-        fh.close()
+        if pending_list:
+            # Listing of bonds which were filtered out before retrieving of other data
+            cached_object["pending"] = pending_list
+        # Readers should never see half-written file, so data is written to temporary file and renamed
+        temp_filename = f"{filename}.{str(os.getpid())}.tmp"
+        try:
+            with open(temp_filename, 'w') as fh:
+                fh.write(json.dumps(cached_object, default=BondsMOEXDataRetriever._convert_to_json))
+            os.replace(temp_filename, filename)
+        except BaseException:
+            BondsCSVWriter._remove_file(temp_filename)
+            raise
         logging.info(f"Data was successfully saved into '{filename}' file.")
 
     @staticmethod
+    @BondsMetrics.measure_stage
     def load_results_from_file(filename):
         fh = open(filename, 'r')
         bonds_list = json.loads(fh.read())
         fh.close()
         return bonds_list
 
+    @staticmethod
+    def load_snapshot(filename, include_pending=False):
+        cached_object = BondsMOEXDataRetriever.load_results_from_file(filename)
+        bonds_list = cached_object.get("data", [])
+        pending_list = cached_object.get("pending", [])
+        if cached_object.get("status") != "with_sales":
+            logging.warning(f"Snapshot '{filename}' is not fully retrieved, its status is "
+                            f"'{cached_object.get('status', 'list_only')}'")
+        if pending_list:
+            # Snapshot was retrieved with filter pushdown, so pending bonds have listing data only
+            if include_pending:
+                logging.info(f"{str(len(pending_list))} bonds of snapshot '{filename}' have listing data only")
+                bonds_list = bonds_list + pending_list
+            else:
+                logging.warning(f"Snapshot '{filename}' is partial, {str(len(pending_list))} bonds skipped by "
+                                f"listing filter are not used")
+        return bonds_list
+
     @staticmethod
     def _convert_data_to_dict(data, root_name):
         field_name_list = data[root_name]['columns']
-        result = []
-        for line in data[root_name]["data"]:
-            current_dict = {}
-            for i in range(len(field_name_list)):
-                current_dict[field_name_list[i]] = line[i]
-            result.append(current_dict)
-        return result
+        return [dict(zip(field_name_list, line)) for line in data[root_name]["data"]]
+
+    @staticmethod
+    def _convert_to_json(value):
+        if isinstance(value, BondsISSColumns):
+            return value.to_list()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
     @staticmethod
     def _url_request(request_url, timeout=60, attempt_count=3, sleep_sec=60):
         logging.debug(f"Request url: {request_url}")
         for i in range(attempt_count):
+            if i > 0:
+                # There is no sleep after the last failed attempt, so every sleep is counted as retry
+                BondsMetrics.record_retry(sleep_sec)
+                logging.warning(f"Sleep for {str(sleep_sec)} seconds before make a new try.")
+                time.sleep(sleep_sec)
+            start_time = time.perf_counter()
             try:
                 content = urllib.request.urlopen(request_url, timeout=timeout).read()
+                BondsMetrics.record_request(time.perf_counter() - start_time, len(content))
                 return json.loads(content)
             except urllib.error.URLError:
+                BondsMetrics.record_request(time.perf_counter() - start_time, is_failed=True)
                 logging.warning(f"Failed to retrieve data for url '{request_url}'", exc_info=True)
-                logging.warning("Sleep for 60 seconds before make a new try.")
-                time.sleep(sleep_sec)
 
+    # Columns which are requested for payment schedules in '_get_bond_payments_url'
+    _payments_columns = {"amortizations": ("amortdate", "faceunit", "value"),
+                         "coupons": ("coupondate", "faceunit", "value"),
+                         "offers": ("offerdate", "offertype")}
 
-class BondsMOEXFilter:
-    @staticmethod
-    def filter_bonds_advanced(bonds_list, filter_description_dict):
-        # Get all filtering options from filter_description_dict
-        max_bond_value = filter_description_dict.get('max_bond_value', None)
-        min_bond_value = filter_description_dict.get('min_bond_value', None)
-        max_expiration_date = filter_description_dict.get('max_expiration_date', None)
-        min_expiration_date = filter_description_dict.get('min_expiration_date', datetime.today() + timedelta(days=1))
-        is_offert_interesting = filter_description_dict.get('is_offert_interesting', True)
-        is_amortization_interesting = filter_description_dict.get('is_amortization_interesting', True)
-        is_qualified = filter_description_dict.get('is_qualified', False)
-        is_noliquid_interesting = filter_description_dict.get('is_noliquid_interesting', False)
-        is_infinity_interesting = filter_description_dict.get('is_infinity_interesting', False)
-        max_offert_date = filter_description_dict.get('max_offert_date', max_expiration_date)
-        min_offert_date = filter_description_dict.get('min_offert_date', min_expiration_date)
-        sales_threshold_amount = filter_description_dict.get('sales_threshold_amount', 50)
-        sales_threshold_deal = filter_description_dict.get('sales_threshold_deal', 10)
 
+class BondsMOEXAsyncRetriever:
+    def __init__(self, max_concurrency=8, timeout=60, attempt_count=3, sleep_sec=60, executor=None):
+        # There is no async HTTP client in standard library, so blocking requests are run in executor threads
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.attempt_count = attempt_count
+        self.sleep_sec = sleep_sec
+        self._is_own_executor = executor is None
+        if executor is None:
+            # Timed out request can not be interrupted, so count of threads limits real count of requests
+            executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="moex_request")
+        self.executor = executor
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def close(self):
+        if self._is_own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def get_bonds_info(self, bonds_group_list=(7, 58)):
+        results = await asyncio.gather(*[self._url_request(BondsMOEXDataRetriever._get_bonds_info_url(bonds_group))
+                                         for bonds_group in bonds_group_list])
         result = []
-        for bond in bonds_list:
-            try:
-                # Getting all important values for bond
-                prev_price = bond.get('PREVPRICE', None)
-                is_for_qualified = int(bond["ISQUALIFIEDINVESTORS"])
-                bond_value = int(bond["FACEVALUE"])
-                expiration_date = bond["MATDATE"]
-                offer_date = bond["OFFERDATE"]
-                amortizations = bond["amortizations"]
-                sales_history = bond["sales_history"]
-                total_sales_volume = 0
-                total_sales_deals = 0
-                for day in sales_history:
-                    total_sales_volume += day['VOLUME']
-                    total_sales_deals += day['NUMTRADES']
-
-                # Filtering by unknown last price
-                if prev_price is None:
-                    continue
-                # Filtering by qualification
-                if (not is_qualified) and (is_for_qualified == 1):
-                    continue
-                # Filtering by sales amount recently
-                if (not is_noliquid_interesting) and \
-                        (total_sales_volume <= sales_threshold_amount or total_sales_deals <= sales_threshold_deal):
-                    continue
-                # Filtering by bond value
-                if (max_bond_value is not None) and (bond_value > max_bond_value):
-                    continue
-                if (min_bond_value is not None) and (bond_value < min_bond_value):
-                    continue
-                # Filtering by amortization
-                if (not is_amortization_interesting) and (len(amortizations) > 1):
-                    continue
-                if (offer_date is not None):
-                    # Filtering by offer
-                    if (not is_offert_interesting):
+        for data in results:
+            if data is None:
+                raise ConnectionError("Can not retrieve list of bonds")
+            result.extend(BondsMOEXDataRetriever._convert_data_to_dict(data, "securities"))
+        logging.info(f"Found {str(len(result))} bonds")
+        return result
+
+    async def get_bond_description(self, sec_id):
+        data = await self._url_request(BondsMOEXDataRetriever._get_bond_description_url(sec_id))
+        return None if data is None else BondsMOEXDataRetriever._parse_bond_description(data)
+
+    async def get_bond_payments(self, sec_id, columnar=False):
+        data = await self._url_request(BondsMOEXDataRetriever._get_bond_payments_url(sec_id))
+        if data is None:
+            return None, None, None
+        return BondsMOEXDataRetriever._parse_bond_payments(data, columnar)
+
+    async def get_bonds_sales_history(self, sec_id, days_delta=15):
+        data = await self._url_request(BondsMOEXDataRetriever._get_bonds_sales_history_url(sec_id, days_delta))
+        return None if data is None else BondsMOEXDataRetriever._convert_data_to_dict(data, "history")
+
+    async def enrich_bond(self, bond, columnar=False):
+        if "SECID" not in bond:
+            logging.error(f"While enriching bond can not find 'SECID' for bond {str(bond)}")
+            return
+        sec_id = bond["SECID"]
+        (bond_description, payments, sales_history) = await asyncio.gather(
+            self.get_bond_description(sec_id), self.get_bond_payments(sec_id, columnar),
+            self.get_bonds_sales_history(sec_id))
+        if bond_description is None or None in payments or sales_history is None:
+            logging.error(f"Can not retrieve full data for bond {str(bond)}")
+            return
+        bond.update(bond_description)
+        (bond["amortizations"], bond["coupons"], bond["offers"]) = payments
+        bond["sales_history"] = sales_history
+        return bond
+
+    async def enrich_bonds_description(self, bonds_list):
+        return await self._enrich_bonds(bonds_list, self._enrich_description, "description")
+
+    async def enrich_bonds_payments(self, bonds_list, columnar=False):
+        return await self._enrich_bonds(bonds_list, lambda bond: self._enrich_payments(bond, columnar), "payments")
+
+    async def enrich_bonds_sales_history(self, bonds_list):
+        return await self._enrich_bonds(bonds_list, self._enrich_sales_history, "sales history")
+
+    async def iter_retrieve(self, bonds_group_list=(7, 58), columnar=False):
+        bonds_list = await self.get_bonds_info(bonds_group_list)
+        async for bond in self.iter_enrich_bonds(bonds_list, columnar):
+            yield bond
+
+    async def iter_enrich_bonds(self, bonds_list, columnar=False):
+        # Only limited count of bonds is enriched at the same time, so consumer gets first bonds quickly
+        bonds_iterator = iter(bonds_list)
+        pending_tasks = set()
+        try:
+            while True:
+                while len(pending_tasks) < self.max_concurrency * 2:
+                    bond = next(bonds_iterator, None)
+                    if bond is None:
+                        break
+                    pending_tasks.add(asyncio.ensure_future(self.enrich_bond(bond, columnar)))
+                if not pending_tasks:
+                    return
+                (done_tasks, pending_tasks) = await asyncio.wait(pending_tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done_tasks:
+                    try:
+                        bond = task.result()
+                    except Exception:
+                        # Malformed response of one bond should not stop enriching of other bonds
+                        logging.error("Can not enrich bond", exc_info=True)
                         continue
-                    else:
-                        # Filter by offer date
-                        offer_date = datetime.strptime(offer_date, '%Y-%m-%d')
-                        if (max_offert_date is not None) and (offer_date > max_offert_date):
-                            continue
-                        if (min_offert_date is not None) and (offer_date < min_offert_date):
-                            continue
-                else:
-                    # Filter by expiration date
-                    if not is_infinity_interesting:
-                        if expiration_date == "0000-00-00" or expiration_date is None:
-                            continue
-                        expiration_date = datetime.strptime(expiration_date, '%Y-%m-%d')
-                        if (max_expiration_date is not None) and (expiration_date > max_expiration_date):
-                            continue
-                        if (min_expiration_date is not None) and (expiration_date < min_expiration_date):
-                            continue
+                    if bond is not None:
+                        yield bond
+        finally:
+            for task in pending_tasks:
+                task.cancel()
+            if pending_tasks:
+                await asyncio.gather(*pending_tasks, return_exceptions=True)
 
+    async def _enrich_bonds(self, bonds_list, enrich_function, data_name):
+        bonds_list = [bond for bond in bonds_list if "SECID" in bond]
+        results = await asyncio.gather(*[enrich_function(bond) for bond in bonds_list], return_exceptions=True)
+        result = []
+        for (bond, is_enriched) in zip(bonds_list, results):
+            if isinstance(is_enriched, asyncio.CancelledError):
+                raise is_enriched
+            if isinstance(is_enriched, Exception):
+                # Malformed response of one bond should not stop enriching of other bonds
+                logging.error(f"Can not enrich {data_name} for bond {str(bond)}", exc_info=is_enriched)
+                continue
+            if is_enriched:
                 result.append(bond)
+        logging.info(f"Successfully enriched {data_name} for {str(len(result))} bonds")
+        return result
+
+    async def _enrich_description(self, bond):
+        bond_description = await self.get_bond_description(bond["SECID"])
+        if bond_description is None:
+            logging.error(f"Can not retrieve data about bond description for bond {str(bond)}")
+            return False
+        bond.update(bond_description)
+        return True
+
+    async def _enrich_payments(self, bond, columnar):
+        payments = await self.get_bond_payments(bond["SECID"], columnar)
+        if None in payments:
+            logging.error(f"Can not retrieve data about bond payments for bond {str(bond)}")
+            return False
+        (bond["amortizations"], bond["coupons"], bond["offers"]) = payments
+        return True
+
+    async def _enrich_sales_history(self, bond):
+        sales_history = await self.get_bonds_sales_history(bond["SECID"])
+        if sales_history is None:
+            logging.error(f"Can not retrieve data about bond sales history for bond {str(bond)}")
+            return False
+        bond["sales_history"] = sales_history
+        return True
+
+    async def _url_request(self, request_url):
+        logging.debug(f"Request url: {request_url}")
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            # Semaphore can be used only in one event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        for i in range(self.attempt_count):
+            if i > 0:
+                BondsMetrics.record_retry(self.sleep_sec)
+                logging.warning(f"Sleep for {str(self.sleep_sec)} seconds before make a new try.")
+                await asyncio.sleep(self.sleep_sec)
+            # Semaphore is not held during sleep, so other requests are not blocked by failed one
+            semaphore = self._semaphore
+            await semaphore.acquire()
+            try:
+                future = loop.run_in_executor(self.executor, BondsMOEXAsyncRetriever._read_url, request_url,
+                                              self.timeout)
+            except BaseException:
+                semaphore.release()
+                raise
+            # Thread of timed out or cancelled request is still busy, so semaphore is released when thread finishes
+            future.add_done_callback(functools.partial(BondsMOEXAsyncRetriever._on_request_done, semaphore))
+            start_time = time.perf_counter()
+            try:
+                content = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                BondsMetrics.record_request(time.perf_counter() - start_time, len(content))
+                return json.loads(content)
+            except (urllib.error.URLError, asyncio.TimeoutError):
+                BondsMetrics.record_request(time.perf_counter() - start_time, is_failed=True)
+                logging.warning(f"Failed to retrieve data for url '{request_url}'", exc_info=True)
+
+    @staticmethod
+    def _on_request_done(semaphore, future):
+        semaphore.release()
+        if not future.cancelled():
+            # Error of abandoned request should not be reported as never retrieved
+            future.exception()
+
+    @staticmethod
+    def _read_url(request_url, timeout):
+        return urllib.request.urlopen(request_url, timeout=timeout).read()
+
+
+class BondsMOEXQuoteRefresher:
+    def __init__(self, bonds_list, commission_ratio=None, bonds_group_list=(7, 58)):
+        self.bonds_group_list = bonds_group_list
+        self.commission_ratio = commission_ratio
+        self.universe = {}
+        for bond in bonds_list:
+            if "SECID" not in bond:
+                logging.error(f"While creating quote refresher can not find 'SECID' for bond {str(bond)}")
+                continue
+            self.universe[bond["SECID"]] = bond
+        self._stop_event = threading.Event()
+
+    def refresh(self):
+        changed_bonds = []
+        for bonds_group in self.bonds_group_list:
+            request_url = "https://iss.moex.com/iss/engines/stock/markets/bonds/boardgroups/" + str(bonds_group) + \
+                          "/securities.json?iss.meta=off&iss.only=securities,marketdata" \
+                          "&securities.columns=SECID,ACCRUEDINT&marketdata.columns=SECID," + \
+                          ",".join(BondsMOEXQuoteRefresher.quote_fields)
+            data = BondsMOEXDataRetriever._url_request(request_url)
+            if data is None:
+                logging.error(f"Can not retrieve quotes for bonds group {str(bonds_group)}")
+                continue
+            changed_bonds.extend(self.apply_quotes(data))
+        if self.commission_ratio is not None:
+            self.recalculate_profit(changed_bonds)
+        logging.info(f"Quotes were changed for {str(len(changed_bonds))} bonds")
+        return changed_bonds
+
+    def apply_quotes(self, data):
+        accrued_interest = {}
+        for line in data["securities"]["data"]:
+            accrued_interest[line[0]] = line[1]
+        changed_bonds = []
+        for quote in BondsMOEXDataRetriever._convert_data_to_dict(data, "marketdata"):
+            bond = self.universe.get(quote["SECID"])
+            if bond is None:
+                continue
+            quote["ACCRUEDINT"] = accrued_interest.get(quote["SECID"], bond.get("ACCRUEDINT"))
+            del quote["SECID"]
+            is_changed = False
+            for key in quote:
+                if bond.get(key) != quote[key]:
+                    bond[key] = quote[key]
+                    is_changed = True
+            if is_changed:
+                changed_bonds.append(bond)
+        return changed_bonds
+
+    def recalculate_profit(self, bonds_list):
+        for bond in bonds_list:
+            # Bond can be bought by best offer price, last deal price is used if there is no offers
+            current_price = bond.get("OFFER") or bond.get("LAST") or bond.get("PREVPRICE")
+            if current_price is None:
+                continue
+            current_bond = dict(bond)
+            current_bond["PREVPRICE"] = current_price
+            BondsCustomCalculationAndFilter.calculate_bonds_profit([current_bond], self.commission_ratio)
+            for key in ('year_profit_ratio', 'profit_type', 'coupon_type'):
+                if key in current_bond:
+                    bond[key] = current_bond[key]
+
+    def run(self, interval_sec=60, iterations=None, callback=None):
+        self._stop_event.clear()
+        iteration = 0
+        while not self._stop_event.is_set() and (iterations is None or iteration < iterations):
+            start_time = time.monotonic()
+            changed_bonds = self.refresh()
+            if callback is not None and len(changed_bonds) > 0:
+                callback(changed_bonds)
+            iteration += 1
+            if iterations is not None and iteration >= iterations:
+                break
+            self._stop_event.wait(max(0.0, interval_sec - (time.monotonic() - start_time)))
+
+    def stop(self):
+        self._stop_event.set()
+
+    quote_fields = ("LAST", "BID", "OFFER")
+    # All fields which are updated in place by refresher
+    market_fields = ("ACCRUEDINT",) + quote_fields
+
+
+class BondsMOEXFilter:
+    @staticmethod
+    def filter_bonds_advanced(bonds_list, filter_description_dict, as_of_date=None):
+        return list(BondsMOEXFilter.iter_filter_bonds_advanced(bonds_list, filter_description_dict, as_of_date))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_advanced(bonds_list, filter_description_dict, as_of_date=None):
+        filter_settings = BondsMOEXFilter.get_advanced_filter_settings(filter_description_dict, as_of_date)
+        result_count = 0
+        for bond in bonds_list:
+            try:
+                if BondsMOEXFilter.check_bond_advanced(bond, filter_settings):
+                    result_count += 1
+                    yield bond
             except KeyError:
                 logging.error("Can not find important key for bond " + str(bond), exc_info=True)
             except ValueError:
                 logging.error("Bad time format for bond's expiration or offer date. Bond is: " + str(bond),
                               exc_info=True)
-        logging.info("After advanced filtering based on configuration " + str(len(result)) + " bonds left")
-        return result
+        logging.info("After advanced filtering based on configuration " + str(result_count) + " bonds left")
+
+    @staticmethod
+    def get_advanced_filter_settings(filter_description_dict, as_of_date=None):
+        if as_of_date is None:
+            as_of_date = datetime.today()
+        # Get all filtering options from filter_description_dict
+        settings = {
+            'max_bond_value': filter_description_dict.get('max_bond_value', None),
+            'min_bond_value': filter_description_dict.get('min_bond_value', None),
+            'max_expiration_date': filter_description_dict.get('max_expiration_date', None),
+            'min_expiration_date': filter_description_dict.get('min_expiration_date',
+                                                               as_of_date + timedelta(days=1)),
+            'is_offert_interesting': filter_description_dict.get('is_offert_interesting', True),
+            'is_amortization_interesting': filter_description_dict.get('is_amortization_interesting', True),
+            'is_qualified': filter_description_dict.get('is_qualified', False),
+            'is_noliquid_interesting': filter_description_dict.get('is_noliquid_interesting', False),
+            'is_infinity_interesting': filter_description_dict.get('is_infinity_interesting', False),
+            'sales_threshold_amount': filter_description_dict.get('sales_threshold_amount', 50),
+            'sales_threshold_deal': filter_description_dict.get('sales_threshold_deal', 10),
+        }
+        settings['max_offert_date'] = filter_description_dict.get('max_offert_date', settings['max_expiration_date'])
+        settings['min_offert_date'] = filter_description_dict.get('min_offert_date', settings['min_expiration_date'])
+        return settings
+
+    @staticmethod
+    def check_bond_advanced(bond, filter_settings):
+        # Getting all important values for bond
+        prev_price = bond.get('PREVPRICE', None)
+        is_for_qualified = int(bond["ISQUALIFIEDINVESTORS"])
+        amortizations = bond["amortizations"]
+        sales_history = bond["sales_history"]
+        total_sales_volume = 0
+        total_sales_deals = 0
+        for day in sales_history:
+            total_sales_volume += day['VOLUME']
+            total_sales_deals += day['NUMTRADES']
+
+        # Filtering by unknown last price
+        if prev_price is None:
+            return False
+        # Filtering by qualification
+        if (not filter_settings['is_qualified']) and (is_for_qualified == 1):
+            return False
+        # Filtering by sales amount recently
+        if (not filter_settings['is_noliquid_interesting']) and \
+                (total_sales_volume <= filter_settings['sales_threshold_amount'] or
+                 total_sales_deals <= filter_settings['sales_threshold_deal']):
+            return False
+        # Filtering by amortization
+        if (not filter_settings['is_amortization_interesting']) and (len(amortizations) > 1):
+            return False
+        return BondsMOEXFilter.check_bond_listing(bond, filter_settings)
+
+    @staticmethod
+    def check_bond_listing(bond, filter_settings):
+        # Only fields from list of bonds are used, so check is possible before retrieving of other data
+        if bond.get('PREVPRICE', None) is None:
+            return False
+        bond_value = int(bond["FACEVALUE"])
+        expiration_date = bond["MATDATE"]
+        offer_date = bond["OFFERDATE"]
+        # Filtering by bond value
+        max_bond_value = filter_settings['max_bond_value']
+        min_bond_value = filter_settings['min_bond_value']
+        if (max_bond_value is not None) and (bond_value > max_bond_value):
+            return False
+        if (min_bond_value is not None) and (bond_value < min_bond_value):
+            return False
+        if (offer_date is not None):
+            # Filtering by offer
+            if (not filter_settings['is_offert_interesting']):
+                return False
+            # Filter by offer date
+            offer_date = datetime.strptime(offer_date, '%Y-%m-%d')
+            max_offert_date = filter_settings['max_offert_date']
+            min_offert_date = filter_settings['min_offert_date']
+            if (max_offert_date is not None) and (offer_date > max_offert_date):
+                return False
+            if (min_offert_date is not None) and (offer_date < min_offert_date):
+                return False
+        else:
+            # Filter by expiration date
+            if not filter_settings['is_infinity_interesting']:
+                if expiration_date == "0000-00-00" or expiration_date is None:
+                    return False
+                expiration_date = datetime.strptime(expiration_date, '%Y-%m-%d')
+                max_expiration_date = filter_settings['max_expiration_date']
+                min_expiration_date = filter_settings['min_expiration_date']
+                if (max_expiration_date is not None) and (expiration_date > max_expiration_date):
+                    return False
+                if (min_expiration_date is not None) and (expiration_date < min_expiration_date):
+                    return False
+        return True
 
     @staticmethod
     def filter_bonds_by_expiration_date(bonds_list, upper_bound, bottom_bound=None,
                                         filter_infinity=True, use_offer_date=False):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_expiration_date(bonds_list, upper_bound, bottom_bound,
+                                                                         filter_infinity, use_offer_date))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_expiration_date(bonds_list, upper_bound, bottom_bound=None,
+                                             filter_infinity=True, use_offer_date=False):
+        result_count = 0
         for bond in bonds_list:
             try:
                 if not use_offer_date:
                     if bond["OFFERDATE"] is not None:
-                        result.append(bond)
+                        result_count += 1
+                        yield bond
                         continue
                     expiration_date = bond["MATDATE"]
                 else:
                     expiration_date = bond["OFFERDATE"]
                 if expiration_date == "0000-00-00" or expiration_date is None:
                     if not filter_infinity:
-                        result.append(bond)
+                        result_count += 1
+                        yield bond
                     continue
                 expiration_date = datetime.strptime(expiration_date, '%Y-%m-%d')
                 if expiration_date > upper_bound:
                     continue
                 if (bottom_bound is not None) and (expiration_date < bottom_bound):
                     continue
-                result.append(bond)
+                result_count += 1
+                yield bond
             except KeyError:
                 logging.error("Can not find expiration or offer date for bond " + str(bond), exc_info=True)
             except ValueError:
                 logging.error("Bad time format for bond's expiration or offer date. Bond is: " + str(bond),
                               exc_info=True)
         if not use_offer_date:
-            logging.info("After filtering by expiration date " + str(len(result)) + " bonds left")
+            logging.info("After filtering by expiration date " + str(result_count) + " bonds left")
         else:
-            logging.info("After filtering by offer date " + str(len(result)) + " bonds left")
-        return result
+            logging.info("After filtering by offer date " + str(result_count) + " bonds left")
 
     @staticmethod
     def filter_bonds_by_value(bonds_list, upper_bound, bottom_bound=None):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_value(bonds_list, upper_bound, bottom_bound))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_value(bonds_list, upper_bound, bottom_bound=None):
+        result_count = 0
         for bond in bonds_list:
             try:
                 value = int(bond["FACEVALUE"])
@@ -333,86 +1178,128 @@ class BondsMOEXFilter:
                     continue
                 if (bottom_bound is not None) and (value < bottom_bound):
                     continue
-                result.append(bond)
+                result_count += 1
+                yield bond
             except KeyError:
                 logging.error("Can not find 'FACEVALUE' for bond " + str(bond), exc_info=True)
-        logging.info("After filtering by value " + str(len(result)) + " bonds left")
-        return result
+        logging.info("After filtering by value " + str(result_count) + " bonds left")
 
     @staticmethod
     def filter_bonds_by_qualification(bonds_list):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_qualification(bonds_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_qualification(bonds_list):
+        result_count = 0
         for bond in bonds_list:
             try:
                 value = int(bond["ISQUALIFIEDINVESTORS"])
                 if value == 1:
                     continue
-                result.append(bond)
+                result_count += 1
+                yield bond
             except KeyError:
                 logging.error("Can not find 'ISQUALIFIEDINVESTORS' for bond " + str(bond), exc_info=True)
-        logging.info("After filtering by qualification " + str(len(result)) + " bonds left")
-        return result
+        logging.info("After filtering by qualification " + str(result_count) + " bonds left")
 
     @staticmethod
-    def filter_bonds_by_amortization(bonds_list):
-        result = []
+    def filter_bonds_by_amortization(bonds_list, as_of_date=None):
+        return list(BondsMOEXFilter.iter_filter_bonds_by_amortization(bonds_list, as_of_date))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_amortization(bonds_list, as_of_date=None):
+        result_count = 0
         for bond in bonds_list:
-            is_not_amortization = BondsMOEXFilter.check_not_amortization(bond)
+            is_not_amortization = BondsMOEXFilter.check_not_amortization(bond, as_of_date=as_of_date)
             if is_not_amortization:
-                result.append(bond)
-        logging.info("After filtering by amortization " + str(len(result)) + " bonds left")
-        return result
+                result_count += 1
+                yield bond
+        logging.info("After filtering by amortization " + str(result_count) + " bonds left")
 
     @staticmethod
     def filter_bonds_by_offer(bonds_list):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_offer(bonds_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_offer(bonds_list):
+        result_count = 0
         for bond in bonds_list:
             is_not_offer = BondsMOEXFilter.check_not_offer(bond)
             if is_not_offer:
-                result.append(bond)
-        logging.info("After filtering by offer " + str(len(result)) + " bonds left")
-        return result
+                result_count += 1
+                yield bond
+        logging.info("After filtering by offer " + str(result_count) + " bonds left")
 
     @staticmethod
     def filter_bonds_by_null_price(bonds_list):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_null_price(bonds_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_null_price(bonds_list):
+        result_count = 0
         for bond in bonds_list:
             prev_price = bond.get('PREVPRICE', None)
             if prev_price is not None:
-                result.append(bond)
-        logging.info("After filtering by unknown last price " + str(len(result)) + " bonds left")
-        return result
+                result_count += 1
+                yield bond
+        logging.info("After filtering by unknown last price " + str(result_count) + " bonds left")
 
     @staticmethod
-    def filter_bonds_without_sales(bonds_list, threshold_deal=10, threshold_amount=50):
-        result = []
+    def filter_bonds_without_sales(bonds_list, threshold_deal=10, threshold_amount=50, liquidity_store=None,
+                                   window_days=15, as_of_date=None):
+        return list(BondsMOEXFilter.iter_filter_bonds_without_sales(bonds_list, threshold_deal, threshold_amount,
+                                                                    liquidity_store, window_days, as_of_date))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_without_sales(bonds_list, threshold_deal=10, threshold_amount=50, liquidity_store=None,
+                                        window_days=15, as_of_date=None):
+        result_count = 0
         for bond in bonds_list:
-            try:
-                sales_history = bond["sales_history"]
-                total_volume = 0
-                total_deals = 0
-                for day in sales_history:
-                    total_volume += day['VOLUME']
-                    total_deals += day['NUMTRADES']
-                if total_volume > threshold_amount and total_deals > threshold_deal:
-                    result.append(bond)
-            except KeyError:
-                logging.error("Can not find 'sales_history' for bond " + str(bond), exc_info=True)
-        logging.info("After filtering by no sales recently " + str(len(result)) + " bonds left")
-        return result
+            if liquidity_store is None:
+                is_liquid = BondsMOEXFilter.check_sales(bond, threshold_deal, threshold_amount)
+            else:
+                is_liquid = liquidity_store.check_sales(bond, threshold_deal, threshold_amount, window_days,
+                                                        as_of_date)
+            if is_liquid:
+                result_count += 1
+                yield bond
+        logging.info("After filtering by no sales recently " + str(result_count) + " bonds left")
+
+    @staticmethod
+    def check_sales(bond, threshold_deal=10, threshold_amount=50):
+        try:
+            sales_history = bond["sales_history"]
+            total_volume = 0
+            total_deals = 0
+            for day in sales_history:
+                total_volume += day['VOLUME']
+                total_deals += day['NUMTRADES']
+            return total_volume > threshold_amount and total_deals > threshold_deal
+        except KeyError:
+            logging.error("Can not find 'sales_history' for bond " + str(bond), exc_info=True)
 
     @staticmethod
     def filter_bonds_by_isin_blacklist(bonds_list, black_list):
-        result = []
+        return list(BondsMOEXFilter.iter_filter_bonds_by_isin_blacklist(bonds_list, black_list))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_isin_blacklist(bonds_list, black_list):
+        result_count = 0
         for bond in bonds_list:
             try:
                 isin = bond["ISIN"]
                 if isin not in black_list:
-                    result.append(bond)
+                    result_count += 1
+                    yield bond
             except KeyError:
                 logging.error("Can not find 'ISIN' for bond " + str(bond), exc_info=True)
-        logging.info("After filtering by isin black list " + str(len(result)) + " bonds left")
-        return result
+        logging.info("After filtering by isin black list " + str(result_count) + " bonds left")
 
     @staticmethod
     def check_specific_bond_existence(bonds_list, isin):
@@ -440,7 +1327,7 @@ class BondsMOEXFilter:
         return bond["OFFERDATE"] is None
 
     @staticmethod
-    def check_not_amortization(bond, ignore_last_step=True):
+    def check_not_amortization(bond, ignore_last_step=True, as_of_date=None):
         if "amortizations" not in bond:
             logging.error(f"While executing function 'check_not_amortization' can not find 'amortizations' "
                           f"for bond {str(bond)}")
@@ -450,7 +1337,7 @@ class BondsMOEXFilter:
             return True
         if not ignore_last_step:
             return False
-        today = datetime.today()
+        today = datetime.today() if as_of_date is None else as_of_date
         future_payments_count = 0
         for payment in amortizations:
             amort_date = BondsMOEXFilter._safe_get_time(payment, 'amortdate')
@@ -476,12 +1363,22 @@ class BondsMOEXFilter:
 
 class BondsCustomCalculationAndFilter:
     @staticmethod
-    def calculate_bonds_profit(bonds_list, commission_ratio):
-        today = datetime.today() + timedelta(days=1)
+    def calculate_bonds_profit(bonds_list, commission_ratio, as_of_date=None):
+        for _ in BondsCustomCalculationAndFilter.iter_calculate_bonds_profit(bonds_list, commission_ratio, as_of_date):
+            pass
+        return
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_calculate_bonds_profit(bonds_list, commission_ratio, as_of_date=None):
+        if as_of_date is None:
+            as_of_date = datetime.today()
+        today = as_of_date + timedelta(days=1)
         for bond in bonds_list:
             is_not_offer = BondsMOEXFilter.check_not_offer(bond)
-            is_not_amortization = BondsMOEXFilter.check_not_amortization(bond)
+            is_not_amortization = BondsMOEXFilter.check_not_amortization(bond, as_of_date=as_of_date)
             if is_not_offer is None or is_not_amortization is None:
+                yield bond
                 continue
             if is_not_offer and is_not_amortization:
                 profit_type = "simple"
@@ -493,17 +1390,17 @@ class BondsCustomCalculationAndFilter:
                     calculate_bond_profit_amortization(bond, commission_ratio, today)
             else:
                 (bond_profit, profit_type, coupon_type) = BondsCustomCalculationAndFilter.\
-                    calculate_bond_profit(bond, commission_ratio)
+                    calculate_bond_profit(bond, commission_ratio, as_of_date)
             bond['year_profit_ratio'] = bond_profit
             bond['profit_type'] = profit_type
             bond['coupon_type'] = coupon_type
-        return
+            yield bond
 
     @staticmethod
-    def calculate_bond_profit(bond, commission_ratio):
+    def calculate_bond_profit(bond, commission_ratio, as_of_date=None):
         logging.debug("Starting to calculate profit for bond" + str(bond))
         tax_ratio = 0.13
-        today = datetime.today()
+        today = datetime.today() if as_of_date is None else as_of_date
         profit_type = "simple"
         coupon_type = "predefined"
         try:
@@ -551,6 +1448,9 @@ class BondsCustomCalculationAndFilter:
             if this_day_amortization == 0:
                 continue
             if len(this_day_amortization) > 0:
+                if full_price <= 0:
+                    # Face value was already fully paid by amortizations before this date
+                    break
                 current_duration = day_number - last_amortization_day_number
                 clear_coupons_sum = coupons_sum * (1 - tax_ratio)
                 clear_income = clear_coupons_sum + close_price
@@ -628,68 +1528,103 @@ class BondsCustomCalculationAndFilter:
 
     @staticmethod
     def enrich_bonds_emitter_from_db(bonds_list, local_db_name='emitters.db'):
+        return list(BondsCustomCalculationAndFilter.iter_enrich_bonds_emitter_from_db(bonds_list, local_db_name))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_enrich_bonds_emitter_from_db(bonds_list, local_db_name='emitters.db'):
         if not os.path.isfile(local_db_name):
             logging.warning("Local database with name '" + local_db_name + "' is not found. Can not enrich emitters")
-            return bonds_list
+            yield from bonds_list
+            return
         connection = sqlite3.connect(local_db_name)
         cursor = connection.cursor()
-        result = []
-        for bond in bonds_list:
-            try:
-                emitter_id = bond["EMITTER_ID"]
-                sql_query = "SELECT name, risk FROM emitters WHERE id='{0}'".format(emitter_id)
-                logging.debug("SQL query for emitter enrichment is " + sql_query)
-                for row in cursor.execute(sql_query):
-                    bond["EMITTER_ID"] = row[0]
-                    bond["emitter_risk"] = row[1]
-                result.append(bond)
-            except KeyError:
-                logging.error("Can not find 'EMITTER_ID' for bond " + str(bond), exc_info=True)
-        connection.close()
-        logging.info("Successfully enriched emitter name for " + str(len(result)) + " bonds")
-        return result
+        result_count = 0
+        try:
+            for bond in bonds_list:
+                try:
+                    # Original id is kept, because 'EMITTER_ID' is replaced with emitter name
+                    emitter_id = bond.get("emitter_id", bond["EMITTER_ID"])
+                    logging.debug(f"Looking for emitter with id '{emitter_id}' in local database")
+                    for row in cursor.execute("SELECT name, risk FROM emitters WHERE id=?", (emitter_id,)).fetchall():
+                        bond["emitter_id"] = emitter_id
+                        bond["EMITTER_ID"] = row[0]
+                        bond["emitter_risk"] = row[1]
+                except KeyError:
+                    logging.error("Can not find 'EMITTER_ID' for bond " + str(bond), exc_info=True)
+                    continue
+                result_count += 1
+                yield bond
+        finally:
+            connection.close()
+        logging.info("Successfully enriched emitter name for " + str(result_count) + " bonds")
 
     @staticmethod
     def enrich_bonds_emitter_from_dict(bonds_list, emitters_dict):
-        result = []
+        return list(BondsCustomCalculationAndFilter.iter_enrich_bonds_emitter_from_dict(bonds_list, emitters_dict))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_enrich_bonds_emitter_from_dict(bonds_list, emitters_dict):
+        result_count = 0
         for bond in bonds_list:
             try:
-                emitter_id = bond["EMITTER_ID"]
+                emitter_id = bond.get("emitter_id", bond["EMITTER_ID"])
                 if emitter_id in emitters_dict:
+                    bond["emitter_id"] = emitter_id
                     bond["EMITTER_ID"] = emitters_dict[emitter_id]['name']
                     bond["emitter_risk"] = emitters_dict[emitter_id]['risk']
-                result.append(bond)
+                result_count += 1
+                yield bond
             except KeyError:
                 logging.error("Can not find 'EMITTER_ID' for bond " + str(bond), exc_info=True)
-        logging.info("Successfully enriched emitter name for " + str(len(result)) + " bonds")
-        return result
-
+        logging.info("Successfully enriched emitter name for " + str(result_count) + " bonds")
 
     @staticmethod
     def filter_bonds_by_profit_ratio(bonds_list, bottom_bound, upper_bound=None):
-        result = []
+        return list(BondsCustomCalculationAndFilter.iter_filter_bonds_by_profit_ratio(bonds_list, bottom_bound,
+                                                                                      upper_bound))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_profit_ratio(bonds_list, bottom_bound, upper_bound=None):
+        result_count = 0
         for bond in bonds_list:
             try:
                 profit_ratio = bond["year_profit_ratio"]
-                if profit_ratio < bottom_bound:
+                # Profit can not be calculated for bonds which are redeemed at the date of calculation
+                if profit_ratio is None or profit_ratio < bottom_bound:
                     continue
                 if (upper_bound is not None) and (profit_ratio < upper_bound):
                     continue
-                result.append(bond)
+                result_count += 1
+                yield bond
             except KeyError:
                 logging.error("Can not find 'year_profit_ratio' for bond " + str(bond), exc_info=True)
-        logging.info("After filtering by profit ratio " + str(len(result)) + " bonds left")
-        return result
+        logging.info("After filtering by profit ratio " + str(result_count) + " bonds left")
 
     @staticmethod
-    def filter_bonds_by_emitter(bonds_list, risk_black_list=('exclude')):
-        result = []
+    def filter_bonds_by_emitter(bonds_list, risk_black_list=('exclude',), local_db_name=None):
+        return list(BondsCustomCalculationAndFilter.iter_filter_bonds_by_emitter(bonds_list, risk_black_list,
+                                                                                 local_db_name))
+
+    @staticmethod
+    @BondsMetrics.measure_generator
+    def iter_filter_bonds_by_emitter(bonds_list, risk_black_list=('exclude',), local_db_name=None):
+        if isinstance(risk_black_list, str):
+            risk_black_list = (risk_black_list,)
+        black_listed_emitters = set()
+        if local_db_name is not None:
+            black_listed_emitters = BondsEmittersDB.get_emitters_by_risk(risk_black_list, local_db_name)
+        result_count = 0
         for bond in bonds_list:
+            if str(bond.get('emitter_id', bond.get('EMITTER_ID'))) in black_listed_emitters:
+                continue
             emitter_risk = bond.get('emitter_risk')
             if emitter_risk is None or emitter_risk not in risk_black_list:
-                result.append(bond)
-        logging.info("After filtering by emitter black list " + str(len(result)) + " bonds left")
-        return result
+                result_count += 1
+                yield bond
+        logging.info("After filtering by emitter black list " + str(result_count) + " bonds left")
 
     @staticmethod
     def force_moex_mistakes(bonds_list, mistakes_dict=None):
@@ -780,6 +1715,8 @@ class BondsCustomCalculationAndFilter:
                 continue
             coupons_sum += close_price * (coupon_rate / 100.0) * (coupon_period / 366)
         duration = close_date - today
+        if duration.days <= 0:
+            return None, None
         clear_coupons_sum = coupons_sum * (1 - tax_ratio)
         value_diff = close_price - buy_price - current_coupon
         price_tax = (value_diff * tax_ratio) if value_diff > 0 else 0
@@ -800,42 +1737,1819 @@ class BondsCustomCalculationAndFilter:
         return calendar
 
 
+class BondsEmittersDB:
+    @staticmethod
+    def create_schema(connection):
+        connection.execute("CREATE TABLE IF NOT EXISTS emitters "
+                           "(id INTEGER PRIMARY KEY, name TEXT NOT NULL, risk TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS emitters_risk_idx ON emitters (risk)")
+
+    @staticmethod
+    def load_emitters_file(filename, delimiter=';'):
+        if filename.lower().endswith('.csv'):
+            with open(filename, 'r', newline='', encoding='utf-8') as fh:
+                emitters_list = [row for row in csv.reader(fh, delimiter=delimiter) if row]
+        else:
+            with open(filename, 'r', encoding='utf-8') as fh:
+                emitters_list = json.loads(fh.read())
+        result = []
+        for entry in emitters_list:
+            try:
+                risk = entry[2] if len(entry) > 2 else ""
+                result.append((int(entry[0]), str(entry[1]), risk))
+            except (IndexError, ValueError):
+                logging.error(f"Bad emitter entry {str(entry)} in file '{filename}'. It will be skipped.")
+        return result
+
+    @staticmethod
+    def sync_emitters(emitters_list, local_db_name='emitters.db', remove_missing=False):
+        connection = sqlite3.connect(local_db_name)
+        try:
+            with connection:
+                BondsEmittersDB.create_schema(connection)
+                stored = {row[0]: (row[1], row[2]) for row in connection.execute("SELECT id, name, risk FROM emitters")}
+                new_entries = {entry[0]: (entry[1], entry[2]) for entry in emitters_list}
+                changed = [(emitter_id, name, risk) for emitter_id, (name, risk) in new_entries.items()
+                           if stored.get(emitter_id) != (name, risk)]
+                connection.executemany("INSERT INTO emitters (id, name, risk) VALUES (?, ?, ?) "
+                                       "ON CONFLICT(id) DO UPDATE SET name=excluded.name, risk=excluded.risk",
+                                       changed)
+                removed = []
+                if remove_missing:
+                    removed = [(emitter_id,) for emitter_id in stored if emitter_id not in new_entries]
+                    connection.executemany("DELETE FROM emitters WHERE id=?", removed)
+        finally:
+            connection.close()
+        logging.info(f"Emitters database '{local_db_name}' is synchronized: {str(len(changed))} emitters "
+                     f"were inserted or updated, {str(len(removed))} emitters were removed.")
+        return len(changed), len(removed)
+
+    @staticmethod
+    def get_emitters_by_risk(risk_list, local_db_name='emitters.db'):
+        if not os.path.isfile(local_db_name):
+            logging.warning("Local database with name '" + local_db_name + "' is not found. Can not filter emitters")
+            return set()
+        risk_list = list(risk_list)
+        if len(risk_list) == 0:
+            return set()
+        connection = sqlite3.connect(local_db_name)
+        try:
+            sql_query = "SELECT id FROM emitters WHERE risk IN ({0})".format(", ".join("?" * len(risk_list)))
+            result = {str(row[0]) for row in connection.execute(sql_query, risk_list)}
+        finally:
+            connection.close()
+        return result
+
+
 class BondsCSVWriter:
     @staticmethod
-    def output_csv(bonds_list, remove_offer_date=False, filename='result.csv'):
-        cleared_result = []
+    @BondsMetrics.measure_stage
+    def output_csv(bonds_list, remove_offer_date=False, filename='result.csv', compress=None):
         field_names = ['ISIN', 'SHORTNAME', 'SECNAME', 'FACEVALUE', 'PREVPRICE', 'MATDATE',
                        'TYPE', 'EMITTER_ID', 'emitter_risk', 'year_profit_ratio', 'profit_type', 'coupon_type']
         if not remove_offer_date:
             field_names = field_names[:5] + ['OFFERDATE'] + field_names[5:]
-        for bond in bonds_list:
-            current_bond = {}
-            for key in bond:
-                if key in field_names:
-                    current_bond[key] = bond[key]
-            cleared_result.append(current_bond)
+        if compress is None:
+            compress = filename.endswith('.gz')
+        formatters = [BondsCSVWriter._get_formatter(key) for key in field_names]
+        columns = list(zip(field_names, formatters))
 
+        if platform.system() == "Darwin":
+            enc = 'utf-16'
+            delim = '\t'
+        else:
+            enc = 'utf-8'
+            delim = ';'
+        temp_filename = f"{filename}.{str(os.getpid())}.tmp"
+        rows_count = 0
         try:
-            if platform.system() == "Darwin":
-                enc = 'utf-16'
-                delim = '\t'
-            else:
-                enc = 'utf-8'
-                delim = ';'
-            with open(filename, 'w+', newline='', encoding=enc) as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=field_names, delimiter=delim)
-                writer.writeheader()
-                for line in cleared_result:
-                    writer.writerow(BondsCSVWriter._localize_floats(line))
+            raw_file = open(temp_filename, 'wb')
+            binary_file = gzip.GzipFile(filename=os.path.basename(filename), mode='wb', fileobj=raw_file) \
+                if compress else raw_file
+            with raw_file, binary_file, io.TextIOWrapper(binary_file, encoding=enc, newline='') as csvfile:
+                writer = csv.writer(csvfile, delimiter=delim)
+                writer.writerow(field_names)
+                for bond in bonds_list:
+                    writer.writerow([formatter(bond.get(key, '')) for (key, formatter) in columns])
+                    rows_count += 1
+            os.replace(temp_filename, filename)
         except PermissionError:
             logging.warning(f"Can not write to file {filename}. Looks like it is opened in another program.")
+            BondsCSVWriter._remove_file(temp_filename)
+            return
+        except BaseException:
+            BondsCSVWriter._remove_file(temp_filename)
+            raise
+        logging.info(f"{str(rows_count)} bonds were saved into '{filename}' file.")
+        return rows_count
+
+    @staticmethod
+    def _get_formatter(key):
+        if key in BondsCSVWriter._float_field_names:
+            return BondsCSVWriter._localize_float
+        return BondsCSVWriter._keep_value
+
+    @staticmethod
+    def _localize_float(value):
+        if isinstance(value, float):
+            return repr(value).translate(BondsCSVWriter._decimal_translation)
+        return value
+
+    @staticmethod
+    def _keep_value(value):
+        return value
 
     @staticmethod
-    def _localize_floats(input_dict):
-        output_dict = {}
-        for key in input_dict:
-            if isinstance(input_dict[key], float):
-                output_dict[key] = str(input_dict[key]).replace('.', ',')
+    def _remove_file(filename):
+        if not os.path.exists(filename):
+            return
+        try:
+            os.remove(filename)
+        except OSError:
+            logging.warning(f"Can not remove temporary file {filename}.")
+
+    _float_field_names = frozenset(['FACEVALUE', 'PREVPRICE', 'year_profit_ratio'])
+    _decimal_translation = str.maketrans('.', ',')
+
+
+class BondsQueryService:
+    def __init__(self, bonds_list=None, bonds_group_list=(7, 58), max_cached_commissions=8, max_cached_filters=32):
+        self.bonds_group_list = bonds_group_list
+        self.max_cached_commissions = max_cached_commissions
+        self.max_cached_filters = max_cached_filters
+        self._profits_lock = threading.Lock()
+        self._filters_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._dataset = None
+        self._server = None
+        self._reload_thread = None
+        self.server_address = None
+        if bonds_list is None:
+            self.reload()
+        else:
+            self.swap_dataset(bonds_list)
+
+    def swap_dataset(self, bonds_list, snapshot_date=None):
+        bonds_list = list(bonds_list)
+        dataset = {"bonds": bonds_list,
+                   "index": {bond["ISIN"]: bond for bond in bonds_list if "ISIN" in bond},
+                   "profits": OrderedDict(),
+                   "filters": OrderedDict(),
+                   "snapshot_date": snapshot_date or datetime.strftime(datetime.today(), "%Y-%m-%d")}
+        # Queries which already took previous dataset will finish with it
+        self._dataset = dataset
+        logging.info(f"Query service dataset was replaced with {str(len(bonds_list))} bonds")
+
+    def reload(self):
+        with self._reload_lock:
+            self.swap_dataset(BondsMOEXDataRetriever.load_or_retrieve(self.bonds_group_list))
+
+    def reload_in_background(self):
+        # Retrieving can take minutes, queries are answered from current dataset until it is swapped
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload_and_release, daemon=True).start()
+        return True
+
+    def get_status(self):
+        dataset = self._dataset
+        return {"snapshot_date": dataset["snapshot_date"], "bonds_count": len(dataset["bonds"]),
+                "is_reloading": self._reload_lock.locked()}
+
+    def get_bond(self, isin):
+        return self._dataset["index"].get(isin)
+
+    def query(self, query_dict):
+        dataset = self._dataset
+        commission_ratio = query_dict.get("commission_ratio")
+        min_profit_ratio = query_dict.get("min_profit_ratio")
+        if min_profit_ratio is not None and commission_ratio is None:
+            raise ValueError("Parameter 'min_profit_ratio' requires 'commission_ratio'")
+        filter_description_dict = BondsQueryService._parse_filter_description(query_dict.get("filter", {}))
+        bonds_list = self._get_filtered_bonds(dataset, filter_description_dict)
+        isin_black_list = query_dict.get("isin_black_list")
+        if isin_black_list:
+            bonds_list = BondsMOEXFilter.filter_bonds_by_isin_blacklist(bonds_list, set(isin_black_list))
+        include_schedules = query_dict.get("include_schedules", False)
+        result = []
+        profits = None if commission_ratio is None else self._get_profits(dataset, float(commission_ratio))
+        for bond in bonds_list:
+            if include_schedules:
+                current_bond = dict(bond)
             else:
-                output_dict[key] = input_dict[key]
-        return output_dict
+                current_bond = {key: value for (key, value) in bond.items()
+                                if key not in BondsQueryService._schedule_keys}
+            if profits is not None:
+                current_bond.update(profits.get(bond.get("SECID"), {}))
+            result.append(current_bond)
+        if min_profit_ratio is not None:
+            result = BondsCustomCalculationAndFilter.filter_bonds_by_profit_ratio(result, min_profit_ratio)
+        sort_by = query_dict.get("sort_by")
+        if sort_by is not None:
+            descending = query_dict.get("descending", True)
+            # Bonds without value are always placed at the end
+            with_value = [bond for bond in result if bond.get(sort_by) is not None]
+            with_value.sort(key=lambda current_bond: current_bond[sort_by], reverse=descending)
+            result = with_value + [bond for bond in result if bond.get(sort_by) is None]
+        top_k = query_dict.get("top_k")
+        if top_k is not None:
+            result = result[:int(top_k)]
+        page = int(query_dict.get("page", 1))
+        page_size = int(query_dict.get("page_size", 100))
+        if page < 1 or page_size < 1:
+            raise ValueError("Parameters 'page' and 'page_size' should be positive")
+        return {"snapshot_date": dataset["snapshot_date"], "total": len(result), "page": page, "page_size": page_size,
+                "data": result[(page - 1) * page_size: page * page_size]}
+
+    def serve(self, host="127.0.0.1", port=8080, reload_check_interval_sec=600):
+        service = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/status":
+                    self._send_json(200, service.get_status())
+                elif self.path.startswith("/bonds/"):
+                    bond = service.get_bond(self.path[len("/bonds/"):])
+                    if bond is None:
+                        self._send_json(404, {"error": "Bond is not found"})
+                    else:
+                        self._send_json(200, bond)
+                else:
+                    self._send_json(404, {"error": "Unknown path"})
+
+            def do_POST(self):
+                try:
+                    if self.path == "/query":
+                        content_length = int(self.headers.get("Content-Length", 0))
+                        query_dict = json.loads(self.rfile.read(content_length) or b"{}")
+                        self._send_json(200, service.query(query_dict))
+                    elif self.path == "/reload":
+                        service.reload_in_background()
+                        self._send_json(202, service.get_status())
+                    else:
+                        self._send_json(404, {"error": "Unknown path"})
+                except (ValueError, TypeError, AttributeError) as error:
+                    self._send_json(400, {"error": str(error)})
+
+            def _send_json(self, code, body):
+                content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logging.debug("Query service: " + format % args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self._stop_event.clear()
+        if reload_check_interval_sec is not None:
+            self._reload_thread = threading.Thread(target=self._reload_new_snapshots,
+                                                   args=(reload_check_interval_sec,), daemon=True)
+            self._reload_thread.start()
+        self.server_address = self._server.server_address
+        logging.info(f"Query service is started on http://{host}:{str(self.server_address[1])}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def shutdown(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _reload_new_snapshots(self, check_interval_sec):
+        while not self._stop_event.wait(check_interval_sec):
+            if self._dataset["snapshot_date"] != datetime.strftime(datetime.today(), "%Y-%m-%d"):
+                logging.info("New day is started. Query service dataset will be reloaded.")
+                try:
+                    self.reload()
+                except Exception:
+                    logging.error("Failed to reload query service dataset", exc_info=True)
+
+    def _reload_and_release(self):
+        try:
+            self.swap_dataset(BondsMOEXDataRetriever.load_or_retrieve(self.bonds_group_list))
+        except Exception:
+            logging.error("Failed to reload query service dataset", exc_info=True)
+        finally:
+            self._reload_lock.release()
+
+    def _get_filtered_bonds(self, dataset, filter_description_dict):
+        # Result should not depend on time of the query, so filter is evaluated as of start of the day
+        today = datetime.today()
+        as_of_date = datetime(today.year, today.month, today.day)
+        filter_settings = BondsMOEXFilter.get_advanced_filter_settings(filter_description_dict, as_of_date)
+        entry = {"settings": BondsScreenCache._canonicalize(filter_settings), "min_profit_ratio": None}
+        key = json.dumps(entry["settings"], sort_keys=True)
+        with self._filters_lock:
+            filters_cache = dataset["filters"]
+            BondsMetrics.record_cache("query_service_filters", key in filters_cache)
+            if key in filters_cache:
+                filters_cache.move_to_end(key)
+                return filters_cache[key][1]
+            # Result of broader filter is refined instead of scanning of all bonds
+            superset_list = next((cached_list for (cached_entry, cached_list) in reversed(filters_cache.values())
+                                  if BondsScreenCache._is_narrower(entry, cached_entry)), None)
+        if superset_list is None:
+            superset_list = dataset["bonds"]
+        bonds_list = BondsMOEXFilter.filter_bonds_advanced(superset_list, filter_description_dict, as_of_date)
+        with self._filters_lock:
+            filters_cache[key] = (entry, bonds_list)
+            if len(filters_cache) > self.max_cached_filters:
+                filters_cache.popitem(last=False)
+        return bonds_list
+
+    def _get_profits(self, dataset, commission_ratio):
+        with self._profits_lock:
+            profits_cache = dataset["profits"]
+            BondsMetrics.record_cache("query_service_profits", commission_ratio in profits_cache)
+            if commission_ratio in profits_cache:
+                profits_cache.move_to_end(commission_ratio)
+                return profits_cache[commission_ratio]
+            bonds_copy = [dict(bond) for bond in dataset["bonds"]]
+            BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_copy, commission_ratio)
+            profits = {}
+            for bond in bonds_copy:
+                if bond.get("year_profit_ratio") is not None:
+                    profits[bond.get("SECID")] = {key: bond[key] for key in
+                                                  ('year_profit_ratio', 'profit_type', 'coupon_type')}
+            profits_cache[commission_ratio] = profits
+            if len(profits_cache) > self.max_cached_commissions:
+                profits_cache.popitem(last=False)
+            return profits
+
+    @staticmethod
+    def _parse_filter_description(filter_description):
+        result = {}
+        for (key, value) in filter_description.items():
+            if key.endswith("_date") and isinstance(value, str):
+                value = datetime.strptime(value, "%Y-%m-%d")
+            result[key] = value
+        return result
+
+    _schedule_keys = frozenset(["coupons", "amortizations", "offers", "sales_history"])
+
+
+class BondsParquetWriter:
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def output_parquet(bonds_list, directory='export', snapshot_date=None, row_group_size=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.error("Package 'pyarrow' is required to save bonds in Parquet format. "
+                          "Please install it with 'pip install pyarrow'.")
+            raise
+        if snapshot_date is None:
+            snapshot_date = datetime.today()
+        partition_name = "snapshot_date=" + datetime.strftime(snapshot_date, "%Y-%m-%d")
+        type_mapping = {'string': pyarrow.string(), 'float64': pyarrow.float64(), 'int64': pyarrow.int64(),
+                        'date': pyarrow.date32(), 'bool': pyarrow.bool_()}
+        writers = {}
+        rows_count = 0
+        try:
+            for columns_dict in BondsParquetWriter.iter_columns(bonds_list, row_group_size):
+                for (table_name, columns) in columns_dict.items():
+                    schema = pyarrow.schema([(key, type_mapping[value_type]) for (key, value_type)
+                                             in BondsParquetWriter.schemas[table_name]])
+                    if table_name not in writers:
+                        table_directory = os.path.join(directory, table_name, partition_name)
+                        os.makedirs(table_directory, exist_ok=True)
+                        filename = os.path.join(table_directory, "part-0.parquet")
+                        temp_filename = f"{filename}.{str(os.getpid())}.tmp"
+                        writers[table_name] = (pyarrow.parquet.ParquetWriter(temp_filename, schema),
+                                               temp_filename, filename)
+                    writers[table_name][0].write_table(pyarrow.table(columns, schema=schema))
+                rows_count += len(columns_dict['bonds']['SECID'])
+        except BaseException:
+            for (writer, temp_filename, _) in writers.values():
+                writer.close()
+                BondsCSVWriter._remove_file(temp_filename)
+            raise
+        for (writer, temp_filename, filename) in writers.values():
+            writer.close()
+            os.replace(temp_filename, filename)
+        logging.info(f"{str(rows_count)} bonds were saved in Parquet format into '{directory}' directory.")
+        return rows_count
+
+    @staticmethod
+    def iter_columns(bonds_list, row_group_size=10000):
+        columns_dict = BondsParquetWriter._get_empty_columns()
+        bonds_count = 0
+        for bond in bonds_list:
+            secid = bond.get('SECID')
+            bonds_columns = columns_dict['bonds']
+            for (key, value_type) in BondsParquetWriter.schemas['bonds']:
+                bonds_columns[key].append(BondsParquetWriter._convert_value(bond.get(key), value_type))
+            for table_name in ('coupons', 'amortizations', 'offers', 'sales_history'):
+                table_columns = columns_dict[table_name]
+                for entry in bond.get(table_name) or []:
+                    table_columns['SECID'].append(secid)
+                    for (key, value_type) in BondsParquetWriter.schemas[table_name][1:]:
+                        table_columns[key].append(BondsParquetWriter._convert_value(entry.get(key), value_type))
+            bonds_count += 1
+            if bonds_count == row_group_size:
+                yield columns_dict
+                columns_dict = BondsParquetWriter._get_empty_columns()
+                bonds_count = 0
+        if bonds_count > 0:
+            yield columns_dict
+
+    @staticmethod
+    def _get_empty_columns():
+        return {table_name: {key: [] for (key, _) in schema} for (table_name, schema) in
+                BondsParquetWriter.schemas.items()}
+
+    @staticmethod
+    def _convert_value(value, value_type):
+        if value is None:
+            return None
+        try:
+            if value_type == 'date':
+                return datetime.strptime(value, '%Y-%m-%d').date()
+            if value_type == 'float64':
+                return float(value)
+            if value_type == 'int64':
+                return int(value)
+            if value_type == 'bool':
+                return bool(int(value))
+            return str(value)
+        except (TypeError, ValueError):
+            # MOEX uses '0000-00-00' for bonds without expiration date
+            return None
+
+    schemas = {
+        'bonds': [('SECID', 'string'), ('ISIN', 'string'), ('SHORTNAME', 'string'), ('SECNAME', 'string'),
+                  ('PREVPRICE', 'float64'), ('LOTSIZE', 'int64'), ('FACEVALUE', 'float64'), ('MATDATE', 'date'),
+                  ('OFFERDATE', 'date'), ('FACEUNIT', 'string'), ('ACCRUEDINT', 'float64'), ('SECTYPE', 'string'),
+                  ('COUPONPERCENT', 'float64'), ('COUPONPERIOD', 'int64'), ('ISQUALIFIEDINVESTORS', 'bool'),
+                  ('TYPE', 'string'), ('EMITTER_ID', 'string'), ('emitter_risk', 'string'),
+                  ('year_profit_ratio', 'float64'), ('profit_type', 'string'), ('coupon_type', 'string')],
+        'coupons': [('SECID', 'string'), ('coupondate', 'date'), ('faceunit', 'string'), ('value', 'float64')],
+        'amortizations': [('SECID', 'string'), ('amortdate', 'date'), ('faceunit', 'string'), ('value', 'float64')],
+        'offers': [('SECID', 'string'), ('offerdate', 'date'), ('offertype', 'string')],
+        'sales_history': [('SECID', 'string'), ('TRADEDATE', 'date'), ('VOLUME', 'int64'), ('NUMTRADES', 'int64')],
+    }
+
+
+class BondsAlertManager:
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.rules = OrderedDict()
+        self._fingerprints = {}
+        self._states = {}
+        self._evaluation_date = None
+
+    def add_rule(self, rule_name, rule_type, threshold=None, isin_list=None, filter_description_dict=None,
+                 threshold_deal=10, threshold_amount=50, notify_cleared=False):
+        if rule_type not in BondsAlertManager.rule_types:
+            raise ValueError(f"Unknown rule type '{rule_type}'. Possible types are: "
+                             f"{', '.join(BondsAlertManager.rule_types)}")
+        if rule_type != "profile_match" and rule_type != "liquidity_lost" and threshold is None:
+            raise ValueError(f"Threshold should be set for rule type '{rule_type}'")
+        if rule_type == "profile_match" and filter_description_dict is None:
+            filter_description_dict = {}
+        # Filter settings depend on evaluation date, so they are resolved on every tick
+        self.rules[rule_name] = {"type": rule_type, "threshold": threshold,
+                                 "isin_set": None if isin_list is None else set(isin_list),
+                                 "filter_description_dict": filter_description_dict, "filter_settings": None,
+                                 "threshold_deal": threshold_deal,
+                                 "threshold_amount": threshold_amount, "notify_cleared": notify_cleared}
+        # New rule should be evaluated for all bonds
+        self._fingerprints.clear()
+
+    def remove_rule(self, rule_name):
+        self.rules.pop(rule_name, None)
+        for key in [key for key in self._states if key[0] == rule_name]:
+            del self._states[key]
+
+    def invalidate(self, secid_list=None):
+        if secid_list is None:
+            self._fingerprints.clear()
+            return
+        for secid in secid_list:
+            self._fingerprints.pop(secid, None)
+
+    def tick(self, bonds_list, as_of_date=None):
+        if as_of_date is None:
+            today = datetime.today()
+            as_of_date = datetime(today.year, today.month, today.day)
+        if self._evaluation_date != as_of_date.date():
+            # Date-relative settings (e.g. default minimal expiration date) are changed, so all bonds are evaluated
+            self._evaluation_date = as_of_date.date()
+            self._fingerprints.clear()
+        for rule in self.rules.values():
+            if rule["type"] == "profile_match":
+                rule["filter_settings"] = BondsMOEXFilter.get_advanced_filter_settings(
+                    rule["filter_description_dict"], as_of_date)
+        events = []
+        evaluated_count = 0
+        for bond in bonds_list:
+            secid = bond.get("SECID")
+            if secid is None:
+                logging.error(f"While evaluating alerts can not find 'SECID' for bond {str(bond)}")
+                continue
+            fingerprint = BondsAlertManager._get_fingerprint(bond)
+            if self._fingerprints.get(secid) == fingerprint:
+                continue
+            self._fingerprints[secid] = fingerprint
+            evaluated_count += 1
+            for (rule_name, rule) in self.rules.items():
+                if rule["isin_set"] is not None and bond.get("ISIN") not in rule["isin_set"]:
+                    continue
+                is_active = BondsAlertManager._check_rule(bond, rule)
+                if is_active is None:
+                    continue
+                was_active = self._states.get((rule_name, secid), False)
+                self._states[(rule_name, secid)] = is_active
+                if is_active and not was_active:
+                    events.append(BondsAlertManager._get_event(rule_name, rule, bond, "triggered"))
+                elif was_active and not is_active and rule["notify_cleared"]:
+                    events.append(BondsAlertManager._get_event(rule_name, rule, bond, "cleared"))
+        for event in events:
+            for sink in self.sinks:
+                try:
+                    sink.send(event)
+                except Exception:
+                    logging.error(f"Failed to send alert event {str(event)}", exc_info=True)
+        logging.info(f"Alerts were evaluated for {str(evaluated_count)} changed bonds, "
+                     f"{str(len(events))} events were sent")
+        return events
+
+    @staticmethod
+    def _check_rule(bond, rule):
+        rule_type = rule["type"]
+        if rule_type == "profile_match":
+            try:
+                return BondsMOEXFilter.check_bond_advanced(bond, rule["filter_settings"])
+            except (KeyError, ValueError):
+                logging.error(f"While evaluating alerts can not check profile for bond {str(bond)}", exc_info=True)
+                return
+        if rule_type == "liquidity_lost":
+            is_liquid = BondsMOEXFilter.check_sales(bond, rule["threshold_deal"], rule["threshold_amount"])
+            return None if is_liquid is None else not is_liquid
+        value = bond.get(BondsAlertManager._get_rule_field(rule_type))
+        if value is None:
+            return
+        if rule_type.endswith("_above"):
+            return value >= rule["threshold"]
+        return value <= rule["threshold"]
+
+    @staticmethod
+    def _get_rule_field(rule_type):
+        return "year_profit_ratio" if rule_type.startswith("yield") else "PREVPRICE"
+
+    @staticmethod
+    def _get_event(rule_name, rule, bond, state):
+        event = {"rule": rule_name, "type": rule["type"], "state": state, "SECID": bond.get("SECID"),
+                 "ISIN": bond.get("ISIN"), "time": datetime.now().isoformat(timespec="seconds")}
+        if rule["threshold"] is not None:
+            event["threshold"] = rule["threshold"]
+            event["value"] = bond.get(BondsAlertManager._get_rule_field(rule["type"]))
+        return event
+
+    @staticmethod
+    def _get_fingerprint(bond):
+        sales_history = bond.get("sales_history") or []
+        return (bond.get("PREVPRICE"), bond.get("year_profit_ratio"), bond.get("ISQUALIFIEDINVESTORS"),
+                bond.get("FACEVALUE"), bond.get("MATDATE"), bond.get("OFFERDATE"),
+                len(bond.get("amortizations") or []), len(sales_history),
+                sum(day.get("VOLUME", 0) for day in sales_history),
+                sum(day.get("NUMTRADES", 0) for day in sales_history))
+
+    rule_types = ("yield_above", "yield_below", "price_above", "price_below", "liquidity_lost", "profile_match")
+
+
+class BondsAlertFileSink:
+    def __init__(self, filename='alerts.jsonl'):
+        self.filename = filename
+
+    def send(self, event):
+        with open(self.filename, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+class BondsAlertCallbackSink:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def send(self, event):
+        self.callback(event)
+
+
+class BondsAlertWebhookSink:
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, event):
+        request = urllib.request.Request(self.url, data=json.dumps(event).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).read()
+        except urllib.error.URLError:
+            logging.warning(f"Failed to send alert event to '{self.url}'", exc_info=True)
+
+
+class BondsLiquidityStore:
+    def __init__(self, local_db_name='liquidity.db'):
+        self.local_db_name = local_db_name
+        # Store can be shared by threads (e.g. by query service), so connection is guarded by lock
+        self.connection = sqlite3.connect(local_db_name, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self.connection:
+            # Cumulative values allow to get aggregates for any window with two index lookups
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sales_history "
+                                    "(secid TEXT NOT NULL, tradedate TEXT NOT NULL, volume INTEGER NOT NULL, "
+                                    "numtrades INTEGER NOT NULL, value REAL NOT NULL, cum_volume INTEGER NOT NULL, "
+                                    "cum_numtrades INTEGER NOT NULL, cum_value REAL NOT NULL, "
+                                    "cum_active_days INTEGER NOT NULL, PRIMARY KEY (secid, tradedate)) WITHOUT ROWID")
+            # Days for which history of all bonds was loaded
+            self.connection.execute("CREATE TABLE IF NOT EXISTS loaded_days (tradedate TEXT PRIMARY KEY)")
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def update(self, days_delta=15, publication_lag_days=3):
+        # History of all bonds is requested day by day, so count of requests does not depend on count of bonds.
+        # Current day is not finished yet, so it is loaded on the next day.
+        today = datetime.today()
+        updated_days = 0
+        for days_ago in range(days_delta, 0, -1):
+            day = today - timedelta(days=days_ago)
+            trade_date = datetime.strftime(day, '%Y-%m-%d')
+            with self._lock:
+                is_loaded = self.connection.execute("SELECT 1 FROM loaded_days WHERE tradedate=?",
+                                                    (trade_date,)).fetchone() is not None
+            BondsMetrics.record_cache("liquidity_store", is_loaded)
+            if is_loaded:
+                continue
+            history = BondsLiquidityStore._get_market_history(trade_date)
+            if history is None:
+                logging.error(f"Can not retrieve data about bonds sales history for {trade_date}")
+                continue
+            if not history and day.weekday() < 5 and days_ago <= publication_lag_days:
+                # Empty weekday can be not published yet, so it is requested again on the next update
+                logging.info(f"There is no sales history for {trade_date} yet")
+                continue
+            days_by_secid = {}
+            for day in history:
+                days_by_secid.setdefault(day["SECID"], []).append(day)
+            with self._lock:
+                rows = []
+                for (secid, days) in days_by_secid.items():
+                    rows.extend(self._get_new_rows(secid, days)[0])
+                # The whole day is written in one transaction
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO sales_history "
+                                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    self.connection.execute("INSERT OR IGNORE INTO loaded_days VALUES (?)", (trade_date,))
+            updated_days += 1
+        logging.info(f"Sales history of {str(updated_days)} days was loaded into liquidity store")
+
+    def append_history(self, secid, history):
+        with self._lock:
+            (rows, new_count) = self._get_new_rows(secid, history)
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO sales_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                            rows)
+        return new_count
+
+    def _get_new_rows(self, secid, history):
+        # Several boards can be returned for the same day, so data is summed up by day
+        days = {}
+        for day in history:
+            (volume, numtrades, value) = days.get(day["TRADEDATE"], (0, 0, 0.0))
+            days[day["TRADEDATE"]] = (volume + (day.get("VOLUME") or 0), numtrades + (day.get("NUMTRADES") or 0),
+                                      value + (day.get("VALUE") or 0.0))
+        if not days:
+            return [], 0
+        first_date = min(days)
+        # Already stored days are kept, days after the first new one get new cumulative values
+        stored_days = {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT tradedate, volume, numtrades, value FROM sales_history WHERE secid=? AND tradedate>=?",
+            (secid, first_date))}
+        new_count = len(days.keys() - stored_days.keys())
+        days.update(stored_days)
+        base_row = self.connection.execute(
+            "SELECT cum_volume, cum_numtrades, cum_value, cum_active_days FROM sales_history "
+            "WHERE secid=? AND tradedate<? ORDER BY tradedate DESC LIMIT 1", (secid, first_date)).fetchone()
+        (cum_volume, cum_numtrades, cum_value, cum_active_days) = base_row or (0, 0, 0.0, 0)
+        rows = []
+        for trade_date in sorted(days):
+            (volume, numtrades, value) = days[trade_date]
+            cum_volume += volume
+            cum_numtrades += numtrades
+            cum_value += value
+            cum_active_days += 1 if numtrades > 0 else 0
+            rows.append((secid, trade_date, volume, numtrades, value, cum_volume, cum_numtrades, cum_value,
+                         cum_active_days))
+        return rows, new_count
+
+    def get_last_trade_date(self, secid):
+        with self._lock:
+            row = self.connection.execute("SELECT MAX(tradedate) FROM sales_history WHERE secid=?",
+                                          (secid,)).fetchone()
+        return row[0]
+
+    def get_window_aggregates(self, secid, window_days=15, as_of_date=None):
+        (date_from, date_to) = BondsLiquidityStore._get_window(window_days, as_of_date)
+        fields = "cum_volume, cum_numtrades, cum_value, cum_active_days"
+        with self._lock:
+            end_row = self.connection.execute(f"SELECT {fields} FROM sales_history WHERE secid=? AND tradedate<=? "
+                                              f"ORDER BY tradedate DESC LIMIT 1", (secid, date_to)).fetchone()
+            start_row = self.connection.execute(f"SELECT {fields} FROM sales_history WHERE secid=? AND tradedate<? "
+                                                f"ORDER BY tradedate DESC LIMIT 1", (secid, date_from)).fetchone()
+        end_row = end_row or (0, 0, 0.0, 0)
+        start_row = start_row or (0, 0, 0.0, 0)
+        return {"volume": end_row[0] - start_row[0], "deals": end_row[1] - start_row[1],
+                "turnover": end_row[2] - start_row[2], "active_days": end_row[3] - start_row[3]}
+
+    def get_sales_history(self, secid, window_days=15, as_of_date=None):
+        (date_from, date_to) = BondsLiquidityStore._get_window(window_days, as_of_date)
+        with self._lock:
+            rows = self.connection.execute("SELECT tradedate, volume, numtrades FROM sales_history "
+                                           "WHERE secid=? AND tradedate>=? AND tradedate<=? ORDER BY tradedate",
+                                           (secid, date_from, date_to)).fetchall()
+        return [{"TRADEDATE": row[0], "VOLUME": row[1], "NUMTRADES": row[2]} for row in rows]
+
+    def check_sales(self, bond, threshold_deal=10, threshold_amount=50, window_days=15, as_of_date=None):
+        if "SECID" not in bond:
+            logging.error(f"While checking sales can not find 'SECID' for bond {str(bond)}")
+            return
+        aggregates = self.get_window_aggregates(bond["SECID"], window_days, as_of_date)
+        return aggregates["volume"] > threshold_amount and aggregates["deals"] > threshold_deal
+
+    def enrich_bonds_sales_history(self, bonds_list, window_days=15):
+        for bond in bonds_list:
+            if "SECID" not in bond:
+                logging.error(f"While enriching sales history can not find 'SECID' for bond {str(bond)}")
+                continue
+            bond["sales_history"] = self.get_sales_history(bond["SECID"], window_days)
+        return bonds_list
+
+    @staticmethod
+    def _get_window(window_days, as_of_date=None):
+        if as_of_date is None:
+            as_of_date = datetime.today()
+        date_from = as_of_date - timedelta(days=window_days)
+        return datetime.strftime(date_from, '%Y-%m-%d'), datetime.strftime(as_of_date, '%Y-%m-%d')
+
+    @staticmethod
+    def _get_market_history(trade_date, page_size=100):
+        result = []
+        while True:
+            request_url = "https://iss.moex.com/iss/history/engines/stock/markets/bonds/securities.json" \
+                          "?iss.meta=off&iss.only=history&history.columns=SECID,TRADEDATE,VOLUME,NUMTRADES,VALUE" \
+                          "&limit=" + str(page_size) + "&start=" + str(len(result)) + "&date=" + trade_date
+            data = BondsMOEXDataRetriever._url_request(request_url)
+            if data is None:
+                return
+            page = BondsMOEXDataRetriever._convert_data_to_dict(data, "history")
+            result.extend(page)
+            if len(page) < page_size:
+                return result
+
+
+class BondsBacktestRunner:
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def run(profile_dict, date_from=None, date_to=None, cache_dir=None, horizon_days=30, processes=None):
+        if horizon_days < 1:
+            raise ValueError("Parameter 'horizon_days' should be positive")
+        cache_dir = BondsMOEXDataRetriever.get_cache_dir(cache_dir)
+        snapshot_dates = BondsBacktestRunner.get_snapshot_dates(cache_dir)
+        tasks = []
+        for snapshot_date in snapshot_dates:
+            if (date_from is not None and snapshot_date < date_from) or \
+                    (date_to is not None and snapshot_date > date_to):
+                continue
+            # Outcome is measured at the first stored snapshot which is not earlier than the horizon
+            exit_date = next((current_date for current_date in snapshot_dates
+                              if current_date >= snapshot_date + timedelta(days=horizon_days)), None)
+            tasks.append((profile_dict, cache_dir, snapshot_date, exit_date))
+        logging.info(f"Backtest will be run for {str(len(tasks))} snapshots")
+        if processes == 1 or len(tasks) <= 1:
+            return [BondsBacktestRunner.run_snapshot(*task) for task in tasks]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return list(executor.map(BondsBacktestRunner.run_snapshot, *zip(*tasks)))
+
+    @staticmethod
+    def get_snapshot_dates(cache_dir=None):
+        result = []
+        for filename in os.listdir(BondsMOEXDataRetriever.get_cache_dir(cache_dir)):
+            (name, extension) = os.path.splitext(filename)
+            if extension != ".json":
+                continue
+            try:
+                result.append(datetime.strptime(name, "%Y-%m-%d"))
+            except ValueError:
+                continue
+        return sorted(result)
+
+    @staticmethod
+    def run_snapshot(profile_dict, cache_dir, snapshot_date, exit_date=None):
+        bonds_list = BondsBacktestRunner._load_snapshot(cache_dir, snapshot_date)
+        selected_list = BondsBacktestRunner.select_bonds(bonds_list, profile_dict, snapshot_date)
+        exit_bonds = {}
+        if exit_date is not None:
+            # Selected bonds may be skipped by listing filter of later snapshot, but their prices are still known
+            exit_bonds = {bond.get("SECID"): bond for bond in BondsBacktestRunner._load_snapshot(cache_dir, exit_date,
+                                                                                                 True)}
+        commission_ratio = float(profile_dict.get("commission_ratio", 0.0))
+        result = []
+        for bond in selected_list:
+            outcome = {key: bond.get(key) for key in ("SECID", "ISIN", "SHORTNAME", "PREVPRICE", "year_profit_ratio",
+                                                      "profit_type")}
+            if exit_date is not None:
+                outcome.update(BondsBacktestRunner.get_realized_outcome(bond, exit_bonds.get(bond.get("SECID")),
+                                                                        snapshot_date, exit_date, commission_ratio))
+            result.append(outcome)
+        return {"date": datetime.strftime(snapshot_date, "%Y-%m-%d"),
+                "exit_date": None if exit_date is None else datetime.strftime(exit_date, "%Y-%m-%d"),
+                "bonds": result}
+
+    @staticmethod
+    def select_bonds(bonds_list, profile_dict, as_of_date):
+        filter_description_dict = BondsQueryService._parse_filter_description(profile_dict.get("filter", {}))
+        bonds_list = BondsMOEXFilter.filter_bonds_advanced(bonds_list, filter_description_dict, as_of_date)
+        isin_black_list = profile_dict.get("isin_black_list")
+        if isin_black_list:
+            bonds_list = BondsMOEXFilter.filter_bonds_by_isin_blacklist(bonds_list, set(isin_black_list))
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_list, float(profile_dict.get("commission_ratio",
+                                                                                                  0.0)), as_of_date)
+        min_profit_ratio = profile_dict.get("min_profit_ratio")
+        if min_profit_ratio is not None:
+            bonds_list = BondsCustomCalculationAndFilter.filter_bonds_by_profit_ratio(bonds_list, min_profit_ratio)
+        top_k = profile_dict.get("top_k")
+        if top_k is not None:
+            bonds_list = sorted(bonds_list, key=lambda bond: bond.get("year_profit_ratio") or 0, reverse=True)
+            bonds_list = bonds_list[:int(top_k)]
+        return bonds_list
+
+    @staticmethod
+    def get_realized_outcome(bond, exit_bond, snapshot_date, exit_date, commission_ratio=0.0):
+        buy_price = bond["PREVPRICE"] * bond["FACEVALUE"] / 100.0
+        full_price = buy_price * (1 + commission_ratio) + bond["ACCRUEDINT"]
+        date_from = datetime.strftime(snapshot_date, "%Y-%m-%d")
+        date_to = datetime.strftime(exit_date, "%Y-%m-%d")
+        # Later snapshot knows actual values of payments which were not defined at the moment of selection
+        coupons = bond.get("coupons", [])
+        amortizations = bond.get("amortizations", [])
+        if exit_bond is not None and "coupons" in exit_bond:
+            coupons = exit_bond["coupons"]
+        if exit_bond is not None and "amortizations" in exit_bond:
+            amortizations = exit_bond["amortizations"]
+        coupons_paid = 0.0
+        last_known_coupon_value = 0.0
+        for coupon in coupons:
+            if coupon["value"] is not None:
+                last_known_coupon_value = coupon["value"]
+            if date_from < coupon["coupondate"] <= date_to:
+                coupons_paid += last_known_coupon_value
+        amortizations_paid = sum(payment["value"] or 0.0 for payment in amortizations
+                                 if date_from < payment["amortdate"] <= date_to)
+        if exit_bond is None or exit_bond.get("PREVPRICE") is None:
+            # Bond is redeemed or not traded anymore, so only payments are taken into account
+            exit_price = None
+            exit_value = 0.0
+        else:
+            exit_price = exit_bond["PREVPRICE"]
+            exit_value = exit_price * exit_bond["FACEVALUE"] / 100.0 + exit_bond["ACCRUEDINT"]
+        realized_return = (exit_value + coupons_paid + amortizations_paid - full_price) / full_price
+        holding_days = (exit_date - snapshot_date).days
+        return {"exit_price": exit_price,
+                "price_change": None if exit_price is None else exit_price - bond["PREVPRICE"],
+                "coupons_paid": coupons_paid, "amortizations_paid": amortizations_paid,
+                "realized_return": realized_return,
+                "realized_year_ratio": realized_return / holding_days * 365 if holding_days > 0 else None}
+
+    @staticmethod
+    def _load_snapshot(cache_dir, snapshot_date, include_pending=False):
+        filename = os.path.join(cache_dir, datetime.strftime(snapshot_date, "%Y-%m-%d") + ".json")
+        return BondsMOEXDataRetriever.load_snapshot(filename, include_pending)
+
+
+class BondsScreenCache:
+    def __init__(self, max_entries=32, filename=None):
+        self.max_entries = max_entries
+        self.filename = filename
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Hash of the last screened snapshot, the list is kept so its id can not be reused
+        self._snapshot = None
+        if filename is not None and os.path.isfile(filename):
+            with open(filename, 'r', encoding='utf-8') as fh:
+                for entry in json.loads(fh.read()):
+                    self._entries[BondsScreenCache._get_key(entry)] = entry
+            logging.info(f"{str(len(self._entries))} cached screen results were loaded from '{filename}'")
+
+    def screen(self, bonds_list, filter_description_dict, commission_ratio, min_profit_ratio=None, as_of_date=None,
+               snapshot_hash=None):
+        if as_of_date is None:
+            # Result should not depend on time of the call, so screen is evaluated as of start of the day
+            today = datetime.today()
+            as_of_date = datetime(today.year, today.month, today.day)
+        if snapshot_hash is None:
+            snapshot_hash = self._get_memoized_hash(bonds_list)
+        filter_settings = BondsMOEXFilter.get_advanced_filter_settings(filter_description_dict, as_of_date)
+        entry = {"snapshot_hash": snapshot_hash, "settings": BondsScreenCache._canonicalize(filter_settings),
+                 "commission_ratio": commission_ratio, "min_profit_ratio": min_profit_ratio,
+                 "as_of_date": as_of_date.isoformat()}
+        key = BondsScreenCache._get_key(entry)
+        superset_entry = None
+        with self._lock:
+            cached_entry = self._entries.get(key)
+            if cached_entry is not None:
+                self._entries.move_to_end(key)
+            else:
+                superset_entry = self._find_superset(entry)
+        bonds_by_isin = {bond.get("ISIN"): bond for bond in bonds_list}
+        if cached_entry is not None:
+            result = BondsScreenCache._apply_entry(cached_entry, bonds_by_isin)
+            if result is not None:
+                BondsMetrics.record_cache("screen_result", True)
+                return result
+            self._discard_entry(cached_entry)
+        elif superset_entry is not None:
+            superset_list = BondsScreenCache._apply_entry(superset_entry, bonds_by_isin)
+            if superset_list is None:
+                self._discard_entry(superset_entry)
+                superset_entry = None
+        BondsMetrics.record_cache("screen_result", False)
+
+        if superset_entry is not None:
+            logging.info("Screen result is refined from cached result of broader screen")
+            candidates_list = []
+            for bond in superset_list:
+                try:
+                    if BondsMOEXFilter.check_bond_advanced(bond, filter_settings):
+                        candidates_list.append(bond)
+                except (KeyError, ValueError):
+                    logging.error("Can not check bond " + str(bond), exc_info=True)
+        else:
+            candidates_list = BondsMOEXFilter.filter_bonds_advanced(bonds_list, filter_description_dict, as_of_date)
+            BondsCustomCalculationAndFilter.calculate_bonds_profit(candidates_list, commission_ratio, as_of_date)
+        if min_profit_ratio is not None:
+            candidates_list = BondsCustomCalculationAndFilter.filter_bonds_by_profit_ratio(candidates_list,
+                                                                                           min_profit_ratio)
+        entry["isins"] = [bond.get("ISIN") for bond in candidates_list]
+        entry["profits"] = {bond.get("ISIN"): [bond[key] for key in BondsScreenCache._profit_keys]
+                            for bond in candidates_list if "year_profit_ratio" in bond}
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.filename is not None:
+            self.save()
+        return candidates_list
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        with self._lock:
+            content = json.dumps(list(self._entries.values()))
+        temp_filename = f"{filename}.{str(os.getpid())}.tmp"
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as fh:
+                fh.write(content)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            BondsCSVWriter._remove_file(temp_filename)
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._snapshot = None
+
+    def forget_snapshot(self):
+        # Should be called when bonds of the last screened list were changed in place
+        with self._lock:
+            self._snapshot = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_snapshot_hash(bonds_list):
+        snapshot_hash = hashlib.sha256()
+        for bond in bonds_list:
+            # Fields added by profit calculation are not part of snapshot content
+            content = {key: value for (key, value) in bond.items() if key not in BondsScreenCache._profit_keys}
+            snapshot_hash.update(json.dumps(content, sort_keys=True, ensure_ascii=False,
+                                            default=BondsMOEXDataRetriever._convert_to_json).encode("utf-8"))
+        return snapshot_hash.hexdigest()
+
+    def _get_memoized_hash(self, bonds_list):
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] is bonds_list and snapshot[1] == len(bonds_list):
+            return snapshot[2]
+        snapshot_hash = BondsScreenCache.get_snapshot_hash(bonds_list)
+        with self._lock:
+            self._snapshot = (bonds_list, len(bonds_list), snapshot_hash)
+        return snapshot_hash
+
+    def _discard_entry(self, entry):
+        logging.warning("Cached screen result does not match bonds list, probably snapshot hash is wrong. "
+                        "Screen will be evaluated again.")
+        with self._lock:
+            self._entries.pop(BondsScreenCache._get_key(entry), None)
+
+    def _find_superset(self, entry):
+        # The most recently used suitable entry is preferred
+        for cached_entry in reversed(self._entries.values()):
+            if all(cached_entry[key] == entry[key] for key in ("snapshot_hash", "commission_ratio", "as_of_date")) \
+                    and BondsScreenCache._is_narrower(entry, cached_entry):
+                return cached_entry
+        return None
+
+    @staticmethod
+    def _is_narrower(entry, cached_entry):
+        settings = entry["settings"]
+        cached_settings = cached_entry["settings"]
+        for key in ("max_bond_value", "max_expiration_date", "max_offert_date"):
+            if cached_settings[key] is not None and (settings[key] is None or settings[key] > cached_settings[key]):
+                return False
+        for key in ("min_bond_value", "min_expiration_date", "min_offert_date", "sales_threshold_amount",
+                    "sales_threshold_deal"):
+            if cached_settings[key] is not None and (settings[key] is None or settings[key] < cached_settings[key]):
+                return False
+        for key in ("is_offert_interesting", "is_amortization_interesting", "is_qualified", "is_noliquid_interesting",
+                    "is_infinity_interesting"):
+            if settings[key] and not cached_settings[key]:
+                return False
+        if cached_entry["min_profit_ratio"] is not None and \
+                (entry["min_profit_ratio"] is None or entry["min_profit_ratio"] < cached_entry["min_profit_ratio"]):
+            return False
+        return True
+
+    @staticmethod
+    def _apply_entry(entry, bonds_by_isin):
+        result = []
+        profits = entry["profits"]
+        if any(isin not in bonds_by_isin for isin in entry["isins"]):
+            return None
+        for isin in entry["isins"]:
+            bond = bonds_by_isin[isin]
+            if isin in profits:
+                bond.update(zip(BondsScreenCache._profit_keys, profits[isin]))
+            result.append(bond)
+        return result
+
+    @staticmethod
+    def _canonicalize(filter_settings):
+        return {key: value.isoformat() if isinstance(value, (datetime, date)) else value
+                for (key, value) in filter_settings.items()}
+
+    @staticmethod
+    def _get_key(entry):
+        return json.dumps([entry["snapshot_hash"], entry["settings"], entry["commission_ratio"],
+                           entry["min_profit_ratio"], entry["as_of_date"]], sort_keys=True)
+
+    _profit_keys = ("year_profit_ratio", "profit_type", "coupon_type")
+
+
+class BondsPortfolioOptimizer:
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def optimize(bonds_list, budget, commission_ratio=0.0, max_emitter_share=None, risk_caps=None, ladder=None,
+                 max_bond_share=None, mode="auto", exact_limit=16, max_nodes=1000000, max_lot_options=8):
+        # Caps are shares of budget: 'risk_caps' is {risk: share}, 'ladder' is [(last_close_date, share), ...]
+        caps = {("budget",): budget}
+        items = []
+        for bond in bonds_list:
+            item = BondsPortfolioOptimizer._get_item(bond, budget, commission_ratio, max_emitter_share, risk_caps,
+                                                     ladder, max_bond_share, caps)
+            if item is not None:
+                items.append(item)
+        # Profit of every ruble spent on bond is its yield, so bonds with higher yield are tried first
+        items.sort(key=lambda current_item: current_item["ratio"], reverse=True)
+        if mode == "auto":
+            mode = "exact" if len(items) <= exact_limit else "heuristic"
+        if mode == "exact":
+            (lots, is_optimal) = BondsPortfolioOptimizer._solve_exact(items, caps, max_nodes, max_lot_options)
+            if not is_optimal:
+                # Search was limited, so local improvement of greedy solution can still be better
+                heuristic_lots = BondsPortfolioOptimizer._solve_heuristic(items, caps)
+                if BondsPortfolioOptimizer._get_value(items, heuristic_lots) > \
+                        BondsPortfolioOptimizer._get_value(items, lots):
+                    lots = heuristic_lots
+        elif mode == "heuristic":
+            lots = BondsPortfolioOptimizer._solve_heuristic(items, caps)
+            is_optimal = False
+        else:
+            raise ValueError(f"Unknown optimization mode '{mode}'")
+
+        positions = []
+        for (item, lots_count) in zip(items, lots):
+            if lots_count == 0:
+                continue
+            bond = item["bond"]
+            positions.append({"SECID": bond.get("SECID"), "ISIN": bond.get("ISIN"), "lots": lots_count,
+                              "lot_cost": item["cost"], "cost": item["cost"] * lots_count,
+                              "year_profit_ratio": item["ratio"], "EMITTER_ID": bond.get("EMITTER_ID"),
+                              "emitter_risk": bond.get("emitter_risk"), "close_date": item["close_date"]})
+        total_cost = sum(position["cost"] for position in positions)
+        year_income = sum(position["cost"] * position["year_profit_ratio"] for position in positions)
+        logging.info(f"Portfolio of {str(len(positions))} bonds costs {str(round(total_cost, 2))} "
+                     f"from budget {str(budget)}")
+        return {"positions": positions, "total_cost": total_cost, "year_income": year_income,
+                "year_profit_ratio": year_income / total_cost if total_cost > 0 else 0.0,
+                "mode": mode, "is_optimal": is_optimal}
+
+    @staticmethod
+    def _get_item(bond, budget, commission_ratio, max_emitter_share, risk_caps, ladder, max_bond_share, caps):
+        ratio = bond.get("year_profit_ratio")
+        price = bond.get("PREVPRICE")
+        if ratio is None or ratio <= 0 or price is None:
+            return
+        lot_size = bond.get("LOTSIZE") or 1
+        cost = (price * bond["FACEVALUE"] / 100.0 * (1 + commission_ratio) + (bond.get("ACCRUEDINT") or 0)) * lot_size
+        if cost <= 0 or cost > budget:
+            return
+        close_date = bond.get("OFFERDATE") or bond.get("MATDATE")
+        keys = [("budget",)]
+        if max_emitter_share is not None:
+            keys.append(("emitter", str(bond.get("EMITTER_ID"))))
+            caps[keys[-1]] = budget * max_emitter_share
+        risk = bond.get("emitter_risk")
+        if risk_caps is not None and risk in risk_caps:
+            keys.append(("risk", risk))
+            caps[keys[-1]] = budget * risk_caps[risk]
+        if ladder is not None:
+            if close_date is None or close_date == "0000-00-00":
+                return
+            bucket_index = None
+            for (index, (last_date, share)) in enumerate(ladder):
+                if not isinstance(last_date, str):
+                    last_date = datetime.strftime(last_date, "%Y-%m-%d")
+                if close_date <= last_date:
+                    bucket_index = index
+                    break
+            if bucket_index is None:
+                return
+            keys.append(("bucket", bucket_index))
+            caps[keys[-1]] = budget * ladder[bucket_index][1]
+        max_lots = None if max_bond_share is None else int(budget * max_bond_share / cost + 1e-9)
+        return {"bond": bond, "cost": cost, "ratio": ratio, "keys": keys, "max_lots": max_lots,
+                "close_date": close_date}
+
+    @staticmethod
+    def _get_max_lots(item, remaining):
+        max_money = min(remaining[key] for key in item["keys"])
+        lots_count = max(0, int(max_money / item["cost"] + 1e-9))
+        if item["max_lots"] is not None:
+            lots_count = min(lots_count, item["max_lots"])
+        return lots_count
+
+    @staticmethod
+    def _buy(item, lots_count, remaining):
+        for key in item["keys"]:
+            remaining[key] -= item["cost"] * lots_count
+
+    @staticmethod
+    def _solve_exact(items, caps, max_nodes, max_lot_options=8):
+        remaining = dict(caps)
+        lots = [0] * len(items)
+        best = {"value": -1.0, "lots": list(lots)}
+        nodes = [0]
+        is_truncated = [False]
+
+        def get_bound(index):
+            # Fractional filling of left budget ignoring shared caps is never worse than any integer solution
+            budget_left = remaining[("budget",)]
+            bound = 0.0
+            for item in items[index:]:
+                if budget_left <= 0:
+                    break
+                money = min(budget_left, min(remaining[key] for key in item["keys"]))
+                if item["max_lots"] is not None:
+                    money = min(money, item["max_lots"] * item["cost"])
+                bound += money * item["ratio"]
+                budget_left -= money
+            return bound
+
+        def search(index, value):
+            nodes[0] += 1
+            if value > best["value"]:
+                best["value"] = value
+                best["lots"] = lots[:index] + [0] * (len(items) - index)
+            if index == len(items) or nodes[0] > max_nodes:
+                return
+            if value + get_bound(index) <= best["value"] + 1e-9:
+                return
+            item = items[index]
+            max_lots = BondsPortfolioOptimizer._get_max_lots(item, remaining)
+            lots_range = range(max_lots, -1, -1)
+            if max_lots >= max_lot_options:
+                # Cheap bond in big budget: only counts close to the maximum and zero are tried
+                lots_range = list(range(max_lots, max_lots - max_lot_options + 1, -1)) + [0]
+                is_truncated[0] = True
+            for lots_count in lots_range:
+                BondsPortfolioOptimizer._buy(item, lots_count, remaining)
+                lots[index] = lots_count
+                search(index + 1, value + item["cost"] * item["ratio"] * lots_count)
+                BondsPortfolioOptimizer._buy(item, -lots_count, remaining)
+            lots[index] = 0
+
+        search(0, 0.0)
+        is_optimal = nodes[0] <= max_nodes and not is_truncated[0]
+        if nodes[0] > max_nodes:
+            logging.warning(f"Exact portfolio optimization was stopped after {str(max_nodes)} nodes, "
+                            f"the best found portfolio is returned")
+        elif is_truncated[0]:
+            logging.warning(f"Not more than {str(max_lot_options)} lots counts were tried for every bond, "
+                            f"the best found portfolio is returned")
+        return best["lots"], is_optimal
+
+    @staticmethod
+    def _solve_heuristic(items, caps, swap_candidates=64):
+        remaining = dict(caps)
+        lots = [0] * len(items)
+        BondsPortfolioOptimizer._fill(items, lots, remaining, range(len(items)))
+        # Local improvement: one lot of chosen bond is replaced by other bonds which use left budget better.
+        # Only the best bonds which still can be bought are tried, and caps are updated in place.
+        is_improved = True
+        while is_improved:
+            is_improved = False
+            candidates = BondsPortfolioOptimizer._get_swap_candidates(items, lots, remaining, swap_candidates)
+            for index in reversed(range(len(items))):
+                if lots[index] == 0:
+                    continue
+                item = items[index]
+                lots[index] -= 1
+                BondsPortfolioOptimizer._buy(item, -1, remaining)
+                bought = BondsPortfolioOptimizer._fill(items, lots, remaining,
+                                                       (other for other in candidates if other != index))
+                gain = sum(items[other]["cost"] * items[other]["ratio"] * lots_count for (other, lots_count) in bought)
+                if gain > item["cost"] * item["ratio"] + 1e-9:
+                    is_improved = True
+                    break
+                for (other, lots_count) in bought:
+                    lots[other] -= lots_count
+                    BondsPortfolioOptimizer._buy(items[other], -lots_count, remaining)
+                lots[index] += 1
+                BondsPortfolioOptimizer._buy(item, 1, remaining)
+        return lots
+
+    @staticmethod
+    def _get_swap_candidates(items, lots, remaining, count):
+        # Freed lot is never more expensive than the most expensive chosen one
+        max_money = remaining[("budget",)] + max((item["cost"] for (item, lots_count) in zip(items, lots)
+                                                  if lots_count > 0), default=0.0)
+        candidates = []
+        for (index, item) in enumerate(items):
+            if item["cost"] <= max_money and (item["max_lots"] is None or lots[index] < item["max_lots"]):
+                candidates.append(index)
+                if len(candidates) == count:
+                    break
+        return candidates
+
+    @staticmethod
+    def _fill(items, lots, remaining, indexes):
+        bought = []
+        for index in indexes:
+            item = items[index]
+            max_lots = BondsPortfolioOptimizer._get_max_lots(item, remaining)
+            if item["max_lots"] is not None:
+                max_lots = min(max_lots, item["max_lots"] - lots[index])
+            if max_lots > 0:
+                BondsPortfolioOptimizer._buy(item, max_lots, remaining)
+                lots[index] += max_lots
+                bought.append((index, max_lots))
+        return bought
+
+    @staticmethod
+    def _get_value(items, lots):
+        return sum(item["cost"] * item["ratio"] * lots_count for (item, lots_count) in zip(items, lots))
+
+
+class BondsSharedUniverse:
+    def __init__(self, shared_memory, is_owner=False):
+        self.shared_memory = shared_memory
+        self.name = shared_memory.name
+        self.is_owner = is_owner
+        self._buffer = shared_memory.buf.toreadonly()
+        self._views = []
+        header_length = int.from_bytes(self._buffer[8:16], "little")
+        self._header = json.loads(bytes(self._buffer[16:16 + header_length]))
+        # Offsets of arrays in header are relative to data part which follows header
+        self._data_offset = (16 + header_length + 7) // 8 * 8
+        self._length = self._header["length"]
+        strings_header = self._header["strings"]
+        self._string_offsets = self._get_view(strings_header["offsets"])
+        self._strings_data = self._get_view(strings_header["data"])
+        self._strings = {}
+        self._tables = {}
+        for (table_name, table_header) in self._header["tables"].items():
+            self._tables[table_name] = {name: (self._get_view(column_header["values"]),
+                                               self._get_view(column_header.get("present")))
+                                        for (name, column_header) in table_header["columns"].items()}
+            self._tables[table_name][None] = (self._get_view(table_header.get("offsets")),
+                                              self._get_view(table_header.get("present")))
+
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def publish(bonds_list, name=None):
+        from multiprocessing import shared_memory
+        strings = {}
+        blobs = []
+        tables = {"bonds": BondsSharedUniverse._pack_table(
+            [{key: value for (key, value) in bond.items() if key not in BondsSharedUniverse.schedule_keys}
+             for bond in bonds_list], strings, blobs)}
+        for schedule_key in BondsSharedUniverse.schedule_keys:
+            # Schedules of all bonds are stored as one table, offsets point to first row of every bond
+            offsets = array.array('q', [0])
+            present = array.array('b')
+            schedule_rows = []
+            for bond in bonds_list:
+                schedule = bond.get(schedule_key)
+                present.append(0 if schedule is None else 1)
+                schedule_rows.extend(schedule or [])
+                offsets.append(len(schedule_rows))
+            table_header = BondsSharedUniverse._pack_table(schedule_rows, strings, blobs)
+            table_header["offsets"] = BondsSharedUniverse._add_blob(blobs, offsets)
+            table_header["present"] = BondsSharedUniverse._add_blob(blobs, present)
+            tables[schedule_key] = table_header
+        strings_data = bytearray()
+        string_offsets = array.array('q', [0])
+        for value in strings:
+            strings_data.extend(value.encode("utf-8"))
+            string_offsets.append(len(strings_data))
+        header = {"length": len(bonds_list), "tables": tables,
+                  "strings": {"offsets": BondsSharedUniverse._add_blob(blobs, string_offsets),
+                              "data": BondsSharedUniverse._add_blob(blobs, array.array('B', strings_data))}}
+        header_content = json.dumps(header).encode("utf-8")
+        # Arrays are aligned by 8 bytes after header, so they can be used as typed memoryviews
+        data_offset = (16 + len(header_content) + 7) // 8 * 8
+        total_size = data_offset + sum(len(blob) for blob in blobs)
+        segment = shared_memory.SharedMemory(name=name, create=True, size=max(1, total_size))
+        try:
+            segment.buf[0:8] = BondsSharedUniverse._magic
+            segment.buf[8:16] = len(header_content).to_bytes(8, "little")
+            segment.buf[16:16 + len(header_content)] = header_content
+            position = data_offset
+            for blob in blobs:
+                segment.buf[position:position + len(blob)] = blob
+                position += len(blob)
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+        logging.info(f"{str(len(bonds_list))} bonds were published into shared memory '{segment.name}' "
+                     f"of {str(total_size)} bytes")
+        return BondsSharedUniverse(segment, is_owner=True)
+
+    @staticmethod
+    def attach(name):
+        from multiprocessing import shared_memory
+        try:
+            segment = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attached segment is always tracked, it is safe for worker processes because
+            # they share resource tracker with process which published segment
+            segment = shared_memory.SharedMemory(name=name)
+        if bytes(segment.buf[0:8]) != BondsSharedUniverse._magic:
+            segment.close()
+            raise ValueError(f"Shared memory '{name}' does not contain bonds")
+        return BondsSharedUniverse(segment)
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._buffer.release()
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self.is_owner:
+            self.unlink()
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self.rows()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Bond index is out of range")
+        return self.row(index)
+
+    def column(self, name, table_name="bonds"):
+        # Numeric columns are read-only views of shared memory, strings are indexes in strings table
+        return self._tables[table_name][name][0]
+
+    def row(self, index):
+        result = BondsSharedUniverse._get_table_row(self, "bonds", index)
+        for schedule_key in BondsSharedUniverse.schedule_keys:
+            (offsets, present) = self._tables[schedule_key][None]
+            if present[index]:
+                result[schedule_key] = [self._get_table_row(schedule_key, row_index)
+                                        for row_index in range(offsets[index], offsets[index + 1])]
+        return result
+
+    def rows(self, indexes=None, updates=None):
+        # Results of parallel stages (e.g. profits by index) can be merged into rows for export
+        for index in (range(self._length) if indexes is None else indexes):
+            bond = self.row(index)
+            if updates is not None:
+                bond.update(updates.get(index, {}))
+            yield bond
+
+    def filter_bonds_advanced(self, filter_description_dict, as_of_date=None, processes=None):
+        return self._map("_filter_chunk", [filter_description_dict, as_of_date], processes)
+
+    def calculate_bonds_profit(self, commission_ratio, indexes=None, as_of_date=None, processes=None):
+        result = self._map("_profit_chunk", [commission_ratio, as_of_date], processes, indexes)
+        return dict(result)
+
+    def _map(self, function_name, args, processes=None, indexes=None):
+        if indexes is None:
+            indexes = range(self._length)
+        indexes = list(indexes)
+        if processes == 1 or len(indexes) == 0:
+            return getattr(BondsSharedUniverse, function_name)(self, indexes, *args)
+        processes = processes or os.cpu_count() or 1
+        chunk_size = max(1, -(-len(indexes) // (processes * 4)))
+        chunks = [indexes[i:i + chunk_size] for i in range(0, len(indexes), chunk_size)]
+        result = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(BondsSharedUniverse._run_chunk, self.name, function_name, chunk, args)
+                       for chunk in chunks]
+            for future in futures:
+                result.extend(future.result())
+        return result
+
+    @staticmethod
+    def _run_chunk(name, function_name, indexes, args):
+        universe = BondsSharedUniverse.attach(name)
+        try:
+            return getattr(BondsSharedUniverse, function_name)(universe, indexes, *args)
+        finally:
+            universe.close()
+
+    @staticmethod
+    def _filter_chunk(universe, indexes, filter_description_dict, as_of_date):
+        filter_settings = BondsMOEXFilter.get_advanced_filter_settings(filter_description_dict, as_of_date)
+        result = []
+        for index in indexes:
+            bond = universe.row(index)
+            try:
+                if BondsMOEXFilter.check_bond_advanced(bond, filter_settings):
+                    result.append(index)
+            except KeyError:
+                logging.error("Can not find important key for bond " + str(bond), exc_info=True)
+            except ValueError:
+                logging.error("Bad time format for bond's expiration or offer date. Bond is: " + str(bond),
+                              exc_info=True)
+        return result
+
+    @staticmethod
+    def _profit_chunk(universe, indexes, commission_ratio, as_of_date):
+        bonds_list = [universe.row(index) for index in indexes]
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_list, commission_ratio, as_of_date)
+        return [(index, {key: bond[key] for key in BondsScreenCache._profit_keys})
+                for (index, bond) in zip(indexes, bonds_list) if "year_profit_ratio" in bond]
+
+    def _get_table_row(self, table_name, index):
+        result = {}
+        for (name, (values, present)) in self._tables[table_name].items():
+            if name is None or (present is not None and not present[index]):
+                continue
+            value = values[index]
+            typecode = values.format
+            if typecode == 'l':
+                value = BondsISSColumns._unpack_date(value)
+            elif typecode == 'd':
+                if value != value:
+                    value = None
+            elif typecode == 'i':
+                value = self._get_string(value)
+            result[name] = value
+        return result
+
+    def _get_string(self, string_index):
+        value = self._strings.get(string_index)
+        if value is None:
+            content = bytes(self._strings_data[self._string_offsets[string_index]:
+                                               self._string_offsets[string_index + 1]])
+            # Values which are not numbers are stored as JSON, so strings, None and booleans are restored
+            value = self._strings[string_index] = json.loads(content)
+        return value
+
+    def _get_view(self, blob_header):
+        if blob_header is None:
+            return None
+        (offset, count, typecode) = blob_header
+        offset += self._data_offset
+        view = self._buffer[offset:offset + count * array.array(typecode).itemsize]
+        self._views.append(view)
+        view = view.cast(typecode)
+        self._views.append(view)
+        return view
+
+    @staticmethod
+    def _pack_table(rows, strings, blobs):
+        names = []
+        for row in rows:
+            for name in row:
+                if name not in names:
+                    names.append(name)
+        columns = {}
+        for name in names:
+            present = array.array('b', [1 if name in row else 0 for row in rows])
+            values = BondsISSColumns._pack_column(name, [row.get(name) for row in rows])
+            if not isinstance(values, array.array):
+                values = array.array('i', [BondsSharedUniverse._get_string_index(strings, value) for value in values])
+            columns[name] = {"values": BondsSharedUniverse._add_blob(blobs, values),
+                             "present": None if all(present) else BondsSharedUniverse._add_blob(blobs, present)}
+        return {"length": len(rows), "columns": columns}
+
+    @staticmethod
+    def _get_string_index(strings, value):
+        content = json.dumps(value, ensure_ascii=False, default=BondsMOEXDataRetriever._convert_to_json)
+        if content not in strings:
+            strings[content] = len(strings)
+        return strings[content]
+
+    @staticmethod
+    def _add_blob(blobs, values):
+        offset = sum(len(blob) for blob in blobs)
+        content = values.tobytes()
+        # Every array starts at offset aligned by 8 bytes
+        blobs.append(content + bytes(-len(content) % 8))
+        return [offset, len(values), values.typecode]
+
+    schedule_keys = ("coupons", "amortizations", "offers", "sales_history")
+    _magic = b"MOEXBU01"
+
+
+class BondsSnapshotDiff:
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def diff(old_bonds_list, new_bonds_list, old_hashes=None, new_hashes=None, include_market=False):
+        old_bonds = {bond.get("SECID"): bond for bond in old_bonds_list}
+        new_bonds = {bond.get("SECID"): bond for bond in new_bonds_list}
+        if old_hashes is None:
+            old_hashes = BondsSnapshotDiff.get_bond_hashes(old_bonds_list)
+        if new_hashes is None:
+            new_hashes = BondsSnapshotDiff.get_bond_hashes(new_bonds_list)
+        changes = []
+        compared_count = 0
+        for (secid, new_bond) in new_bonds.items():
+            old_bond = old_bonds.get(secid)
+            if old_bond is None:
+                changes.append(BondsSnapshotDiff._get_change("listed", new_bond))
+                continue
+            if include_market and old_bond.get("PREVPRICE") != new_bond.get("PREVPRICE"):
+                changes.append(BondsSnapshotDiff._get_change("price_changed", new_bond, old_bond.get("PREVPRICE"),
+                                                             new_bond.get("PREVPRICE")))
+            # Only bonds with changed reference data are compared field by field
+            if old_hashes.get(secid) == new_hashes.get(secid):
+                continue
+            compared_count += 1
+            changes.extend(BondsSnapshotDiff.compare_bonds(old_bond, new_bond))
+        for (secid, old_bond) in old_bonds.items():
+            if secid not in new_bonds:
+                changes.append(BondsSnapshotDiff._get_change("delisted", old_bond))
+        logging.info(f"{str(compared_count)} changed bonds were compared, {str(len(changes))} changes were found")
+        return changes
+
+    @staticmethod
+    def diff_files(old_filename, new_filename, include_market=False):
+        # Bonds skipped by listing filter are still listed, so they are taken into account too
+        old_bonds_list = BondsMOEXDataRetriever.load_snapshot(old_filename, include_pending=True)
+        new_bonds_list = BondsMOEXDataRetriever.load_snapshot(new_filename, include_pending=True)
+        return BondsSnapshotDiff.diff(old_bonds_list, new_bonds_list, include_market=include_market)
+
+    @staticmethod
+    def get_bond_hashes(bonds_list):
+        return {bond.get("SECID"): BondsSnapshotDiff.get_bond_hash(bond) for bond in bonds_list}
+
+    @staticmethod
+    def get_bond_hash(bond):
+        # Market data is changed every day, so only reference data is hashed
+        content = {key: value for (key, value) in bond.items() if key not in BondsSnapshotDiff._market_keys}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False,
+                                       default=BondsMOEXDataRetriever._convert_to_json).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_changed_secids(changes):
+        return sorted({change["SECID"] for change in changes})
+
+    @staticmethod
+    def compare_bonds(old_bond, new_bond):
+        changes = []
+        keys = old_bond.keys() | new_bond.keys()
+        if "coupons" not in old_bond or "coupons" not in new_bond:
+            # Bond skipped by listing filter of partial snapshot has listing data only
+            keys = old_bond.keys() & new_bond.keys()
+        if "ISQUALIFIEDINVESTORS" in keys and \
+                old_bond.get("ISQUALIFIEDINVESTORS") != new_bond.get("ISQUALIFIEDINVESTORS"):
+            changes.append(BondsSnapshotDiff._get_change("qualification_changed", new_bond,
+                                                         old_bond.get("ISQUALIFIEDINVESTORS"),
+                                                         new_bond.get("ISQUALIFIEDINVESTORS")))
+        if "coupons" in keys:
+            changes.extend(BondsSnapshotDiff._compare_coupons(old_bond, new_bond))
+        if "offers" in keys:
+            changes.extend(BondsSnapshotDiff._compare_offers(old_bond, new_bond))
+        if "amortizations" in keys:
+            changes.extend(BondsSnapshotDiff._compare_amortizations(old_bond, new_bond))
+        # Other fields of description (e.g. OFFERDATE, MATDATE, FACEVALUE after amortization) are reported as is
+        for key in sorted(keys - BondsSnapshotDiff._compared_keys):
+            if old_bond.get(key) != new_bond.get(key):
+                changes.append(BondsSnapshotDiff._get_change("field_changed", new_bond, old_bond.get(key),
+                                                             new_bond.get(key), field=key))
+        return changes
+
+    @staticmethod
+    def _compare_coupons(old_bond, new_bond):
+        changes = []
+        old_coupons = BondsSnapshotDiff._get_schedule(old_bond, "coupons", "coupondate")
+        new_coupons = BondsSnapshotDiff._get_schedule(new_bond, "coupons", "coupondate")
+        for (coupon_date, new_coupon) in new_coupons.items():
+            old_coupon = old_coupons.get(coupon_date)
+            if old_coupon is None:
+                changes.append(BondsSnapshotDiff._get_change("coupon_added", new_bond, None, new_coupon.get("value"),
+                                                             coupon_date))
+            elif old_coupon.get("value") != new_coupon.get("value"):
+                change_type = "coupon_value_set" if old_coupon.get("value") is None else "coupon_value_changed"
+                changes.append(BondsSnapshotDiff._get_change(change_type, new_bond, old_coupon.get("value"),
+                                                             new_coupon.get("value"), coupon_date))
+        for (coupon_date, old_coupon) in old_coupons.items():
+            if coupon_date not in new_coupons:
+                changes.append(BondsSnapshotDiff._get_change("coupon_removed", new_bond, old_coupon.get("value"),
+                                                             None, coupon_date))
+        return changes
+
+    @staticmethod
+    def _compare_amortizations(old_bond, new_bond):
+        changes = []
+        old_amortizations = BondsSnapshotDiff._get_schedule(old_bond, "amortizations", "amortdate")
+        new_amortizations = BondsSnapshotDiff._get_schedule(new_bond, "amortizations", "amortdate")
+        # Only added, removed and changed payments are reported
+        for amortization_date in sorted(old_amortizations.keys() | new_amortizations.keys()):
+            old_payment = old_amortizations.get(amortization_date)
+            new_payment = new_amortizations.get(amortization_date)
+            if old_payment is None or new_payment is None or old_payment.get("value") != new_payment.get("value"):
+                changes.append(BondsSnapshotDiff._get_change("amortization_changed", new_bond,
+                                                             None if old_payment is None else old_payment.get("value"),
+                                                             None if new_payment is None else new_payment.get("value"),
+                                                             amortization_date))
+        return changes
+
+    @staticmethod
+    def _compare_offers(old_bond, new_bond):
+        changes = []
+        old_offers = BondsSnapshotDiff._get_schedule(old_bond, "offers", "offerdate")
+        new_offers = BondsSnapshotDiff._get_schedule(new_bond, "offers", "offerdate")
+        for offer_date in new_offers.keys() - old_offers.keys():
+            changes.append(BondsSnapshotDiff._get_change("offer_added", new_bond, None,
+                                                         new_offers[offer_date].get("offertype"), offer_date))
+        for offer_date in old_offers.keys() - new_offers.keys():
+            changes.append(BondsSnapshotDiff._get_change("offer_removed", new_bond,
+                                                         old_offers[offer_date].get("offertype"), None, offer_date))
+        return changes
+
+    @staticmethod
+    def _get_schedule(bond, schedule_key, date_key):
+        return {payment.get(date_key): payment for payment in bond.get(schedule_key) or []}
+
+    @staticmethod
+    def _get_change(change_type, bond, old_value=None, new_value=None, payment_date=None, field=None):
+        change = {"type": change_type, "SECID": bond.get("SECID"), "ISIN": bond.get("ISIN")}
+        if field is not None:
+            change["field"] = field
+        if payment_date is not None:
+            change["date"] = payment_date
+        if old_value is not None or new_value is not None:
+            change["old"] = old_value
+            change["new"] = new_value
+        return change
+
+    change_types = ("listed", "delisted", "price_changed", "qualification_changed", "coupon_added",
+                    "coupon_value_set", "coupon_value_changed", "coupon_removed", "offer_added", "offer_removed",
+                    "amortization_changed", "field_changed")
+    # Quotes updated by BondsMOEXQuoteRefresher and calculated profit are not reference data
+    _market_keys = frozenset(("PREVPRICE", "sales_history") + BondsMOEXQuoteRefresher.market_fields +
+                             BondsScreenCache._profit_keys)
+    _compared_keys = _market_keys | {"ISQUALIFIEDINVESTORS", "coupons", "offers", "amortizations"}
+
+
+class BondsCashFlowProjector:
+    @staticmethod
+    @BondsMetrics.measure_stage
+    def project(bonds_list, holdings, as_of_date=None, horizon_date=None, tax_ratio=0.13, fx_rates=None,
+                redeem_at_offer=False, include_flows=False):
+        # Holdings are {ISIN: lots count}, fx_rates are {currency: price in RUB}
+        date_from = datetime.strftime(datetime.today() if as_of_date is None else as_of_date, "%Y-%m-%d")
+        date_to = None if horizon_date is None else datetime.strftime(horizon_date, "%Y-%m-%d")
+        rates = {"RUB": 1.0, "SUR": 1.0}
+        rates.update(fx_rates or {})
+        bonds = {bond.get("ISIN"): bond for bond in bonds_list}
+        daily = {}
+        flows = []
+        missing_list = []
+        for (isin, lots_count) in holdings.items():
+            bond = bonds.get(isin)
+            if bond is None:
+                logging.warning(f"Bond '{isin}' from holdings is not found")
+                missing_list.append(isin)
+                continue
+            quantity = lots_count * (bond.get("LOTSIZE") or 1)
+            for (flow_date, flow_type, amount, currency, is_extrapolated) in \
+                    BondsCashFlowProjector.get_bond_flows(bond, date_from, date_to, tax_ratio, redeem_at_offer):
+                rate = rates.get(currency)
+                if rate is None:
+                    logging.error(f"Rate of currency '{currency}' is not set, payment of bond '{isin}' "
+                                  f"at {flow_date} is skipped")
+                    continue
+                amount = amount * quantity * rate
+                day = daily.get(flow_date)
+                if day is None:
+                    day = daily[flow_date] = {"coupons": 0.0, "amortizations": 0.0, "redemptions": 0.0}
+                day[flow_type] += amount
+                if include_flows:
+                    flows.append({"date": flow_date, "ISIN": isin, "type": flow_type, "amount": amount,
+                                  "is_extrapolated": is_extrapolated})
+
+        result = {"daily": BondsCashFlowProjector._get_totals(daily, "date", lambda flow_date: flow_date),
+                  "monthly": BondsCashFlowProjector._get_totals(daily, "month", lambda flow_date: flow_date[:7]),
+                  "total": sum(sum(day.values()) for day in daily.values()), "missing": missing_list}
+        if include_flows:
+            flows.sort(key=lambda flow: flow["date"])
+            result["flows"] = flows
+        return result
+
+    @staticmethod
+    def get_bond_flows(bond, date_from, date_to=None, tax_ratio=0.13, redeem_at_offer=False):
+        # Payments of one bond after date_from (not included) till date_to (included) per one bond
+        close_date = date_to
+        offer_date = None
+        if redeem_at_offer:
+            offer_dates = [offer.get("offerdate") for offer in bond.get("offers") or []
+                           if offer.get("offerdate") and offer.get("offerdate") > date_from]
+            if bond.get("OFFERDATE") and bond["OFFERDATE"] > date_from:
+                offer_dates.append(bond["OFFERDATE"])
+            if offer_dates and (date_to is None or min(offer_dates) <= date_to):
+                offer_date = close_date = min(offer_dates)
+        face_unit = bond.get("FACEUNIT") or "RUB"
+        result = []
+        last_known_coupon_value = 0
+        for coupon in sorted(bond.get("coupons") or [], key=lambda payment: payment["coupondate"]):
+            value = coupon.get("value")
+            if value is not None:
+                last_known_coupon_value = value
+            coupon_date = coupon["coupondate"]
+            if coupon_date <= date_from or (close_date is not None and coupon_date > close_date):
+                continue
+            result.append((coupon_date, "coupons", last_known_coupon_value * (1 - tax_ratio),
+                           coupon.get("faceunit") or face_unit, value is None))
+        remaining_value = 0
+        for payment in bond.get("amortizations") or []:
+            amortization_date = payment["amortdate"]
+            value = payment.get("value") or 0
+            if amortization_date <= date_from:
+                continue
+            if offer_date is not None and amortization_date >= offer_date:
+                remaining_value += value
+                continue
+            if close_date is not None and amortization_date > close_date:
+                continue
+            result.append((amortization_date, "amortizations", value, payment.get("faceunit") or face_unit, False))
+        if offer_date is not None and remaining_value > 0:
+            # Bond is sold back at offer for the face value which is not paid yet
+            result.append((offer_date, "redemptions", remaining_value, face_unit, False))
+        return result
+
+    @staticmethod
+    def _get_totals(daily, key_name, get_key):
+        totals = {}
+        for flow_date in sorted(daily):
+            key = get_key(flow_date)
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {key_name: key, "coupons": 0.0, "amortizations": 0.0, "redemptions": 0.0}
+            for (flow_type, amount) in daily[flow_date].items():
+                total[flow_type] += amount
+        for total in totals.values():
+            total["total"] = total["coupons"] + total["amortizations"] + total["redemptions"]
+        return list(totals.values())
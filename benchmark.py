@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from MOEXBondScrinner import BondsMOEXDataRetriever, BondsMOEXFilter, BondsCustomCalculationAndFilter, \
+    BondsCSVWriter, BondsEmittersDB
+
+
+def generate_bonds(count, seed=0, today=None):
+    rnd = random.Random(seed)
+    if today is None:
+        today = datetime.today()
+    today = datetime(today.year, today.month, today.day)
+    emitters_count = max(1, count // 5)
+    result = []
+    for i in range(count):
+        sec_id = "RU000A" + format(i, "06X")
+        face_value = rnd.choice((1000, 1000, 1000, 500, 10000, 100000))
+        coupon_period = rnd.choice((91, 182, 182, 30, 364))
+        issue_date = today - timedelta(days=rnd.randint(30, 3650))
+        bond_kind = rnd.random()
+        if bond_kind < 0.03:
+            # Perpetual bond
+            expiration_date = None
+            last_coupon_date = today + timedelta(days=3650)
+        elif bond_kind < 0.15:
+            # Long bond
+            expiration_date = today + timedelta(days=rnd.randint(3650, 11000))
+            last_coupon_date = expiration_date
+        else:
+            expiration_date = today + timedelta(days=rnd.randint(-30, 3650))
+            last_coupon_date = expiration_date
+        offer_date = None
+        if expiration_date is not None and rnd.random() < 0.2:
+            offer_date = today + timedelta(days=rnd.randint(1, max(2, (expiration_date - today).days)))
+        coupon_percent = round(rnd.uniform(4.0, 15.0), 2)
+        coupon_value = round(face_value * coupon_percent / 100 * coupon_period / 365, 2)
+        known_coupons_date = offer_date or (today + timedelta(days=rnd.choice((90, 365, 36500))))
+
+        coupons = []
+        coupon_date = issue_date + timedelta(days=coupon_period)
+        while coupon_date <= last_coupon_date:
+            coupons.append({"coupondate": coupon_date.strftime("%Y-%m-%d"), "faceunit": "RUB",
+                            "value": coupon_value if coupon_date <= known_coupons_date else None})
+            coupon_date += timedelta(days=coupon_period)
+
+        amortizations = []
+        if expiration_date is not None:
+            if rnd.random() < 0.15 and len(coupons) > 4:
+                # Face value is paid by equal parts together with last four coupons
+                for coupon in coupons[-4:]:
+                    amortizations.append({"amortdate": coupon["coupondate"], "faceunit": "RUB",
+                                          "value": face_value / 4})
+            else:
+                amortizations.append({"amortdate": expiration_date.strftime("%Y-%m-%d"), "faceunit": "RUB",
+                                      "value": face_value})
+
+        offers = []
+        if offer_date is not None:
+            offers.append({"offerdate": offer_date.strftime("%Y-%m-%d"), "offertype": "Оферта"})
+
+        sales_history = []
+        for days_ago in range(14, -1, -1):
+            trade_date = today - timedelta(days=days_ago)
+            if trade_date.weekday() >= 5:
+                continue
+            is_liquid = rnd.random() < 0.7
+            sales_history.append({"TRADEDATE": trade_date.strftime("%Y-%m-%d"),
+                                  "VOLUME": rnd.randint(0, 5000) if is_liquid else 0,
+                                  "NUMTRADES": rnd.randint(0, 100) if is_liquid else 0})
+
+        result.append({
+            "SECID": sec_id, "ISIN": sec_id, "SHORTNAME": f"Bond {str(i)}", "SECNAME": f"Synthetic bond {str(i)}",
+            "PREVPRICE": None if rnd.random() < 0.05 else round(rnd.uniform(80.0, 110.0), 2),
+            "LOTSIZE": 1, "FACEVALUE": face_value,
+            "MATDATE": "0000-00-00" if expiration_date is None else expiration_date.strftime("%Y-%m-%d"),
+            "OFFERDATE": None if offer_date is None else offer_date.strftime("%Y-%m-%d"),
+            "FACEUNIT": "SUR", "ACCRUEDINT": round(rnd.uniform(0, coupon_value), 2), "SECTYPE": "6",
+            "COUPONPERCENT": coupon_percent, "COUPONPERIOD": coupon_period,
+            "ISQUALIFIEDINVESTORS": "1" if rnd.random() < 0.1 else "0", "TYPE": "corporate_bond",
+            "EMITTER_ID": str(rnd.randint(1, emitters_count)),
+            "amortizations": amortizations, "coupons": coupons, "offers": offers, "sales_history": sales_history})
+    return result
+
+
+def generate_emitters(count, seed=0):
+    rnd = random.Random(seed)
+    return [(i, f"Emitter \"{str(i)}\"", rnd.choice(("", "", "low", "high", "exclude"))) for i in range(1, count + 1)]
+
+
+def get_stages(bonds_list, temp_dir):
+    cache_filename = os.path.join(temp_dir, "cache.json")
+    emitters_db_name = os.path.join(temp_dir, "emitters.db")
+    BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, "with_sales")
+    BondsEmittersDB.sync_emitters(generate_emitters(max(1, len(bonds_list) // 5)), emitters_db_name)
+    filter_description_dict = {'max_bond_value': 100000, 'max_expiration_date': datetime.today() + timedelta(days=7300)}
+    state = {}
+
+    def load_stage():
+        state["bonds"] = BondsMOEXDataRetriever.load_results_from_file(cache_filename)["data"]
+
+    def filter_stage():
+        state["filtered"] = BondsMOEXFilter.filter_bonds_advanced(state["bonds"], filter_description_dict)
+
+    def profit_stage():
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(state["filtered"], 0.0006)
+
+    def emitter_setup():
+        # Enrichment replaces EMITTER_ID with emitter name, so every run needs its own copy of bonds
+        state["enriched"] = [dict(bond) for bond in state["filtered"]]
+
+    def emitter_stage():
+        BondsCustomCalculationAndFilter.enrich_bonds_emitter_from_db(state["enriched"], emitters_db_name)
+
+    def csv_stage():
+        BondsCSVWriter.output_csv(state["filtered"], filename=os.path.join(temp_dir, "result.csv"))
+
+    return [("load_results_from_file", None, load_stage), ("filter_bonds_advanced", None, filter_stage),
+            ("calculate_bonds_profit", None, profit_stage),
+            ("enrich_bonds_emitter_from_db", emitter_setup, emitter_stage), ("output_csv", None, csv_stage)]
+
+
+def run_benchmark(sizes, seed=0, repeat=3, measure_memory=True):
+    result = {"python": platform.python_version(), "platform": platform.platform(),
+              "date": datetime.today().strftime("%Y-%m-%d"), "sizes": {}}
+    for size in sizes:
+        bonds_list = generate_bonds(size, seed)
+        size_result = {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stages = get_stages(bonds_list, temp_dir)
+            del bonds_list
+            for (stage_name, setup, stage) in stages:
+                timings = []
+                for _ in range(repeat):
+                    if setup is not None:
+                        setup()
+                    start_time = time.perf_counter()
+                    stage()
+                    timings.append(time.perf_counter() - start_time)
+                size_result[stage_name] = {"time_sec": round(min(timings), 6)}
+            if measure_memory:
+                # Memory is measured in separate run since tracing slows down execution
+                for (stage_name, setup, stage) in stages:
+                    if setup is not None:
+                        setup()
+                    tracemalloc.start()
+                    stage()
+                    size_result[stage_name]["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+                    tracemalloc.stop()
+        result["sizes"][str(size)] = size_result
+    return result
+
+
+def compare_with_baseline(result, baseline, tolerance=0.2):
+    regressions = []
+    for (size, size_result) in result["sizes"].items():
+        for (stage_name, stage_result) in size_result.items():
+            baseline_stage = baseline.get("sizes", {}).get(size, {}).get(stage_name)
+            if baseline_stage is None:
+                continue
+            for (metric, value) in stage_result.items():
+                baseline_value = baseline_stage.get(metric)
+                if baseline_value and value > baseline_value * (1 + tolerance):
+                    regressions.append((size, stage_name, metric, baseline_value, value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark main library stages on synthetic bonds.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000],
+                        help="counts of synthetic bonds, e.g. '--sizes 1000 10000 100000'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timing is the best of this count of runs")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="file with baseline results")
+    parser.add_argument("--save-baseline", action="store_true", help="save results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown ratio against baseline")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    benchmark_result = run_benchmark(args.sizes, args.seed, args.repeat, not args.no_memory)
+    for (bonds_count, stages_result) in benchmark_result["sizes"].items():
+        for (name, stage_result) in stages_result.items():
+            print(f"{bonds_count:>8} {name:<30} {stage_result['time_sec']:>10.4f} s "
+                  f"{stage_result.get('peak_memory_mb', 0):>10.2f} MB")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps(benchmark_result, indent=2))
+        print(f"Baseline is saved into '{args.baseline}'")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as fh:
+            baseline_result = json.loads(fh.read())
+        found_regressions = compare_with_baseline(benchmark_result, baseline_result, args.tolerance)
+        for (bonds_count, name, metric, old_value, new_value) in found_regressions:
+            print(f"REGRESSION: {name} with {bonds_count} bonds, {metric} {old_value} -> {new_value}")
+        if found_regressions:
+            exit(1)
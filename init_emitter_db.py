@@ -1,24 +1,17 @@
 # -*- coding: utf-8 -*-
+import argparse
+import logging
+from MOEXBondScrinner import BondsEmittersDB
 
-import sqlite3
-import json
+parser = argparse.ArgumentParser(description="Create or synchronize SQLite3 database with info about emitters.")
+parser.add_argument("source", nargs="?", default="emitters.json",
+                    help="file with emitters info: .json list of [id, name, risk] or .csv with 'id;name;risk' lines")
+parser.add_argument("--db", default="emitters.db", help="name of SQLite3 database file")
+parser.add_argument("--remove-missing", action="store_true",
+                    help="remove emitters which are not present in source file")
+args = parser.parse_args()
 
-connection = sqlite3.connect('emitters.db')
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-cursor = connection.cursor()
-cursor.execute("CREATE TABLE IF NOT EXISTS emitters "
-               "(id INTEGER PRIMARY KEY, name TEXT NOT NULL, risk TEXT)")
-
-
-fh = open('emitters.json','r', encoding="utf-8")
-emitters_list = json.loads(fh.read())
-fh.close()
-
-for entry in emitters_list:
-    sql_query = "INSERT INTO emitters (id, name, risk) SELECT '{0}','{1}','{2}' " \
-                "WHERE NOT EXISTS(SELECT 1 FROM emitters WHERE id = {0})".format(entry[0], entry[1], entry[2])
-    # print(sql_query)
-    cursor.execute(sql_query)
-
-connection.commit()
-connection.close()
+emitters_list = BondsEmittersDB.load_emitters_file(args.source)
+BondsEmittersDB.sync_emitters(emitters_list, args.db, remove_missing=args.remove_missing)
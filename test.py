@@ -1,7 +1,36 @@
 import unittest
 import json
 import datetime
-from MOEXBondScrinner import BondsMOEXFilter, BondsCustomCalculationAndFilter
+import itertools
+import os
+import gzip
+import importlib.util
+import tempfile
+import asyncio
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest import mock
+from MOEXBondScrinner import BondsMOEXFilter, BondsCustomCalculationAndFilter, BondsEmittersDB, BondsCSVWriter, \
+    BondsParquetWriter, BondsMOEXQuoteRefresher, BondsQueryService, BondsAlertManager, BondsAlertCallbackSink, \
+    BondsMetrics, BondsISSColumns, BondsMOEXDataRetriever, BondsCacheLock, \
+    BondsLiquidityStore, BondsBacktestRunner, BondsScreenCache, BondsPortfolioOptimizer, BondsSharedUniverse, \
+    BondsSnapshotDiff, BondsCashFlowProjector, BondsMOEXAsyncRetriever
+from benchmark import generate_bonds
+
+
+def get_test_bond(isin, face_value, price, expiration_date):
+    return {"SECID": isin, "ISIN": isin, "PREVPRICE": price, "FACEVALUE": face_value, "ACCRUEDINT": 0,
+            "MATDATE": expiration_date, "OFFERDATE": None, "ISQUALIFIEDINVESTORS": "0",
+            "amortizations": [{"amortdate": expiration_date, "faceunit": "RUB", "value": face_value}],
+            "coupons": [{"coupondate": expiration_date, "faceunit": "RUB", "value": 50}],
+            "offers": [], "sales_history": [{"TRADEDATE": "2021-03-03", "VOLUME": 100, "NUMTRADES": 20}]}
+
+
+class TempDirTestMixin:
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
 
 
 class BondsMOEXFilterTest(unittest.TestCase):
@@ -167,5 +196,927 @@ class BondsCustomCalculationAndFilterTest(unittest.TestCase):
         self.assertEqual(coupon_type, "extrapolated")
 
 
+class BondsEmittersDBTest(TempDirTestMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_name = os.path.join(self.temp_dir.name, 'emitters.db')
+
+    def test_sync_emitters_incremental(self):
+        emitters_list = [(1199, 'ПАО "Сбербанк России"', ''), (1374788, "Минфин РФ", ''), (2067, "Москва", 'exclude')]
+        self.assertEqual(BondsEmittersDB.sync_emitters(emitters_list, self.db_name), (3, 0))
+        # Nothing changed, so nothing should be written
+        self.assertEqual(BondsEmittersDB.sync_emitters(emitters_list, self.db_name), (0, 0))
+        emitters_list[1] = (1374788, "Минфин России", 'low')
+        self.assertEqual(BondsEmittersDB.sync_emitters(emitters_list[:2], self.db_name, remove_missing=True), (1, 1))
+        self.assertEqual(BondsEmittersDB.get_emitters_by_risk(['low', 'exclude'], self.db_name), {'1374788'})
+
+    def test_filter_bonds_by_emitter_from_db(self):
+        BondsEmittersDB.sync_emitters([(1199, "Сбербанк", ''), (2067, "Москва", 'exclude')], self.db_name)
+        bonds_list = [{"ISIN": "A", "EMITTER_ID": "1199"}, {"ISIN": "B", "EMITTER_ID": "2067"},
+                      {"ISIN": "C", "EMITTER_ID": "1", "emitter_risk": "exclude"}]
+        output_bond_list = BondsCustomCalculationAndFilter.filter_bonds_by_emitter(bonds_list,
+                                                                                   local_db_name=self.db_name)
+        self.assertEqual([bond["ISIN"] for bond in output_bond_list], ["A"])
+
+    def test_filter_bonds_by_emitter_after_enrich(self):
+        BondsEmittersDB.sync_emitters([(1199, "Сбербанк", ''), (2067, "Москва", '')], self.db_name)
+        bonds_list = [{"ISIN": "A", "EMITTER_ID": "1199"}, {"ISIN": "B", "EMITTER_ID": "2067"}]
+        bonds_list = BondsCustomCalculationAndFilter.enrich_bonds_emitter_from_db(bonds_list, self.db_name)
+        self.assertEqual(bonds_list[1]["EMITTER_ID"], "Москва")
+        # Risk is changed after enriching, so only original emitter id can be matched
+        BondsEmittersDB.sync_emitters([(1199, "Сбербанк", ''), (2067, "Москва", 'exclude')], self.db_name)
+        output_bond_list = BondsCustomCalculationAndFilter.filter_bonds_by_emitter(bonds_list,
+                                                                                   local_db_name=self.db_name)
+        self.assertEqual([bond["ISIN"] for bond in output_bond_list], ["A"])
+
+
+class BondsCSVWriterTest(TempDirTestMixin, unittest.TestCase):
+    def test_output_csv_gzip_generator(self):
+        filename = os.path.join(self.temp_dir.name, 'result.csv.gz')
+        bonds = ({"ISIN": "RU000A0JNYN1", "FACEVALUE": 1000, "PREVPRICE": 100.36, "year_profit_ratio": 0.0614917,
+                  "OFFERDATE": None, "SECTYPE": "4", "emitter_risk": "high"} for _ in range(3))
+        self.assertEqual(BondsCSVWriter.output_csv(bonds, filename=filename), 3)
+        with gzip.open(filename, 'rt', encoding='utf-8', newline='') as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("ISIN;SHORTNAME;SECNAME;FACEVALUE;PREVPRICE;OFFERDATE;"))
+        self.assertEqual(lines[1], "RU000A0JNYN1;;;1000;100,36;;;;;high;0,0614917;;")
+        self.assertEqual(os.listdir(self.temp_dir.name), ['result.csv.gz'])
+
+
+class BondsParquetWriterTest(TempDirTestMixin, unittest.TestCase):
+    def test_iter_columns(self):
+        bonds = [{"SECID": "A", "PREVPRICE": 100, "FACEVALUE": 1000, "MATDATE": "0000-00-00", "OFFERDATE": "2030-01-15",
+                  "ISQUALIFIEDINVESTORS": "1", "coupons": [{"coupondate": "2029-07-15", "faceunit": "RUB", "value": None},
+                                                            {"coupondate": "2030-01-15", "faceunit": "RUB", "value": 40}],
+                  "amortizations": [], "offers": [{"offerdate": "2030-01-15", "offertype": "put"}]},
+                 {"SECID": "B", "PREVPRICE": None, "MATDATE": "2031-02-01"}]
+        chunks = list(BondsParquetWriter.iter_columns(bonds, row_group_size=1))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[0]['bonds']['PREVPRICE'], [100.0])
+        self.assertEqual(chunks[0]['bonds']['MATDATE'], [None])
+        self.assertEqual(chunks[0]['bonds']['OFFERDATE'], [datetime.date(2030, 1, 15)])
+        self.assertEqual(chunks[0]['bonds']['ISQUALIFIEDINVESTORS'], [True])
+        self.assertEqual(chunks[0]['coupons']['SECID'], ["A", "A"])
+        self.assertEqual(chunks[0]['coupons']['value'], [None, 40.0])
+        self.assertEqual(chunks[0]['offers']['offertype'], ["put"])
+        self.assertEqual(chunks[1]['bonds']['MATDATE'], [datetime.date(2031, 2, 1)])
+        self.assertEqual(chunks[1]['coupons']['SECID'], [])
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_output_parquet(self):
+        import pyarrow.parquet
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01"), get_test_bond("B", 1000, None, "0000-00-00")]
+        bonds_list[0]["year_profit_ratio"] = 0.07
+        self.assertEqual(BondsParquetWriter.output_parquet(iter(bonds_list), self.temp_dir.name,
+                                                           datetime.datetime(2021, 3, 1), row_group_size=1), 2)
+        partition_name = "snapshot_date=2021-03-01"
+        table = pyarrow.parquet.read_table(os.path.join(self.temp_dir.name, "bonds", partition_name, "part-0.parquet"))
+        self.assertEqual(table.column("PREVPRICE").to_pylist(), [99.0, None])
+        self.assertEqual(table.column("MATDATE").to_pylist(), [datetime.date(2099, 1, 1), None])
+        self.assertEqual(table.column("year_profit_ratio").to_pylist(), [0.07, None])
+        coupons = pyarrow.parquet.read_table(os.path.join(self.temp_dir.name, "coupons", partition_name,
+                                                          "part-0.parquet"))
+        self.assertEqual(coupons.column("SECID").to_pylist(), ["A", "B"])
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow"), "pyarrow is installed")
+    def test_output_parquet_without_pyarrow(self):
+        with self.assertRaises(ImportError):
+            BondsParquetWriter.output_parquet([get_test_bond("A", 1000, 99, "2099-01-01")], self.temp_dir.name)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+
+class BondsMOEXQuoteRefresherTest(unittest.TestCase):
+    def test_apply_quotes(self):
+        bonds_list = [{"SECID": "A", "PREVPRICE": 99.5, "ACCRUEDINT": 1.5}, {"SECID": "B", "PREVPRICE": 101}]
+        refresher = BondsMOEXQuoteRefresher(bonds_list)
+        data = {"securities": {"columns": ["SECID", "ACCRUEDINT"], "data": [["A", 1.6], ["B", None], ["C", 2]]},
+                "marketdata": {"columns": ["SECID", "LAST", "BID", "OFFER"],
+                               "data": [["A", 99.7, 99.6, 99.8], ["B", None, None, None], ["C", 100, 99, 101]]}}
+        changed_bonds = refresher.apply_quotes(data)
+        self.assertEqual([bond["SECID"] for bond in changed_bonds], ["A"])
+        self.assertEqual(bonds_list[0]["OFFER"], 99.8)
+        self.assertEqual(bonds_list[0]["ACCRUEDINT"], 1.6)
+        self.assertNotIn("C", refresher.universe)
+        # The same quotes should not produce any changes
+        self.assertEqual(refresher.apply_quotes(data), [])
+
+
+class BondsQueryServiceTest(unittest.TestCase):
+    def test_query(self):
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01"), get_test_bond("B", 1000, 98, "2099-01-01"),
+                      get_test_bond("C", 10000, 97, "2099-01-01"), get_test_bond("D", 1000, 96, "2010-01-01")]
+        service = BondsQueryService(bonds_list)
+        result = service.query({"filter": {"max_bond_value": 5000, "max_expiration_date": "2100-01-01"},
+                                "commission_ratio": 0.0001, "sort_by": "year_profit_ratio", "page_size": 1})
+        self.assertEqual(result["total"], 2)
+        self.assertEqual([bond["ISIN"] for bond in result["data"]], ["B"])
+        self.assertNotIn("coupons", result["data"][0])
+        self.assertNotIn("year_profit_ratio", bonds_list[1])
+        service.swap_dataset(bonds_list[:1])
+        result = service.query({"sort_by": "PREVPRICE", "descending": False})
+        self.assertEqual([bond["ISIN"] for bond in result["data"]], ["A"])
+        with self.assertRaises(ValueError):
+            service.query({"min_profit_ratio": 0.05})
+
+    def test_query_filters_cache(self):
+        bonds_list = [get_test_bond(isin, 1000 * (i + 1), 99, "2099-01-01") for (i, isin) in enumerate("ABCDEF")]
+        service = BondsQueryService(bonds_list)
+        broad_query = {"filter": {"max_bond_value": 4000}}
+        narrow_query = {"filter": {"max_bond_value": 2000}}
+        with mock.patch.object(BondsMOEXFilter, "check_bond_advanced",
+                               side_effect=BondsMOEXFilter.check_bond_advanced) as check_bond:
+            self.assertEqual(service.query(broad_query)["total"], 4)
+            self.assertEqual(check_bond.call_count, 6)
+            # The same filter is not evaluated again, narrower filter checks only result of broader one
+            self.assertEqual(service.query(broad_query)["total"], 4)
+            self.assertEqual(check_bond.call_count, 6)
+            self.assertEqual(service.query(narrow_query)["total"], 2)
+            self.assertEqual(check_bond.call_count, 10)
+            service.swap_dataset(bonds_list[:1])
+            self.assertEqual(service.query(broad_query)["total"], 1)
+
+    def test_serve(self):
+        service = BondsQueryService([get_test_bond("A", 1000, 99, "2099-01-01")])
+        server_thread = threading.Thread(target=service.serve, kwargs={"port": 0, "reload_check_interval_sec": None},
+                                         daemon=True)
+        server_thread.start()
+        for _ in range(500):
+            if service.server_address is not None:
+                break
+            time.sleep(0.01)
+        base_url = f"http://127.0.0.1:{str(service.server_address[1])}"
+        reload_event = threading.Event()
+
+        def load_or_retrieve(bonds_group_list):
+            reload_event.wait(10)
+            return [get_test_bond(isin, 1000, 98, "2099-01-01") for isin in ("B", "C")]
+
+        try:
+            request = urllib.request.Request(base_url + "/query", data=json.dumps({"sort_by": "PREVPRICE"}).encode(),
+                                             method="POST")
+            with urllib.request.urlopen(request, timeout=10) as response:
+                result = json.loads(response.read())
+            self.assertEqual([bond["ISIN"] for bond in result["data"]], ["A"])
+            with mock.patch.object(BondsMOEXDataRetriever, "load_or_retrieve", side_effect=load_or_retrieve):
+                # Reload is answered before data is retrieved, old dataset is used until then
+                with urllib.request.urlopen(urllib.request.Request(base_url + "/reload", data=b"", method="POST"),
+                                            timeout=10) as response:
+                    self.assertEqual(response.status, 202)
+                    self.assertEqual(json.loads(response.read())["bonds_count"], 1)
+                self.assertFalse(service.reload_in_background())
+                reload_event.set()
+                for _ in range(500):
+                    if not service.get_status()["is_reloading"]:
+                        break
+                    time.sleep(0.01)
+            with urllib.request.urlopen(base_url + "/status", timeout=10) as response:
+                self.assertEqual(json.loads(response.read())["bonds_count"], 2)
+        finally:
+            service.shutdown()
+            server_thread.join(10)
+
+    def test_shutdown_reload_thread(self):
+        service = BondsQueryService([get_test_bond("A", 1000, 99, "2099-01-01")])
+        server_thread = threading.Thread(target=service.serve, kwargs={"port": 0, "reload_check_interval_sec": 3600},
+                                         daemon=True)
+        server_thread.start()
+        for _ in range(500):
+            if service.server_address is not None:
+                break
+            time.sleep(0.01)
+        service.shutdown()
+        server_thread.join(10)
+        service._reload_thread.join(10)
+        self.assertFalse(service._reload_thread.is_alive())
+
+
+class BondsAlertManagerTest(unittest.TestCase):
+    def test_tick_edge_triggered(self):
+        events = []
+        alert_manager = BondsAlertManager([BondsAlertCallbackSink(events.append)])
+        alert_manager.add_rule("cheap", "price_below", 98, notify_cleared=True)
+        alert_manager.add_rule("illiquid", "liquidity_lost", isin_list=["B"])
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01"),
+                      get_test_bond("B", 1000, 97, "2099-01-01")]
+        alert_manager.tick(bonds_list)
+        self.assertEqual([(event["rule"], event["ISIN"]) for event in events], [("cheap", "B")])
+        # Nothing is changed, so no new events
+        self.assertEqual(alert_manager.tick(bonds_list), [])
+        bonds_list[0]["PREVPRICE"] = 97.5
+        bonds_list[1]["PREVPRICE"] = 99
+        bonds_list[1]["sales_history"] = []
+        new_events = alert_manager.tick(bonds_list)
+        self.assertEqual([(event["rule"], event["ISIN"], event["state"]) for event in new_events],
+                         [("cheap", "A", "triggered"), ("cheap", "B", "cleared"), ("illiquid", "B", "triggered")])
+
+    def test_profile_match_next_day(self):
+        alert_manager = BondsAlertManager()
+        alert_manager.add_rule("profile", "profile_match", filter_description_dict={}, notify_cleared=True)
+        bonds_list = [get_test_bond("A", 1000, 99, "2021-03-03")]
+        events = alert_manager.tick(bonds_list, datetime.datetime(2021, 3, 1))
+        self.assertEqual([(event["ISIN"], event["state"]) for event in events], [("A", "triggered")])
+        self.assertEqual(alert_manager.tick(bonds_list, datetime.datetime(2021, 3, 1, 18)), [])
+        # Bond is not changed, but on the next day it expires too soon for default minimal expiration date
+        events = alert_manager.tick(bonds_list, datetime.datetime(2021, 3, 3))
+        self.assertEqual([(event["ISIN"], event["state"]) for event in events], [("A", "cleared")])
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_generate_bonds(self):
+        today = datetime.datetime(2021, 3, 19)
+        bonds_list = generate_bonds(300, seed=1, today=today)
+        self.assertEqual(bonds_list, generate_bonds(300, seed=1, today=today))
+        self.assertTrue(any(bond["MATDATE"] == "0000-00-00" for bond in bonds_list))
+        self.assertTrue(any(bond["OFFERDATE"] is not None for bond in bonds_list))
+        self.assertTrue(any(len(bond["amortizations"]) > 1 for bond in bonds_list))
+        self.assertTrue(any(coupon["value"] is None for bond in bonds_list for coupon in bond["coupons"]))
+        # Every generated bond with known price should be processed without errors
+        bonds_list = BondsMOEXFilter.filter_bonds_by_null_price(bonds_list)
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_list, 0.0006)
+
+
+class BondsMetricsTest(unittest.TestCase):
+    def test_report(self):
+        BondsMetrics.reset()
+        bonds_list = [{"ISIN": "A", "PREVPRICE": None}, {"ISIN": "B", "PREVPRICE": 99}]
+        BondsMOEXFilter.filter_bonds_by_null_price(bonds_list)
+        BondsMOEXFilter.filter_bonds_by_null_price(bonds_list)
+        BondsMetrics.record_request(0.3, 1024)
+        BondsMetrics.record_retry(60)
+        report = BondsMetrics.get_report()
+        filter_report = report["filters"]["BondsMOEXFilter.filter_bonds_by_null_price"]
+        self.assertEqual((filter_report["input"], filter_report["output"], filter_report["selectivity"]), (4, 2, 0.5))
+        self.assertEqual(report["stages"]["BondsMOEXFilter.filter_bonds_by_null_price"]["count"], 2)
+        self.assertEqual(report["requests"]["bytes"], 1024)
+        prometheus_text = BondsMetrics.to_prometheus()
+        self.assertIn('moex_bonds_request_duration_seconds_bucket{le="0.25"} 0', prometheus_text)
+        self.assertIn('moex_bonds_request_duration_seconds_bucket{le="0.5"} 1', prometheus_text)
+        self.assertIn('moex_bonds_request_retries_total 1', prometheus_text)
+        BondsMetrics.reset()
+
+    def test_chained_stages(self):
+        def slow_bonds():
+            for isin in ("A", "B", "C", "D", "E"):
+                time.sleep(0.02)
+                yield {"ISIN": isin, "PREVPRICE": 99}
+
+        BondsMetrics.reset()
+        bonds_iterator = BondsMOEXFilter.iter_filter_bonds_by_null_price(slow_bonds())
+        bonds_iterator = BondsMOEXFilter.iter_filter_bonds_by_isin_blacklist(bonds_iterator, {"B"})
+        self.assertEqual(len(list(bonds_iterator)), 4)
+        # Every stage is timed without upstream stages, so slow source is not counted twice
+        stages = BondsMetrics.get_report()["stages"]
+        self.assertLess(stages["BondsMOEXFilter.filter_bonds_by_null_price"]["total_sec"], 0.05)
+        self.assertLess(stages["BondsMOEXFilter.filter_bonds_by_isin_blacklist"]["total_sec"], 0.05)
+        BondsMetrics.reset()
+
+    def test_retries(self):
+        BondsMetrics.reset()
+        with mock.patch("urllib.request.urlopen", side_effect=urllib.error.URLError("Connection reset")), \
+                mock.patch("time.sleep") as sleep:
+            self.assertIsNone(BondsMOEXDataRetriever._url_request("https://iss.moex.com/iss", attempt_count=3,
+                                                                  sleep_sec=5))
+        self.assertEqual(sleep.call_count, 2)
+        report = BondsMetrics.get_report()["requests"]
+        self.assertEqual((report["failures"], report["retries"], report["retry_sleep_sec"]), (3, 2, 10))
+        BondsMetrics.reset()
+
+
+class GeneratorPipelineTest(unittest.TestCase):
+    def test_pipeline_is_lazy(self):
+        consumed = []
+
+        def infinite_bonds():
+            for i in itertools.count():
+                bond = get_test_bond(str(i), 1000 if i % 2 else 100000, 95, "2099-01-01")
+                consumed.append(i)
+                yield bond
+
+        bonds_iterator = BondsMOEXFilter.iter_filter_bonds_advanced(infinite_bonds(), {'max_bond_value': 5000})
+        bonds_iterator = BondsCustomCalculationAndFilter.iter_calculate_bonds_profit(bonds_iterator, 0.0001)
+        bonds_iterator = BondsCustomCalculationAndFilter.iter_filter_bonds_by_profit_ratio(bonds_iterator, 0.0)
+        first_bonds = list(itertools.islice(bonds_iterator, 3))
+        self.assertEqual([bond["ISIN"] for bond in first_bonds], ["1", "3", "5"])
+        self.assertTrue(all("year_profit_ratio" in bond for bond in first_bonds))
+        self.assertEqual(len(consumed), 6)
+
+
+class BondsISSColumnsTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = {"coupons": {"columns": ["coupondate", "faceunit", "value"],
+                            "data": [["2021-06-11", "RUB", 29.92], ["2021-12-11", "RUB", None]]},
+                "securities": {"columns": ["SECID", "MATDATE", "OFFERDATE", "PREVPRICE", "LOTSIZE"],
+                               "data": [["A", "0000-00-00", None, 105, 1], ["B", "2022-06-11", "2021-04-19", 100.36, 1]]}}
+        for root_name in ("coupons", "securities"):
+            columns = BondsISSColumns.from_iss(data, root_name)
+            self.assertEqual(list(columns), BondsMOEXDataRetriever._convert_data_to_dict(data, root_name))
+            self.assertEqual(columns[-1], dict(zip(data[root_name]["columns"], data[root_name]["data"][1])))
+        columns = BondsISSColumns.from_iss(data, "coupons")
+        self.assertEqual(columns.columns["coupondate"].typecode, 'l')
+        self.assertEqual(columns.columns["value"].typecode, 'd')
+        columns.extend(BondsISSColumns.from_iss(data, "coupons"))
+        self.assertEqual(len(columns), 4)
+        self.assertEqual(columns.column("value"), [29.92, None, 29.92, None])
+
+    def test_profit_with_columnar_payments(self):
+        bond = get_test_bond("A", 1000, 99, "2099-01-01")
+        columnar_bond = dict(bond)
+        for key in ("coupons", "amortizations"):
+            columns = list(bond[key][0].keys())
+            data = {key: {"columns": columns, "data": [[entry[name] for name in columns] for entry in bond[key]]}}
+            columnar_bond[key] = BondsISSColumns.from_iss(data, key)
+        BondsCustomCalculationAndFilter.calculate_bonds_profit([bond, columnar_bond], 0.0001)
+        self.assertEqual(bond["year_profit_ratio"], columnar_bond["year_profit_ratio"])
+        self.assertEqual(json.loads(json.dumps(columnar_bond, default=BondsMOEXDataRetriever._convert_to_json)), bond)
+
+
+class BondsCacheTest(TempDirTestMixin, unittest.TestCase):
+    def test_lock(self):
+        lock_filename = os.path.join(self.temp_dir.name, 'cache.lock')
+        with BondsCacheLock(lock_filename):
+            self.assertFalse(BondsCacheLock(lock_filename).acquire(blocking=False))
+        other_lock = BondsCacheLock(lock_filename)
+        self.assertTrue(other_lock.acquire(blocking=False))
+        other_lock.release()
+
+    def test_load_from_shared_cache(self):
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01")]
+        cache_filename = os.path.join(self.temp_dir.name, datetime.datetime.today().strftime("%Y-%m-%d") + ".json")
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, "with_sales")
+        self.assertEqual(BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name), bonds_list)
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), sorted([os.path.basename(cache_filename),
+                                                                          os.path.basename(cache_filename)[:-5] + ".lock"]))
+
+    def test_load_with_filter(self):
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01"),
+                      get_test_bond("B", 10000, 99, "2099-01-01"),
+                      get_test_bond("C", 1000, None, "2099-01-01")]
+        filter_description_dict = {"max_bond_value": 5000}
+        (selected_list, pending_list) = BondsMOEXDataRetriever.split_listing(bonds_list, filter_description_dict)
+        self.assertEqual([bond["ISIN"] for bond in selected_list], ["A"])
+        self.assertEqual([bond["ISIN"] for bond in pending_list], ["B", "C"])
+        self.assertEqual(BondsMOEXDataRetriever.split_listing(bonds_list), (bonds_list, []))
+
+        cache_filename = os.path.join(self.temp_dir.name, datetime.datetime.today().strftime("%Y-%m-%d") + ".json")
+        BondsMOEXDataRetriever.dump_results_to_file(selected_list, cache_filename, "with_sales", pending_list)
+        self.assertEqual(BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name,
+                                                                 filter_description_dict={"max_bond_value": 1000}),
+                         selected_list)
+        self.assertEqual(BondsMOEXDataRetriever.load_results_from_file(cache_filename)["pending"], pending_list)
+
+    def test_load_columnar(self):
+        def url_request(request_url):
+            if "/bondization/" in request_url:
+                return {"amortizations": {"columns": ["amortdate", "faceunit", "value"],
+                                          "data": [["2099-01-01", "RUB", 1000]]},
+                        "coupons": {"columns": ["coupondate", "faceunit", "value"],
+                                    "data": [["2098-07-01", "RUB", 35.5], ["2099-01-01", "RUB", 35.5]]},
+                        "offers": {"columns": ["offerdate", "offertype"], "data": []}}
+            return {"history": {"columns": ["TRADEDATE", "VOLUME", "NUMTRADES"], "data": [["2021-03-03", 10, 2]]}}
+
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01")]
+        for key in ("amortizations", "coupons", "offers", "sales_history"):
+            del bonds_list[0][key]
+        cache_filename = os.path.join(self.temp_dir.name, datetime.datetime.today().strftime("%Y-%m-%d") + ".json")
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, "with_description")
+        with mock.patch.object(BondsMOEXDataRetriever, "_url_request", side_effect=url_request):
+            retrieved_list = BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name, columnar=True)
+        # Schedules loaded from cache file are packed as well as retrieved ones
+        loaded_list = BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name, columnar=True)
+        for bond in (retrieved_list[0], loaded_list[0]):
+            for key in ("amortizations", "coupons", "offers"):
+                self.assertIsInstance(bond[key], BondsISSColumns)
+            self.assertEqual(bond["coupons"].column("value"), [35.5, 35.5])
+            self.assertEqual(len(bond["offers"]), 0)
+        self.assertEqual(loaded_list[0]["amortizations"].to_list(),
+                         [{"amortdate": "2099-01-01", "faceunit": "RUB", "value": 1000}])
+        self.assertIsInstance(BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name)[0]["coupons"],
+                              list)
+
+
+class BondsLiquidityStoreTest(TempDirTestMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = BondsLiquidityStore(os.path.join(self.temp_dir.name, 'liquidity.db'))
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    def test_window_aggregates(self):
+        history = [{"TRADEDATE": "2021-03-03", "VOLUME": 126, "NUMTRADES": 28, "VALUE": 1260.0},
+                   {"TRADEDATE": "2021-03-04", "VOLUME": 0, "NUMTRADES": 0, "VALUE": 0.0},
+                   {"TRADEDATE": "2021-03-05", "VOLUME": 291, "NUMTRADES": 13, "VALUE": 2910.0}]
+        self.assertEqual(self.store.append_history("A", history), 3)
+        # Already stored days are skipped, days from different boards are summed up
+        self.assertEqual(self.store.append_history("A", history[2:] + [
+            {"TRADEDATE": "2021-03-09", "VOLUME": 100, "NUMTRADES": 10, "VALUE": 1000.0},
+            {"TRADEDATE": "2021-03-09", "VOLUME": 86, "NUMTRADES": 24, "VALUE": 860.0}]), 1)
+        self.assertEqual(self.store.get_last_trade_date("A"), "2021-03-09")
+        aggregates = self.store.get_window_aggregates("A", 5, datetime.datetime(2021, 3, 9))
+        self.assertEqual(aggregates, {"volume": 477, "deals": 47, "turnover": 4770.0, "active_days": 2})
+        aggregates = self.store.get_window_aggregates("A", 30, datetime.datetime(2021, 3, 9))
+        self.assertEqual((aggregates["volume"], aggregates["active_days"]), (603, 3))
+        self.assertEqual(len(self.store.get_sales_history("A", 30, datetime.datetime(2021, 3, 9))), 4)
+        self.assertEqual(self.store.get_window_aggregates("B", 30)["volume"], 0)
+
+    def test_update_by_days(self):
+        requested_dates = []
+
+        def url_request(request_url):
+            trade_date = request_url[-10:]
+            requested_dates.append(trade_date)
+            return {"history": {"columns": ["SECID", "TRADEDATE", "VOLUME", "NUMTRADES", "VALUE"],
+                                "data": [[secid, trade_date, 10, 3, 100.0] for secid in ("A", "B", "C")]}}
+
+        bonds_list = [get_test_bond("A", 1000, 99, "2099-01-01"), get_test_bond("B", 1000, 99, "2099-01-01")]
+        for bond in bonds_list:
+            del bond["sales_history"]
+        cache_filename = os.path.join(self.temp_dir.name, datetime.datetime.today().strftime("%Y-%m-%d") + ".json")
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list, cache_filename, "with_payments")
+        with mock.patch.object(BondsMOEXDataRetriever, "_url_request", side_effect=url_request):
+            bonds_list = BondsMOEXDataRetriever.load_or_retrieve(cache_dir=self.temp_dir.name,
+                                                                 liquidity_store=self.store)
+            # One request for every day instead of one request for every bond, loaded days are not requested again
+            self.assertEqual(len(requested_dates), 15)
+            self.store.update(days_delta=20)
+            self.assertEqual(len(requested_dates), 20)
+        self.assertEqual([len(bond["sales_history"]) for bond in bonds_list], [15, 15])
+        self.assertEqual(BondsMOEXDataRetriever.load_results_from_file(cache_filename)["status"], "with_sales")
+        # Store can be used from other threads
+        aggregates = []
+        thread = threading.Thread(target=lambda: aggregates.append(self.store.get_window_aggregates("C", 30)))
+        thread.start()
+        thread.join()
+        self.assertEqual(aggregates[0]["deals"], 60)
+
+    def test_update_unpublished_day(self):
+        today = datetime.datetime.today()
+        unpublished_date = next(day for day in (today - datetime.timedelta(days=days_ago) for days_ago in range(1, 4))
+                                if day.weekday() < 5).strftime("%Y-%m-%d")
+        requested_dates = []
+
+        def url_request(request_url):
+            trade_date = request_url[-10:]
+            requested_dates.append(trade_date)
+            data = [["A", trade_date, 10, 3, 100.0]]
+            if trade_date == unpublished_date and requested_dates.count(trade_date) == 1:
+                data = []
+            return {"history": {"columns": ["SECID", "TRADEDATE", "VOLUME", "NUMTRADES", "VALUE"], "data": data}}
+
+        with mock.patch.object(BondsMOEXDataRetriever, "_url_request", side_effect=url_request):
+            self.store.update(days_delta=3)
+            self.assertEqual(self.store.get_window_aggregates("A", 30)["volume"], 20)
+            # Weekday without history is requested again, other days are already loaded
+            self.store.update(days_delta=3)
+        self.assertEqual(requested_dates[3:], [unpublished_date])
+        self.assertEqual(self.store.get_window_aggregates("A", 30)["volume"], 30)
+
+
+class BondsBacktestRunnerTest(TempDirTestMixin, unittest.TestCase):
+    def _dump_snapshot(self, snapshot_date, bonds_list):
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list, os.path.join(self.temp_dir.name, snapshot_date + ".json"),
+                                                    "with_sales")
+
+    def test_as_of_date(self):
+        bond = get_test_bond("A", 1000, 99, "2021-06-01")
+        bond["amortizations"] = [{"amortdate": "2021-03-01", "faceunit": "RUB", "value": 500},
+                                 {"amortdate": "2021-06-01", "faceunit": "RUB", "value": 500}]
+        self.assertFalse(BondsMOEXFilter.check_not_amortization(bond, as_of_date=datetime.datetime(2021, 2, 1)))
+        self.assertTrue(BondsMOEXFilter.check_not_amortization(bond, as_of_date=datetime.datetime(2021, 4, 1)))
+        self.assertEqual(len(BondsMOEXFilter.filter_bonds_advanced([bond], {}, datetime.datetime(2021, 4, 1))), 1)
+        self.assertEqual(len(BondsMOEXFilter.filter_bonds_advanced([bond], {}, datetime.datetime(2021, 7, 1))), 0)
+
+    def test_run(self):
+        bond = get_test_bond("A", 1000, 99, "2099-01-01")
+        bond["coupons"] = [{"coupondate": "2021-03-20", "faceunit": "RUB", "value": 50},
+                           {"coupondate": "2021-09-20", "faceunit": "RUB", "value": None}]
+        expensive_bond = get_test_bond("B", 1000, 120, "2099-01-01")
+        self._dump_snapshot("2021-03-01", [bond, expensive_bond])
+        self._dump_snapshot("2021-03-15", [dict(bond, PREVPRICE=99.5), expensive_bond])
+        self._dump_snapshot("2021-04-01", [dict(bond, PREVPRICE=100)])
+        profile_dict = {"filter": {"max_expiration_date": "2100-01-01"}, "commission_ratio": 0.0,
+                        "min_profit_ratio": 0.0}
+        result = BondsBacktestRunner.run(profile_dict, cache_dir=self.temp_dir.name, horizon_days=30, processes=2)
+        self.assertEqual([(item["date"], item["exit_date"]) for item in result],
+                         [("2021-03-01", "2021-04-01"), ("2021-03-15", None), ("2021-04-01", None)])
+        self.assertEqual([outcome["ISIN"] for outcome in result[0]["bonds"]], ["A"])
+        outcome = result[0]["bonds"][0]
+        self.assertEqual((outcome["price_change"], outcome["coupons_paid"]), (1, 50))
+        self.assertAlmostEqual(outcome["realized_return"], (1000 + 50 - 990) / 990)
+        self.assertNotIn("realized_return", result[1]["bonds"][0])
+        with mock.patch.dict(os.environ, {"MOEX_BONDS_CACHE_DIR": self.temp_dir.name}):
+            result = BondsBacktestRunner.run(profile_dict, date_to=datetime.datetime(2021, 3, 1), horizon_days=10,
+                                             processes=1)
+        self.assertEqual([(item["date"], item["exit_date"]) for item in result], [("2021-03-01", "2021-03-15")])
+        with self.assertRaises(ValueError):
+            BondsBacktestRunner.run(profile_dict, cache_dir=self.temp_dir.name, horizon_days=0)
+
+    def test_realized_outcome(self):
+        bond = get_test_bond("A", 1000, 99, "2099-01-01")
+        exit_bond = dict(bond, PREVPRICE=50, FACEVALUE=500,
+                         amortizations=[{"amortdate": "2021-03-10", "faceunit": "RUB", "value": 500},
+                                        {"amortdate": "2099-01-01", "faceunit": "RUB", "value": 500}])
+        # Amortization which was announced after selection is taken from the exit snapshot
+        outcome = BondsBacktestRunner.get_realized_outcome(bond, exit_bond, datetime.datetime(2021, 3, 1),
+                                                           datetime.datetime(2021, 3, 15))
+        self.assertEqual(outcome["amortizations_paid"], 500)
+        self.assertAlmostEqual(outcome["realized_return"], (250 + 500 - 990) / 990)
+        outcome = BondsBacktestRunner.get_realized_outcome(bond, bond, datetime.datetime(2021, 3, 1),
+                                                           datetime.datetime(2021, 3, 1))
+        self.assertEqual((outcome["realized_return"], outcome["realized_year_ratio"]), (0.0, None))
+
+
+class BondsScreenCacheTest(TempDirTestMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.today = datetime.datetime(2021, 3, 1)
+        self.bonds_list = generate_bonds(300, seed=3, today=self.today)
+
+    def _screen(self, filter_description_dict, min_profit_ratio):
+        bonds_list = BondsMOEXFilter.filter_bonds_advanced(self.bonds_list, filter_description_dict, self.today)
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_list, 0.0006, self.today)
+        return [bond["ISIN"] for bond in
+                BondsCustomCalculationAndFilter.filter_bonds_by_profit_ratio(bonds_list, min_profit_ratio)]
+
+    def test_screen(self):
+        filename = os.path.join(self.temp_dir.name, "screens.json")
+        screen_cache = BondsScreenCache(max_entries=2, filename=filename)
+        snapshot_hash = BondsScreenCache.get_snapshot_hash(self.bonds_list)
+        broad_filter = {"max_expiration_date": datetime.datetime(2031, 1, 1)}
+        narrow_filter = {"max_expiration_date": datetime.datetime(2024, 1, 1), "max_bond_value": 1000}
+        result = screen_cache.screen(self.bonds_list, broad_filter, 0.0006, 0.05, self.today)
+        self.assertEqual([bond["ISIN"] for bond in result], self._screen(broad_filter, 0.05))
+        # Profit fields are not part of snapshot content
+        self.assertEqual(BondsScreenCache.get_snapshot_hash(self.bonds_list), snapshot_hash)
+
+        BondsMetrics.reset()
+        result = screen_cache.screen(self.bonds_list, broad_filter, 0.0006, 0.05, self.today)
+        self.assertEqual(BondsMetrics.get_report()["cache"]["screen_result"]["hits"], 1)
+        self.assertEqual([bond["ISIN"] for bond in result], self._screen(broad_filter, 0.05))
+        # Narrower screen is refined from cached one without rescanning of all bonds
+        BondsMetrics.reset()
+        result = screen_cache.screen(self.bonds_list, narrow_filter, 0.0006, 0.07, self.today)
+        self.assertNotIn("BondsMOEXFilter.filter_bonds_advanced", BondsMetrics.get_report()["stages"])
+        self.assertEqual([bond["ISIN"] for bond in result], self._screen(narrow_filter, 0.07))
+        self.assertLess(len(result), len(self._screen(broad_filter, 0.05)))
+
+        # Cache is restored from file and the least recently used entry is evicted
+        screen_cache.screen(self.bonds_list, broad_filter, 0.001, None, self.today)
+        restored_cache = BondsScreenCache(max_entries=2, filename=filename)
+        self.assertEqual(len(restored_cache), 2)
+        BondsMetrics.reset()
+        restored_cache.screen(self.bonds_list, narrow_filter, 0.0006, 0.07, self.today, snapshot_hash)
+        restored_cache.screen(self.bonds_list, broad_filter, 0.0006, 0.05, self.today, snapshot_hash)
+        self.assertEqual(BondsMetrics.get_report()["cache"]["screen_result"], {"hits": 1, "misses": 1})
+
+    def test_screen_memoized_hash(self):
+        screen_cache = BondsScreenCache()
+        broad_filter = {"max_expiration_date": datetime.datetime(2031, 1, 1)}
+        with mock.patch.object(BondsScreenCache, "get_snapshot_hash",
+                               wraps=BondsScreenCache.get_snapshot_hash) as get_snapshot_hash:
+            expected_list = [bond["ISIN"] for bond in screen_cache.screen(self.bonds_list, broad_filter, 0.0006,
+                                                                          0.05, self.today)]
+            screen_cache.screen(self.bonds_list, broad_filter, 0.0006, 0.05, self.today)
+            self.assertEqual(get_snapshot_hash.call_count, 1)
+            screen_cache.screen(self.bonds_list[:10], broad_filter, 0.0006, 0.05, self.today)
+            self.assertEqual(get_snapshot_hash.call_count, 2)
+        # Result cached for another list is not applied to bonds which are not in it
+        result = screen_cache.screen(self.bonds_list[:10], broad_filter, 0.0006, 0.05, self.today,
+                                     BondsScreenCache.get_snapshot_hash(self.bonds_list))
+        self.assertEqual([bond["ISIN"] for bond in result], [isin for isin in expected_list
+                                                             if isin in {bond["ISIN"] for bond in self.bonds_list[:10]}])
+
+
+class BondsPortfolioOptimizerTest(unittest.TestCase):
+    @staticmethod
+    def _get_bond(isin, price, year_profit_ratio, emitter_id, expiration_date="2025-01-01"):
+        bond = get_test_bond(isin, 1000, price, expiration_date)
+        bond.update({"LOTSIZE": 1, "EMITTER_ID": emitter_id, "emitter_risk": "", "year_profit_ratio": year_profit_ratio})
+        return bond
+
+    def test_optimize(self):
+        # Greedy choice of the best bond leaves budget unused, two other bonds use it completely
+        bonds_list = [self._get_bond("A", 60, 0.10, "1"), self._get_bond("B", 50, 0.09, "2"),
+                      self._get_bond("C", 50, 0.09, "3"), self._get_bond("D", None, 0.2, "4")]
+        for mode in ("exact", "heuristic"):
+            result = BondsPortfolioOptimizer.optimize(bonds_list, 1000, mode=mode)
+            self.assertNotIn("A", [position["ISIN"] for position in result["positions"]])
+            self.assertAlmostEqual(result["year_income"], 90)
+        self.assertTrue(BondsPortfolioOptimizer.optimize(bonds_list, 1000)["is_optimal"])
+
+    def test_optimize_caps(self):
+        bonds_list = [self._get_bond("A", 100, 0.12, "1", "2022-01-01"), self._get_bond("B", 100, 0.11, "1"),
+                      self._get_bond("C", 100, 0.10, "2", "2022-06-01"), self._get_bond("D", 100, 0.05, "3")]
+        bonds_list[3]["emitter_risk"] = "high"
+        ladder = [("2022-12-31", 0.5), (datetime.datetime(2030, 1, 1), 0.5)]
+        result = BondsPortfolioOptimizer.optimize(bonds_list, 10000, max_emitter_share=0.3, risk_caps={"high": 0.1},
+                                                  ladder=ladder)
+        self.assertEqual({position["ISIN"]: position["lots"] for position in result["positions"]},
+                         {"A": 2, "B": 1, "C": 3, "D": 1})
+        result = BondsPortfolioOptimizer.optimize(bonds_list, 10000, max_emitter_share=0.3, risk_caps={"high": 0.1},
+                                                  ladder=ladder, mode="heuristic")
+        lots = {position["ISIN"]: position["lots"] for position in result["positions"]}
+        self.assertLessEqual(result["year_income"], 700 + 1e-6)
+        self.assertLessEqual(lots.get("A", 0) + lots.get("B", 0), 3)
+        self.assertLessEqual(lots.get("A", 0) + lots.get("C", 0), 5)
+        self.assertLessEqual(lots.get("D", 0), 1)
+
+    def test_optimize_big_budget(self):
+        # Every bond can be bought in thousands of lots, so only lots counts close to the maximum are tried
+        bonds_list = [self._get_bond(str(i), 90 + i, 0.05 + i / 100, str(i % 5)) for i in range(16)]
+        result = BondsPortfolioOptimizer.optimize(bonds_list, 10000000, max_emitter_share=0.3, mode="exact")
+        heuristic_result = BondsPortfolioOptimizer.optimize(bonds_list, 10000000, max_emitter_share=0.3,
+                                                            mode="heuristic")
+        self.assertFalse(result["is_optimal"])
+        self.assertGreaterEqual(result["year_income"], heuristic_result["year_income"] - 1e-6)
+        self.assertLessEqual(result["total_cost"], 10000000)
+
+    def test_optimize_generated(self):
+        bonds_list = BondsMOEXFilter.filter_bonds_by_null_price(generate_bonds(2000, seed=5))
+        BondsCustomCalculationAndFilter.calculate_bonds_profit(bonds_list, 0.0006)
+        result = BondsPortfolioOptimizer.optimize(bonds_list, 300000, max_emitter_share=0.1)
+        self.assertEqual(result["mode"], "heuristic")
+        self.assertLessEqual(result["total_cost"], 300000)
+        emitters_cost = {}
+        for position in result["positions"]:
+            emitters_cost[position["EMITTER_ID"]] = emitters_cost.get(position["EMITTER_ID"], 0) + position["cost"]
+        self.assertLessEqual(max(emitters_cost.values()), 30000 + 1e-6)
+
+
+class BondsSharedUniverseTest(unittest.TestCase):
+    def test_publish_and_attach(self):
+        today = datetime.datetime(2021, 3, 1)
+        bonds_list = generate_bonds(200, seed=7, today=today)
+        bonds_list[0]["is_flag"] = True
+        del bonds_list[1]["sales_history"]
+        with BondsSharedUniverse.publish(bonds_list) as universe:
+            attached_universe = BondsSharedUniverse.attach(universe.name)
+            self.assertEqual(len(attached_universe), 200)
+            self.assertEqual(list(attached_universe), bonds_list)
+            self.assertEqual(attached_universe[-1], bonds_list[-1])
+            prices = attached_universe.column("FACEVALUE")
+            self.assertTrue(prices.readonly)
+            self.assertEqual(prices.tolist(), [bond["FACEVALUE"] for bond in bonds_list])
+            attached_universe.close()
+
+            filter_description_dict = {"max_expiration_date": datetime.datetime(2031, 1, 1)}
+            indexes = universe.filter_bonds_advanced(filter_description_dict, today, processes=2)
+            expected_list = BondsMOEXFilter.filter_bonds_advanced(bonds_list, filter_description_dict, today)
+            self.assertEqual([bonds_list[index]["ISIN"] for index in indexes],
+                             [bond["ISIN"] for bond in expected_list])
+            profits = universe.calculate_bonds_profit(0.0006, indexes, today, processes=2)
+            BondsCustomCalculationAndFilter.calculate_bonds_profit(expected_list, 0.0006, today)
+            self.assertEqual([bond["year_profit_ratio"] for bond in universe.rows(indexes, profits)],
+                             [bond["year_profit_ratio"] for bond in expected_list])
+        with self.assertRaises(FileNotFoundError):
+            BondsSharedUniverse.attach(universe.name)
+
+
+class BondsSnapshotDiffTest(TempDirTestMixin, unittest.TestCase):
+    def test_diff(self):
+        old_bonds_list = generate_bonds(50, seed=11, today=datetime.datetime(2021, 3, 1))
+        new_bonds_list = json.loads(json.dumps(old_bonds_list[1:]))
+        new_bonds_list.append(dict(old_bonds_list[0], SECID="NEW", ISIN="NEW"))
+        for bond in new_bonds_list:
+            bond["PREVPRICE"] = 100.5
+        bond = new_bonds_list[0]
+        bond["ISQUALIFIEDINVESTORS"] = "0" if bond["ISQUALIFIEDINVESTORS"] == "1" else "1"
+        bond["coupons"][0]["value"] = 1.23
+        bond["coupons"].append({"coupondate": "2099-01-01", "faceunit": "RUB", "value": 10})
+        bond["offers"].append({"offerdate": "2022-01-01", "offertype": "Оферта"})
+        bond["OFFERDATE"] = "2022-01-01"
+        bond = next(bond for bond in new_bonds_list if None in [coupon["value"] for coupon in bond["coupons"]]
+                    and bond is not new_bonds_list[0])
+        coupon_date = next(coupon["coupondate"] for coupon in bond["coupons"] if coupon["value"] is None)
+        bond["coupons"] = [dict(coupon, value=15.5) if coupon["coupondate"] == coupon_date else coupon
+                           for coupon in bond["coupons"]]
+
+        changes = BondsSnapshotDiff.diff(old_bonds_list, new_bonds_list)
+        first_secid = new_bonds_list[0]["SECID"]
+        self.assertEqual(sorted(change["type"] for change in changes if change["SECID"] == first_secid),
+                         ["coupon_added", "coupon_value_changed", "field_changed", "offer_added",
+                          "qualification_changed"])
+        self.assertIn({"type": "coupon_value_set", "SECID": bond["SECID"], "ISIN": bond["ISIN"], "date": coupon_date,
+                       "old": None, "new": 15.5}, changes)
+        self.assertEqual([change["SECID"] for change in changes if change["type"] in ("listed", "delisted")],
+                         ["NEW", old_bonds_list[0]["SECID"]])
+        self.assertEqual(len(BondsSnapshotDiff.get_changed_secids(changes)), 4)
+        self.assertEqual(len(BondsSnapshotDiff.diff(old_bonds_list, new_bonds_list, include_market=True)),
+                         len(changes) + len([bond for bond in old_bonds_list[1:] if bond["PREVPRICE"] != 100.5]))
+
+        # Alerts are evaluated again only for changed bonds
+        alert_manager = BondsAlertManager()
+        alert_manager.add_rule("profile", "profile_match", filter_description_dict={"is_noliquid_interesting": True,
+                                                                                    "is_qualified": True})
+        self.assertGreater(len(alert_manager.tick(new_bonds_list)), 0)
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(alert_manager.tick(new_bonds_list), [])
+        self.assertIn("Alerts were evaluated for 0 changed bonds", logs.output[-1])
+        alert_manager.invalidate(BondsSnapshotDiff.get_changed_secids(changes))
+        # Delisted bond is not in the new list, so only three bonds are evaluated
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(alert_manager.tick(new_bonds_list), [])
+        self.assertIn("Alerts were evaluated for 3 changed bonds", logs.output[-1])
+
+    def test_diff_market_and_amortizations(self):
+        old_bond = get_test_bond("A", 1000, 99, "2030-01-01")
+        old_bond["amortizations"] = [{"amortdate": "2025-01-01", "faceunit": "RUB", "value": 500},
+                                     {"amortdate": "2030-01-01", "faceunit": "RUB", "value": 500}]
+        new_bond = json.loads(json.dumps(old_bond))
+        # Quotes written by refresher are not reference data
+        BondsMOEXQuoteRefresher([new_bond]).apply_quotes(
+            {"securities": {"columns": ["SECID", "ACCRUEDINT"], "data": [["A", 1.5]]},
+             "marketdata": {"columns": ["SECID", "LAST", "BID", "OFFER"], "data": [["A", 99.7, 99.6, 99.8]]}})
+        self.assertEqual(BondsSnapshotDiff.diff([old_bond], [new_bond]), [])
+        new_bond["amortizations"][0]["value"] = 400
+        new_bond["amortizations"].insert(1, {"amortdate": "2027-01-01", "faceunit": "RUB", "value": 100})
+        self.assertEqual(BondsSnapshotDiff.diff([old_bond], [new_bond]),
+                         [{"type": "amortization_changed", "SECID": "A", "ISIN": "A", "date": "2025-01-01",
+                           "old": 500, "new": 400},
+                          {"type": "amortization_changed", "SECID": "A", "ISIN": "A", "date": "2027-01-01",
+                           "old": None, "new": 100}])
+
+    def test_diff_partial_snapshot(self):
+        bonds_list = [get_test_bond(isin, 1000, 99, "2099-01-01") for isin in ("A", "B", "C")]
+        bonds_list[2]["FACEVALUE"] = 10000
+        listing_keys = ("SECID", "ISIN", "PREVPRICE", "FACEVALUE", "ACCRUEDINT", "MATDATE", "OFFERDATE")
+        old_filename = os.path.join(self.temp_dir.name, "2021-03-01.json")
+        new_filename = os.path.join(self.temp_dir.name, "2021-03-02.json")
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list, old_filename, "with_sales")
+        # The next day was retrieved with filter pushdown, so B and C have listing data only
+        (selected_list, pending_list) = BondsMOEXDataRetriever.split_listing(
+            [{key: bond[key] for key in listing_keys} for bond in bonds_list], {"max_bond_value": 5000})
+        self.assertEqual([bond["ISIN"] for bond in pending_list], ["C"])
+        pending_list.append(selected_list.pop())
+        pending_list[0]["FACEVALUE"] = 5000
+        BondsMOEXDataRetriever.dump_results_to_file(bonds_list[:1], new_filename, "with_sales", pending_list)
+
+        changes = BondsSnapshotDiff.diff_files(old_filename, new_filename)
+        self.assertEqual(changes, [{"type": "field_changed", "SECID": "C", "ISIN": "C", "field": "FACEVALUE",
+                                    "old": 10000, "new": 5000}])
+        self.assertEqual(BondsSnapshotDiff.diff_files(new_filename, old_filename)[0]["new"], 10000)
+        self.assertEqual(len(BondsMOEXDataRetriever.load_snapshot(new_filename)), 1)
+        self.assertEqual(len(BondsMOEXDataRetriever.load_snapshot(new_filename, include_pending=True)), 3)
+
+
+class BondsCashFlowProjectorTest(unittest.TestCase):
+    def test_project(self):
+        bond = get_test_bond("A", 1000, 99, "2022-03-01")
+        bond.update({"LOTSIZE": 10, "FACEUNIT": "SUR", "offers": [{"offerdate": "2021-12-01", "offertype": "Оферта"}]})
+        bond["coupons"] = [{"coupondate": "2021-01-01", "faceunit": "RUB", "value": 40},
+                           {"coupondate": "2021-06-01", "faceunit": "RUB", "value": 50},
+                           {"coupondate": "2021-09-01", "faceunit": "RUB", "value": None},
+                           {"coupondate": "2021-12-01", "faceunit": "RUB", "value": None},
+                           {"coupondate": "2022-03-01", "faceunit": "RUB", "value": None}]
+        bond["amortizations"] = [{"amortdate": "2021-06-01", "faceunit": "RUB", "value": 500},
+                                 {"amortdate": "2022-03-01", "faceunit": "RUB", "value": 500}]
+        usd_bond = get_test_bond("B", 100, 99, "2021-06-15")
+        usd_bond["FACEUNIT"] = "USD"
+        usd_bond["coupons"] = [{"coupondate": "2021-06-15", "faceunit": "USD", "value": 2}]
+        usd_bond["amortizations"] = [{"amortdate": "2021-06-15", "faceunit": "USD", "value": 100}]
+        holdings = {"A": 2, "B": 3, "C": 1}
+
+        result = BondsCashFlowProjector.project([bond, usd_bond], holdings, datetime.datetime(2021, 3, 1),
+                                                fx_rates={"USD": 75.0}, include_flows=True)
+        self.assertEqual(result["missing"], ["C"])
+        self.assertEqual([day["date"] for day in result["daily"]],
+                         ["2021-06-01", "2021-06-15", "2021-09-01", "2021-12-01", "2022-03-01"])
+        self.assertAlmostEqual(result["daily"][0]["coupons"], 50 * 0.87 * 20)
+        self.assertAlmostEqual(result["daily"][0]["amortizations"], 500 * 20)
+        self.assertAlmostEqual(result["daily"][1]["total"], (2 * 0.87 + 100) * 3 * 75)
+        # Unknown coupons are extrapolated with the last known value
+        self.assertAlmostEqual(result["daily"][2]["coupons"], 50 * 0.87 * 20)
+        self.assertEqual([flow["is_extrapolated"] for flow in result["flows"] if flow["type"] == "coupons"],
+                         [False, False, True, True, True])
+        self.assertEqual([month["month"] for month in result["monthly"]], ["2021-06", "2021-09", "2021-12", "2022-03"])
+        self.assertAlmostEqual(result["monthly"][0]["total"], result["daily"][0]["total"] + result["daily"][1]["total"])
+        self.assertAlmostEqual(result["total"], sum(month["total"] for month in result["monthly"]))
+
+        result = BondsCashFlowProjector.project([bond], {"A": 1}, datetime.datetime(2021, 3, 1), redeem_at_offer=True)
+        self.assertEqual([(day["date"], day["redemptions"]) for day in result["daily"]],
+                         [("2021-06-01", 0), ("2021-09-01", 0), ("2021-12-01", 5000)])
+        result = BondsCashFlowProjector.project([bond], {"A": 1}, datetime.datetime(2021, 3, 1),
+                                                datetime.datetime(2021, 9, 1))
+        self.assertEqual(len(result["daily"]), 2)
+
+
+class BondsMOEXAsyncRetrieverTest(unittest.TestCase):
+    def setUp(self):
+        self.active_count = 0
+        self.max_active_count = 0
+        self.failed_urls = set()
+        self.lock = threading.Lock()
+        # Slow request is blocked until test finishes, so its timeout does not depend on speed of other requests
+        self.release_event = threading.Event()
+        self.addCleanup(self.release_event.set)
+
+    def _read_url(self, request_url, timeout):
+        with self.lock:
+            self.active_count += 1
+            self.max_active_count = max(self.max_active_count, self.active_count)
+        try:
+            if "SLOW" in request_url and "iss.only=description" in request_url:
+                self.release_event.wait()
+                raise urllib.error.URLError("Connection closed")
+            if "BAD" in request_url and request_url not in self.failed_urls:
+                self.failed_urls.add(request_url)
+                raise urllib.error.URLError("Connection reset")
+            if "BROKEN" in request_url:
+                return b"<html>Service unavailable</html>"
+            if "/boardgroups/" in request_url:
+                data = {"securities": {"columns": ["SECID", "ISIN", "PREVPRICE"],
+                                       "data": [[sec_id, sec_id, 99.5] for sec_id in ("A", "B", "BAD", "SLOW")]}}
+            elif "/bondization/" in request_url:
+                data = {"amortizations": {"columns": ["amortdate", "faceunit", "value"],
+                                          "data": [["2030-01-01", "RUB", 1000]]},
+                        "coupons": {"columns": ["coupondate", "faceunit", "value"], "data": [["2030-01-01", "RUB", 50]]},
+                        "offers": {"columns": ["offerdate", "offertype"], "data": []}}
+            elif "/history/" in request_url:
+                data = {"history": {"columns": ["TRADEDATE", "VOLUME", "NUMTRADES"], "data": [["2021-03-03", 10, 2]]}}
+            else:
+                data = {"description": {"columns": ["name", "value"],
+                                        "data": [["ISQUALIFIEDINVESTORS", "0"], ["TYPE", "exchange_bond"]]}}
+            return json.dumps(data).encode("utf-8")
+        finally:
+            with self.lock:
+                self.active_count -= 1
+
+    def test_iter_retrieve(self):
+        async def retrieve():
+            # Blocked threads of both attempts of slow request still leave one free thread for other requests
+            retriever = BondsMOEXAsyncRetriever(max_concurrency=3, timeout=0.5, attempt_count=2, sleep_sec=0)
+            try:
+                return [bond async for bond in retriever.iter_retrieve((7,))]
+            finally:
+                self.release_event.set()
+                retriever.close()
+
+        with mock.patch.object(BondsMOEXAsyncRetriever, "_read_url", side_effect=self._read_url):
+            bonds_list = asyncio.run(retrieve())
+        # Bond with timed out requests is skipped, failed request is repeated
+        self.assertEqual(sorted(bond["SECID"] for bond in bonds_list), ["A", "B", "BAD"])
+        self.assertEqual(bonds_list[0]["coupons"], [{"coupondate": "2030-01-01", "faceunit": "RUB", "value": 50}])
+        self.assertEqual(bonds_list[0]["TYPE"], "exchange_bond")
+        self.assertLessEqual(self.max_active_count, 3)
+
+    def test_broken_response(self):
+        async def retrieve():
+            retriever = BondsMOEXAsyncRetriever(max_concurrency=2, attempt_count=1)
+            bonds_list = [{"SECID": "A"}, {"SECID": "BROKEN"}, {"SECID": "B"}]
+            try:
+                return [bond async for bond in retriever.iter_enrich_bonds(bonds_list)]
+            finally:
+                retriever.close()
+
+        with mock.patch.object(BondsMOEXAsyncRetriever, "_read_url", side_effect=self._read_url):
+            with self.assertLogs(level="ERROR") as logs:
+                bonds_list = asyncio.run(retrieve())
+        self.assertEqual(sorted(bond["SECID"] for bond in bonds_list), ["A", "B"])
+        self.assertTrue(any("Can not enrich bond" in line for line in logs.output))
+
+    def test_broken_response_list(self):
+        async def enrich():
+            retriever = BondsMOEXAsyncRetriever(max_concurrency=2, attempt_count=1)
+            bonds_list = [{"SECID": "A"}, {"SECID": "BROKEN"}, {"SECID": "B"}]
+            try:
+                return (await retriever.enrich_bonds_description(bonds_list),
+                        await retriever.enrich_bonds_payments(bonds_list),
+                        await retriever.enrich_bonds_sales_history(bonds_list))
+            finally:
+                retriever.close()
+
+        with mock.patch.object(BondsMOEXAsyncRetriever, "_read_url", side_effect=self._read_url):
+            with self.assertLogs(level="ERROR") as logs:
+                results = asyncio.run(enrich())
+        for bonds_list in results:
+            self.assertEqual([bond["SECID"] for bond in bonds_list], ["A", "B"])
+        self.assertTrue(any("Can not enrich payments for bond" in line for line in logs.output))
+
+    def test_cancel(self):
+        async def retrieve():
+            retriever = BondsMOEXAsyncRetriever(max_concurrency=4)
+            bonds_list = [{"SECID": "SLOW" + str(i)} for i in range(20)]
+            try:
+                async for _ in retriever.iter_enrich_bonds(bonds_list):
+                    pass
+            finally:
+                retriever.close()
+
+        async def cancel():
+            task = asyncio.ensure_future(retrieve())
+            # Cancellation is requested while description requests are still blocked
+            while self.active_count < 4:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(BondsMOEXAsyncRetriever, "_read_url", side_effect=self._read_url):
+            asyncio.run(cancel())
+        self.assertFalse(self.release_event.is_set())
+
+
 if __name__ == '__main__':
     unittest.main()